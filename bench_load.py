@@ -0,0 +1,675 @@
+#!/usr/bin/env python3
+"""
+Headless load generator and latency benchmark for the chat server.
+
+Starts a server locally (or targets a running one with --no-server) and
+drives it with scripted bot clients from a single asyncio event loop.
+Every chat message a bot sends carries its send time, so receivers can
+measure end-to-end delivery latency.
+
+Scenarios:
+- broadcast: every bot broadcasts, every other bot receives (fan-out)
+- private: every bot sends private messages to random other bots
+- churn: bots log in, say one thing and leave, over and over, while a
+  few observers stay connected and receive the join/leave traffic
+- storm: every bot drops its connection at once and logs back in, as
+  after a server restart or a network blip; --messages sets the number
+  of storms. Run it with --server-arg=--presence-window=0 to compare
+  against announcing every join and leave separately
+- reap: bots log in and a third of them stop answering the server's
+  pings, as if their network had gone away, while a few extra
+  connections never send a username. The server is started with
+  --interval as its heartbeat interval (half of it as the heartbeat
+  timeout, all of it as the handshake timeout); the report counts the
+  dead and stalled connections that were closed, the live ones that
+  were wrongly closed, and how long after its deadline each one went
+- handoff: bots log in and a hundred of them keep sending private
+  messages while a second server process takes the first one's
+  connections over (--takeover); the report shows how long the
+  takeover took, how many bots were disconnected (none should be) and
+  whether every message arrived, and the delivery latency shows the
+  pause the clients saw
+- flaky: a hundred bots keep sending private messages to the others,
+  which now and then lose their connection for about half a second and
+  log back in, like phones on a bad network. With --resume the bots ask
+  for resumable sessions and come back with them; compare the messages
+  delivered, the join/leave notices and the logins with and without it
+Bots in the broadcast and private scenarios also ask for /users now and
+then, which is timed separately.
+
+--message-size pads messages with log-like text and --compression makes
+the bots negotiate compressed delivery; the report includes the bytes
+the bots received and the CPU time the server used, so the two can be
+compared.
+
+Usage:
+  python bench_load.py --scenario broadcast
+  python bench_load.py --scenario private --bots 2000 --engine asyncio --json private.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from protocol import COMPRESSIONS, FrameDecoder, decode_message, encode_frame, is_welcome, split_sequence
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+SCENARIOS = {
+    'broadcast': dict(bots=100, messages=20, interval=0.05, users_every=10),
+    'private': dict(bots=1000, messages=20, interval=0.1, users_every=10),
+    'churn': dict(bots=300, messages=5, interval=0.05, users_every=0),
+    'storm': dict(bots=500, messages=3, interval=1.0, users_every=0),
+    'reap': dict(bots=1000, messages=3, interval=2.0, users_every=0),
+    'handoff': dict(bots=10000, messages=40, interval=0.05, users_every=0),
+    'flaky': dict(bots=1000, messages=100, interval=0.05, users_every=0),
+}
+HANDOFF_TALKERS = 100  # Bots that keep sending private messages through the handoff
+FLAKY_TALKERS = 100  # Bots that keep sending private messages to the flaky ones
+FLAKY_PERIOD = 0.25  # Seconds between rounds of dropped connections
+FLAKY_DROPS = 0.02  # Fraction of the flaky bots that drop their connection each round
+FLAKY_OUTAGE = 0.5  # Average seconds a dropped bot stays away
+REAP_SILENT_EVERY = 3  # Every third bot stops answering pings
+REAP_STALLED_FRACTION = 0.1  # Connections that never log in, relative to the bots
+RECONNECT_ATTEMPTS = 20
+CHURN_OBSERVERS = 10
+MAX_CONCURRENT_LOGINS = 100
+LOGIN_TIMEOUT = 10.0
+DRAIN_TIMEOUT = 5.0
+MARKER = 'bench'
+LOG_LINE = ('2026-01-01T00:00:00Z INFO worker.py:142 - request handled in 12ms '
+            'status=200 path=/api/v1/messages user=bot\n')
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not samples:
+        return None
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+def summarize(samples):
+    """Count and p50/p95/p99/max, in milliseconds"""
+    samples = sorted(samples)
+    summary = {"count": len(samples)}
+    for name, p in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100)):
+        value = percentile(samples, p)
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+
+class Stats:
+    """Measurements collected by every bot"""
+
+    def __init__(self):
+        """Start with no samples"""
+        self.sent = 0
+        self.delivered = 0
+        self.deliveries = []  # Seconds from send to receipt
+        self.logins = []  # Seconds from connect to welcome
+        self.user_lists = []  # Seconds from /users request to reply
+        self.login_failures = 0
+        self.storms = []  # Seconds for every bot to log back in after a mass disconnect
+        self.presence_notices = 0  # Join/leave notices received
+        self.reaped = {}  # {'silent'/'stalled'/'live': connections the server closed}
+        self.reap_delays = []  # Seconds from a connection's timeout deadline to its close
+        self.handoff = {}  # Takeover timings from the new server, and bots disconnected by it
+        self.reconnects = {"logins": 0, "resumed": 0, "lost": 0}  # Flaky bots coming back
+        self.bytes_received = 0
+        self.last_delivery = time.monotonic()
+
+
+class Bot:
+    """One headless chat client"""
+
+    def __init__(self, name, stats, options, counts_deliveries=True):
+        """Create a bot that logs in as name"""
+        self.name = name
+        self.stats = stats
+        self.options = options
+        self.names = {}  # Name ids for binary frames
+        self.counts_deliveries = counts_deliveries  # Whether received chat messages are measured
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+        self.welcomed = None
+        self.users_requests = []  # Send times of unanswered /users requests
+        self.silent = False  # Ignores pings, like a client whose network went away
+        self.pinged = None  # When a silent bot got the ping it ignored
+        self.disconnected = None  # When the server closed the connection
+        self.away = False  # Dropped its connection and not logged back in yet
+        self.session = None  # Resume token, with --resume
+        self.last_seq = 0  # Last sequence number received in the session
+        self.resume_from = 0  # last_seq sent in the handshake
+        self.task = None
+
+    async def login(self, host, port):
+        """Connect and complete the username handshake"""
+        start = time.monotonic()
+        self.welcomed = asyncio.get_running_loop().create_future()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.decoder = FrameDecoder()
+        self.names = {}
+        self.task = asyncio.create_task(self.receive())
+        handshake = {"username": self.name, "heartbeat": True}  # Even the silent ones, so they are pinged
+        if self.options.compression:
+            handshake['compression'] = self.options.compression
+        if self.options.resume:
+            handshake['resume'] = True
+            if self.session:
+                handshake['session'] = self.session
+                handshake['last_seq'] = self.last_seq
+        self.resume_from, self.last_seq = self.last_seq, 0
+        self.send(handshake)
+        await asyncio.wait_for(self.welcomed, LOGIN_TIMEOUT)
+        self.stats.logins.append(time.monotonic() - start)
+
+    def send(self, message):
+        """Frame and write one message"""
+        self.writer.write(encode_frame(json.dumps(message).encode('utf-8')))
+
+    def chat(self, text, target=None):
+        """Send a timestamped broadcast, or private message to target"""
+        body = f"{MARKER} {time.monotonic()} {text} "
+        if len(body) < self.options.message_size:
+            body += (LOG_LINE * (self.options.message_size // len(LOG_LINE) + 1))[:self.options.message_size - len(body)]
+        if target:
+            self.send({"type": "private", "target": target, "message": body})
+        else:
+            self.send({"type": "message", "message": body})
+        self.stats.sent += 1
+
+    def request_users(self):
+        """Ask for the user list"""
+        self.users_requests.append(time.monotonic())
+        self.send({"type": "list_users"})
+
+    async def receive(self):
+        """Read frames until the connection closes, recording latencies"""
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.stats.bytes_received += len(data)
+                self.decoder.feed(data)
+                now = time.monotonic()
+                for flags, payload in self.decoder.frames():
+                    seq, flags, payload = split_sequence(flags, payload)
+                    if seq is not None:
+                        self.last_seq = seq
+                    message = decode_message(flags, payload, self.names)
+                    if message is not None:
+                        self.handle(message, now)
+            self.disconnected = time.monotonic()
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            if self.welcomed is not None and not self.welcomed.done():
+                self.welcomed.set_exception(ConnectionError(f"{self.name} was disconnected"))
+
+    def handle(self, message, now):
+        """Account for one received message"""
+        text = message.get('message', '')
+        if message.get('type') in ('message', 'private') and text.startswith(MARKER):
+            if not self.counts_deliveries:
+                return
+            self.stats.deliveries.append(now - float(text.split(' ', 2)[1]))
+            self.stats.delivered += 1
+            self.stats.last_delivery = now
+        elif message.get('type') == 'system':
+            if not self.welcomed.done():
+                if message.get('error') == 'username_taken':
+                    self.welcomed.set_exception(ConnectionError(f"username {self.name} taken"))
+                elif is_welcome(message):
+                    self.session = message.get('session')
+                    if message.get('resumed'):
+                        self.last_seq = max(self.last_seq, self.resume_from)
+                        self.stats.reconnects['resumed'] += 1
+                        self.stats.reconnects['lost'] += message.get('lost', 0)
+                    self.welcomed.set_result(True)
+            elif ('request' in message or text.startswith('Connected users')) and self.users_requests:
+                sent = self.users_requests.pop(0)
+                if message.get('error') is None:  # Not dropped by the rate limit
+                    self.stats.user_lists.append(now - sent)
+            elif 'presence' in message or text.endswith((' joined the chat', ' left the chat')):
+                self.stats.presence_notices += 1
+        elif message.get('type') == 'ping':
+            if not self.silent:
+                self.send({"type": "pong"})
+            elif self.pinged is None:
+                self.pinged = now
+
+    async def close(self):
+        """Disconnect"""
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        if self.task is not None:
+            self.task.cancel()
+
+
+async def login_all(bots, host, port, stats):
+    """Log bots in with bounded concurrency, returning the ones that made it"""
+    gate = asyncio.Semaphore(MAX_CONCURRENT_LOGINS)
+
+    async def login(bot):
+        async with gate:
+            try:
+                await bot.login(host, port)
+                return bot
+            except (OSError, ConnectionError, asyncio.TimeoutError):
+                stats.login_failures += 1
+                await bot.close()
+                return None
+
+    return [bot for bot in await asyncio.gather(*(login(bot) for bot in bots)) if bot]
+
+
+async def wait_for_deliveries(stats, expected):
+    """Wait until expected deliveries arrived or none arrived for a while"""
+    while stats.delivered < expected and time.monotonic() - stats.last_delivery < DRAIN_TIMEOUT:
+        await asyncio.sleep(0.05)
+
+
+async def run_chatter(bots, options, stats, private):
+    """Every bot sends its messages, to everyone or to random other bots"""
+    names = [bot.name for bot in bots]
+
+    async def talk(bot):
+        await asyncio.sleep(random.random() * options.interval)
+        for i in range(options.messages):
+            target = None
+            while private and target in (None, bot.name):
+                target = random.choice(names)
+            bot.chat(f"{bot.name} {i}", target)
+            if options.users_every and i % options.users_every == options.users_every - 1:
+                bot.request_users()
+            await asyncio.sleep(options.interval)
+
+    await asyncio.gather(*(talk(bot) for bot in bots))
+    per_message = 1 if private else len(bots) - 1
+    return len(bots) * options.messages * per_message
+
+
+async def run_churn(host, port, options, stats):
+    """Bots cycle through login, one broadcast and logout"""
+    observers = [Bot(f"observer{i}", stats, options) for i in range(CHURN_OBSERVERS)]
+    observers = await login_all(observers, host, port, stats)
+    gate = asyncio.Semaphore(MAX_CONCURRENT_LOGINS)
+
+    async def churn(index):
+        for cycle in range(options.messages):
+            bot = Bot(f"churn{index}_{cycle}", stats, options, counts_deliveries=False)
+            async with gate:
+                try:
+                    await bot.login(host, port)
+                    bot.chat(f"{bot.name} hello")
+                    await bot.writer.drain()
+                except (OSError, ConnectionError, asyncio.TimeoutError):
+                    stats.login_failures += 1
+                await bot.close()
+            await asyncio.sleep(options.interval)
+
+    await asyncio.gather(*(churn(index) for index in range(options.bots)))
+    return observers, stats.sent * len(observers)
+
+
+async def run_storm(host, port, options, stats):
+    """Bots all disconnect at once and log back in, options.messages times"""
+    bots = await login_all([Bot(f"bot{i}", stats, options) for i in range(options.bots)], host, port, stats)
+    print(f"{len(bots)} bots logged in")
+    gate = asyncio.Semaphore(MAX_CONCURRENT_LOGINS)
+
+    async def reconnect(name):
+        # The server may still hold the old connection, so retry a taken name
+        for attempt in range(RECONNECT_ATTEMPTS):
+            bot = Bot(name, stats, options)
+            async with gate:
+                try:
+                    await bot.login(host, port)
+                    return bot
+                except (OSError, ConnectionError, asyncio.TimeoutError):
+                    await bot.close()
+            await asyncio.sleep(0.05 * (attempt + 1))
+        stats.login_failures += 1
+        return None
+
+    for storm in range(options.messages):
+        await asyncio.sleep(options.interval)  # Let the previous storm's notices arrive
+        names = [bot.name for bot in bots]
+        start = time.monotonic()
+        await asyncio.gather(*(bot.close() for bot in bots))
+        bots = [bot for bot in await asyncio.gather(*(reconnect(name) for name in names)) if bot]
+        stats.storms.append(time.monotonic() - start)
+        print(f"Storm {storm + 1}: {len(bots)} bots back in {stats.storms[-1]:.2f}s")
+    await asyncio.sleep(options.interval)
+    return bots, 0
+
+
+async def run_reap(host, port, options, stats):
+    """Bots go quiet or never log in, and the server's timeouts should close exactly those"""
+    bots = await login_all([Bot(f"bot{i}", stats, options) for i in range(options.bots)], host, port, stats)
+    print(f"{len(bots)} bots logged in")
+    for bot in bots[::REAP_SILENT_EVERY]:
+        bot.silent = True
+    start = time.monotonic()
+    stalled = []
+    for _ in range(int(options.bots * REAP_STALLED_FRACTION)):
+        reader, writer = await asyncio.open_connection(host, port)
+        stalled.append((time.monotonic(), reader, writer))
+
+    async def closed(reader):
+        try:
+            while await reader.read(65536):
+                pass
+        except OSError:
+            pass
+        return time.monotonic()
+
+    wait = options.interval * (1 + options.messages)
+    try:
+        closes = await asyncio.wait_for(asyncio.gather(*(closed(reader) for _, reader, _ in stalled)), wait)
+    except asyncio.TimeoutError:
+        closes = []
+    await asyncio.sleep(max(0.0, start + wait - time.monotonic()))
+    stats.reaped['stalled'] = len(closes)
+    stats.reap_delays += [closed_at - (connected + options.interval)
+                          for closed_at, (connected, _, _) in zip(closes, stalled)]
+    for (connected, reader, writer) in stalled:
+        writer.close()
+    silent = [bot for bot in bots if bot.silent]
+    stats.reaped['silent'] = sum(bot.disconnected is not None for bot in silent)
+    # Pinged bots have half of interval to answer
+    stats.reap_delays += [bot.disconnected - (bot.pinged + options.interval / 2)
+                          for bot in silent if bot.disconnected is not None and bot.pinged is not None]
+    stats.reaped['live'] = sum(bot.disconnected is not None for bot in bots if not bot.silent)
+    print(f"Reaped {stats.reaped['silent']}/{len(silent)} silent bots, {stats.reaped['stalled']}/{len(stalled)} "
+          f"stalled handshakes and {stats.reaped['live']} live bots")
+    return [bot for bot in bots if bot.disconnected is None], 0
+
+
+async def run_handoff(host, port, options, stats, servers):
+    """Bots keep talking while a new server process takes over from the running one"""
+    bots = await login_all([Bot(f"bot{i}", stats, options) for i in range(options.bots)], host, port, stats)
+    print(f"{len(bots)} bots logged in")
+    names = [bot.name for bot in bots]
+    talkers = bots[:HANDOFF_TALKERS]
+
+    async def talk(bot):
+        await asyncio.sleep(random.random() * options.interval)
+        for i in range(options.messages):
+            bot.chat(f"{bot.name} {i}", random.choice(names))
+            await asyncio.sleep(options.interval)
+
+    async def take_over():
+        await asyncio.sleep(options.interval * options.messages / 2)
+        successor = subprocess.Popen(server_command(options) + ['--takeover'], stdout=subprocess.PIPE, text=True)
+        servers.append(successor)
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, successor.stdout.readline)
+            if not line or line.startswith('Took over'):
+                break
+        # Keep the pipe from filling up, on a thread that does not hold up the loop's shutdown
+        threading.Thread(target=successor.stdout.read, daemon=True).start()
+        print(line.strip() or "The new server did not take over")
+        await loop.run_in_executor(None, servers[0].wait, 10)
+        numbers = [float(word) for word in line.replace(':', ' ').split() if word.replace('.', '').isdigit()]
+        if len(numbers) == 3:
+            stats.handoff.update(connections=int(numbers[0]), received_ms=numbers[1], serving_ms=numbers[2])
+
+    await asyncio.gather(take_over(), *(talk(bot) for bot in talkers))
+    await wait_for_deliveries(stats, len(talkers) * options.messages)
+    stats.handoff['disconnected'] = sum(bot.disconnected is not None for bot in bots)
+    print(f"Handoff: {stats.handoff}")
+    return bots, len(talkers) * options.messages
+
+
+async def run_flaky(host, port, options, stats):
+    """Bots drop their connections now and then while others keep sending them private messages"""
+    bots = await login_all([Bot(f"bot{i}", stats, options) for i in range(options.bots)], host, port, stats)
+    print(f"{len(bots)} bots logged in")
+    talkers, flaky = bots[:FLAKY_TALKERS], bots[FLAKY_TALKERS:]
+    names = [bot.name for bot in flaky]
+    gate = asyncio.Semaphore(MAX_CONCURRENT_LOGINS)
+
+    async def talk(bot):
+        await asyncio.sleep(random.random() * options.interval)
+        for i in range(options.messages):
+            bot.chat(f"{bot.name} {i}", random.choice(names))
+            await asyncio.sleep(options.interval)
+
+    async def drop(bot):
+        bot.away = True
+        bot.writer.transport.abort()
+        await asyncio.sleep(FLAKY_OUTAGE * random.uniform(0.5, 1.5))
+        # Without a session the server may still hold the old connection, so retry a taken name
+        for attempt in range(RECONNECT_ATTEMPTS):
+            async with gate:
+                try:
+                    await bot.login(host, port)
+                    stats.reconnects['logins'] += 1
+                    bot.away = False
+                    return
+                except (OSError, ConnectionError, asyncio.TimeoutError):
+                    bot.writer.close()
+            await asyncio.sleep(0.05 * (attempt + 1))
+        stats.login_failures += 1
+
+    async def flap():
+        drops = []
+        end = time.monotonic() + options.interval * options.messages
+        while time.monotonic() < end:
+            await asyncio.sleep(FLAKY_PERIOD)
+            present = [bot for bot in flaky if not bot.away]
+            for bot in random.sample(present, min(len(present), max(1, int(len(flaky) * FLAKY_DROPS)))):
+                drops.append(asyncio.create_task(drop(bot)))
+        await asyncio.gather(*drops)
+
+    await asyncio.gather(flap(), *(talk(bot) for bot in talkers))
+    print(f"Reconnects: {stats.reconnects}")
+    return bots, len(talkers) * options.messages
+
+
+async def run_scenario(options, servers):
+    """Run the selected scenario and return the report"""
+    stats = Stats()
+    host, port = options.host, options.port
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    if options.scenario == 'churn':
+        bots, expected = await run_churn(host, port, options, stats)
+    elif options.scenario == 'storm':
+        bots, expected = await run_storm(host, port, options, stats)
+    elif options.scenario == 'reap':
+        bots, expected = await run_reap(host, port, options, stats)
+    elif options.scenario == 'handoff':
+        bots, expected = await run_handoff(host, port, options, stats, servers)
+    elif options.scenario == 'flaky':
+        bots, expected = await run_flaky(host, port, options, stats)
+    else:
+        bots = await login_all([Bot(f"bot{i}", stats, options) for i in range(options.bots)], host, port, stats)
+        login_done = time.monotonic()
+        print(f"{len(bots)} bots logged in in {login_done - start:.2f}s")
+        start = login_done
+        expected = await run_chatter(bots, options, stats, options.scenario == 'private')
+    await wait_for_deliveries(stats, expected)
+    elapsed = stats.last_delivery - start if stats.delivered else time.monotonic() - start
+    for bot in bots:
+        await bot.close()
+    return {
+        "scenario": options.scenario,
+        "engine": options.engine,
+        "bots": options.bots,
+        "messages_per_bot": options.messages,
+        "interval": options.interval,
+        "message_size": options.message_size,
+        "compression": options.compression,
+        "commit": git_commit(),
+        "seconds": round(elapsed, 3),
+        "sent": stats.sent,
+        "expected_deliveries": expected,
+        "deliveries": stats.delivered,
+        "sent_per_second": round(stats.sent / elapsed, 1) if elapsed > 0 else None,
+        "deliveries_per_second": round(stats.delivered / elapsed, 1) if elapsed > 0 else None,
+        "delivery_latency_ms": summarize(stats.deliveries),
+        "login_latency_ms": summarize(stats.logins),
+        "users_latency_ms": summarize(stats.user_lists),
+        "reconnect_storm_ms": summarize(stats.storms),
+        "presence_notices": stats.presence_notices,
+        "reaped": stats.reaped,
+        "reap_delay_ms": summarize(stats.reap_delays),
+        "handoff": stats.handoff,
+        "resume": options.resume,
+        "reconnects": stats.reconnects,
+        "login_failures": stats.login_failures,
+        "bytes_received": stats.bytes_received,
+        "bench_cpu_seconds": round(time.process_time() - cpu_start, 3),
+        "server_cpu_seconds": None,  # Filled in once a server started by us exits
+    }
+
+
+def git_commit():
+    """Short hash of the checked out commit, if this is a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit permits"""
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def server_command(options):
+    """Command line of the local server for the scenario"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    extra = []
+    if options.scenario == 'reap':
+        extra = ['--heartbeat-interval', str(options.interval), '--heartbeat-timeout', str(options.interval / 2),
+                 '--handshake-timeout', str(options.interval)]
+    elif options.scenario == 'handoff':
+        extra = ['--handoff-path', os.path.join(tempfile.gettempdir(), f"chat-bench-{options.port}.sock")]
+    return [sys.executable, script, '--host', options.host, '--port', str(options.port),
+            '--engine', options.engine] + extra + options.server_args
+
+
+def start_server(options):
+    """Start a local server for the benchmark and wait until it accepts connections"""
+    process = subprocess.Popen(server_command(options), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((options.host, options.port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+def print_report(report):
+    """Print a short human readable summary"""
+    print(f"Scenario {report['scenario']} ({report['engine']} engine, commit {report['commit']})")
+    print(f"  sent {report['sent']} messages, delivered {report['deliveries']}/{report['expected_deliveries']}"
+          f" in {report['seconds']}s")
+    print(f"  throughput: {report['sent_per_second']} sent/s, {report['deliveries_per_second']} deliveries/s")
+    for label, key in (("delivery", 'delivery_latency_ms'), ("login", 'login_latency_ms'),
+                       ("/users", 'users_latency_ms'), ("reconnect storm", 'reconnect_storm_ms'),
+                       ("reap", 'reap_delay_ms')):
+        summary = report[key]
+        if summary['count']:
+            print(f"  {label} latency ms: p50 {summary['p50']}  p95 {summary['p95']}"
+                  f"  p99 {summary['p99']}  max {summary['max']}  (n={summary['count']})")
+    print(f"  bots received {report['bytes_received']} bytes"
+          + (f", server used {report['server_cpu_seconds']}s CPU" if report['server_cpu_seconds'] is not None else ""))
+    if report['reaped']:
+        print("  connections closed by the server: "
+              + ', '.join(f"{count} {kind}" for kind, count in report['reaped'].items()))
+    if report['handoff']:
+        print(f"  handoff of {report['handoff'].get('connections')} connections: received in "
+              f"{report['handoff'].get('received_ms')} ms, serving after {report['handoff'].get('serving_ms')} ms, "
+              f"{report['handoff']['disconnected']} bots disconnected")
+    if report['reconnects']['logins']:
+        print(f"  {report['reconnects']['logins']} reconnects, {report['reconnects']['resumed']} resumed sessions, "
+              f"{report['reconnects']['lost']} messages lost on resume")
+    if report['presence_notices']:
+        print(f"  join/leave notices received: {report['presence_notices']}")
+    if report['login_failures']:
+        print(f"  login failures: {report['login_failures']}")
+
+
+def parse_args(argv=None):
+    """Parse the command line, filling unset values from the scenario preset"""
+    parser = argparse.ArgumentParser(description="Chat server load benchmark")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='broadcast')
+    parser.add_argument('--bots', type=int, help="bot clients (churn: bots logging in and out)")
+    parser.add_argument('--messages', type=int, help="messages per bot (churn: login cycles per bot)")
+    parser.add_argument('--interval', type=float, help="seconds between a bot's messages")
+    parser.add_argument('--users-every', type=int, help="request /users every N messages (0: never)")
+    parser.add_argument('--message-size', type=int, default=0,
+                        help="pad chat messages with log lines to this many characters")
+    parser.add_argument('--compression', choices=COMPRESSIONS, help="ask the server for compressed delivery")
+    parser.add_argument('--resume', action='store_true',
+                        help="bots ask for resumable sessions and resume them when they reconnect")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12399)
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'), default='threaded')
+    parser.add_argument('--no-server', action='store_true', help="benchmark a server that is already running")
+    parser.add_argument('--server-arg', dest='server_args', action='append', default=[],
+                        help="extra argument for the started server (repeatable)")
+    parser.add_argument('--json', metavar='FILE', help="also write the report as JSON to FILE ('-' for stdout)")
+    options = parser.parse_args(argv)
+    if options.scenario == 'handoff' and options.no_server:
+        parser.error("the handoff scenario starts its own servers")
+    for key, value in SCENARIOS[options.scenario].items():
+        if getattr(options, key) is None:
+            setattr(options, key, value)
+    return options
+
+
+def main():
+    """Run one benchmark scenario"""
+    options = parse_args()
+    raise_file_limit()
+    servers = [] if options.no_server else [start_server(options)]
+    try:
+        report = asyncio.run(run_scenario(options, servers))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    if servers and resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report['server_cpu_seconds'] = round(usage.ru_utime + usage.ru_stime, 3)
+    print_report(report)
+    if options.json == '-':
+        print(json.dumps(report, indent=2))
+    elif options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Interactive client display benchmark.
+Feeds chat messages at a fixed rate (5000 a second by default) to the
+interactive client's display, which writes to a pseudo-terminal whose
+other end is read at a limited rate, like a terminal emulator drawing
+lines. Meanwhile a ticker that should wake every 10 ms on the same
+event loop (where keyboard input, pongs and reads are handled too)
+records how late it wakes. Compares printing every message with the
+batched Renderer, and reports how many messages each kept up with.
+
+Usage: python bench_render.py [messages per second] [seconds] [terminal bytes per second]
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from client import InteractiveClient
+from protocol import timestamp
+from render import Renderer
+
+TICK = 0.01  # Seconds between the ticker's wakeups, and between batches of messages
+
+
+def drain(fd, rate):
+    """Read the terminal side of the pty no faster than rate bytes per second"""
+    try:
+        while True:
+            data = os.read(fd, 16384)
+            if not data:
+                return
+            time.sleep(len(data) / rate)
+    except OSError:
+        pass  # The other side was closed
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a sorted list, in milliseconds"""
+    return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000 if samples else 0.0
+
+
+async def run(mode, rate, duration, out):
+    """Feed messages for duration seconds; return (messages fed, sorted ticker lateness, renderer)"""
+    loop = asyncio.get_running_loop()
+    client = InteractiveClient()
+    renderer = Renderer(client.format_message, out)
+    fed = 0
+    lateness = []
+    end = loop.time() + duration
+
+    async def ticker():
+        while loop.time() < end:
+            start = loop.time()
+            await asyncio.sleep(TICK)
+            lateness.append(loop.time() - start - TICK)
+
+    async def feed():
+        nonlocal fed
+        start = loop.time()
+        while loop.time() < end:
+            # Catch up to where the feed should be, as a receive loop handed a full socket buffer would
+            due = int((loop.time() - start) * rate)
+            for i in range(fed, due):
+                message = {"type": "message", "sender": f"user{i % 50}", "timestamp": timestamp(),
+                           "message": f"message {i} in a busy room"}
+                if mode == 'print':
+                    print(client.format_message(message), file=out)
+                else:
+                    renderer.add(message)
+            fed = max(fed, due)
+            await asyncio.sleep(TICK)
+
+    await asyncio.gather(ticker(), feed())
+    renderer.close()
+    return fed, sorted(lateness), renderer
+
+
+def main():
+    """Print ticker lateness and throughput for both display modes"""
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    terminal_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 64 * 1024
+    print(f"{rate} messages/s for {duration:g}s into a terminal reading {terminal_rate / 1024:.0f} KiB/s")
+    for mode in ('print', 'batched'):
+        master, slave = os.openpty()
+        reader = threading.Thread(target=drain, args=(master, terminal_rate), daemon=True)
+        reader.start()
+        with open(slave, 'w', buffering=1) as out:  # Line buffered, as stdout is on a terminal
+            fed, lateness, renderer = asyncio.run(run(mode, rate, duration, out))
+        os.close(master)
+        line = (f"{mode:8} fed {fed / duration:.0f} messages/s; event loop late by p50 "
+                f"{percentile(lateness, 50):.1f} ms, p99 {percentile(lateness, 99):.1f} ms, "
+                f"max {percentile(lateness, 100):.1f} ms")
+        if mode == 'batched':
+            line += (f"; {renderer.displayed} displayed, {renderer.collapsed} collapsed in "
+                     f"{renderer.updates} writes, {renderer.budget} lines per update at the end")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
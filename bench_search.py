@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Search index benchmark.
+Logs and indexes synthetic chat messages (Zipf-distributed words from a
+fixed vocabulary, a thousand senders), then reports indexing speed, the
+index's memory per million messages, the size of the saved index, how
+long loading it takes, and the latency of a few typical searches.
+
+Usage: python bench_search.py [messages]
+"""
+
+import random
+import sys
+import tempfile
+import time
+
+from history import MessageLog
+from protocol import FRAMING_LENGTH, Payload, timestamp
+from search import SearchIndex
+
+VOCABULARY = 50000
+SENDERS = 1000
+
+
+def main():
+    """Print indexing, memory, persistence and query figures"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rng = random.Random(1)
+    words = [f"w{i}" for i in range(VOCABULARY)]
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY)]
+    vocabulary = rng.choices(words, weights, k=count * 12)
+
+    with tempfile.TemporaryDirectory() as directory:
+        log = MessageLog(directory, fsync='never')
+        index = SearchIndex(log, save_interval=0)
+        start = time.perf_counter()
+        for i in range(count):
+            text = ' '.join(vocabulary[i * 12:i * 12 + rng.randint(4, 12)])
+            message = {"type": "message", "sender": f"user{i % SENDERS}", "message": text,
+                       "timestamp": timestamp()}
+            index.append(Payload(message).frame(FRAMING_LENGTH), message)
+        elapsed = time.perf_counter() - start
+        size = index.memory()
+        print(f"Indexed {count} messages in {elapsed:.2f}s ({elapsed / count * 1e6:.1f} us each, "
+              "including the log append)")
+        print(f"Index memory: {size / 2**20:.1f} MiB for {len(index.postings)} terms, "
+              f"{size / count * 1e6 / 2**20:.0f} MiB per million messages")
+
+        index.save()
+        saved = index.path
+        with open(saved, 'rb') as f:
+            saved_size = len(f.read())
+        start = time.perf_counter()
+        reloaded = SearchIndex(log, save_interval=0)
+        print(f"Saved index: {saved_size / 2**20:.1f} MiB, loaded in {time.perf_counter() - start:.2f}s "
+              f"({reloaded.messages} messages)")
+
+        for query in ("w0", "w0 w1", "w5000", "w0 from:user7", "w20000 w3"):
+            start = time.perf_counter()
+            results = index.search(query, "user0")
+            print(f"  search {query!r:>16}: {len(results):>2} results in "
+                  f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        log.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Timing wheel benchmark.
+Runs the server's Heartbeats against simulated connections on a
+simulated clock: most connections receive data now and then and answer
+pings, a few stop answering (half-open) and a few never finish the
+handshake. Reports the CPU time spent on timers per simulated second,
+how many connections were reaped, and how late each reap was compared
+with its exact deadline.
+
+Usage: python bench_timers.py [connections] [simulated seconds]
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+
+from protocol import FRAMING_LENGTH
+from timers import Heartbeats
+
+HEARTBEAT_INTERVAL = 30.0
+HEARTBEAT_TIMEOUT = 10.0
+HANDSHAKE_TIMEOUT = 10.0
+DEAD_FRACTION = 0.01
+STALLED_FRACTION = 0.001
+ACTIVE_PER_TICK = 0.01  # Fraction of the connections that receive data every tick
+
+
+class Server:
+    """Just enough of a ChatServer for Heartbeats"""
+    loop = None
+
+
+class QuietHeartbeats(Heartbeats):
+    """Heartbeats without the log line per reaped connection"""
+
+    def reap(self, connection, reason):
+        """Count and close"""
+        self.reaped[reason] += 1
+        connection.abort()
+
+
+class Connection:
+    """Simulated client connection"""
+
+    def __init__(self, index, wheel, dead, stalled):
+        """dead connections go quiet after logging in; stalled ones never log in"""
+        self.address = ('127.0.0.1', index)
+        self.username = None if stalled else f"user{index}"
+        self.wheel = wheel
+        self.dead = dead
+        self.closed = False
+        self.frozen = False
+        self.framing = FRAMING_LENGTH
+        self.heartbeat = True  # Answers pings, unless dead
+        self.reaped_at = None
+
+    def send(self, data):
+        """A ping; live clients answer within the same tick"""
+        if not self.dead:
+            self.last_seen = self.wheel.now
+
+    def abort(self):
+        """Reaped"""
+        self.closed = True
+        self.reaped_at = self.wheel.now
+
+
+def main():
+    """Print timer cost, reap counts and reap lateness"""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 120.0
+    rng = random.Random(1)
+    heartbeats = QuietHeartbeats(Server(), HANDSHAKE_TIMEOUT, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+    wheel = heartbeats.wheel
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    connections = []
+    for index in range(count):
+        connection = Connection(index, wheel, rng.random() < DEAD_FRACTION, rng.random() < STALLED_FRACTION)
+        heartbeats.watch(connection)
+        connections.append(connection)
+    setup = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    timer_cpu = 0.0
+    slowest = 0.0
+    ticks = int(duration / wheel.tick)
+    for tick in range(1, ticks + 1):
+        now = wheel.started + tick * wheel.tick
+        # Traffic: stamping last_seen is all a received packet costs
+        for connection in rng.sample(connections, int(count * ACTIVE_PER_TICK)):
+            if not connection.dead and not connection.closed:
+                connection.last_seen = wheel.now
+        start = time.perf_counter()
+        wheel.advance(now)
+        elapsed = time.perf_counter() - start
+        timer_cpu += elapsed
+        slowest = max(slowest, elapsed)
+
+    late = []
+    for connection in connections:
+        if connection.reaped_at is None:
+            continue
+        if connection.username is None:
+            deadline = connection.connected_at + HANDSHAKE_TIMEOUT
+        else:
+            deadline = connection.last_seen + connection.ping_interval + HEARTBEAT_TIMEOUT
+        late.append(connection.reaped_at - deadline)
+    late.sort()
+    dead = sum(connection.dead and connection.username is not None for connection in connections)
+    stalled = sum(connection.username is None for connection in connections)
+    live_reaped = sum(connection.closed and not connection.dead and connection.username is not None
+                      for connection in connections)
+    print(f"{count} connections, {duration:g}s simulated in {ticks} ticks of {wheel.tick * 1000:g} ms")
+    print(f"Setup: {setup / count * 1e6:.1f} us and {memory / count:.0f} bytes per connection "
+          "(connection objects included)")
+    print(f"Timer CPU: {timer_cpu:.2f}s ({timer_cpu / duration * 100:.2f}% of one core), "
+          f"slowest tick {slowest * 1000:.1f} ms, {heartbeats.pings} pings")
+    print(f"Reaped: {heartbeats.reaped['heartbeat']}/{dead} dead, {heartbeats.reaped['handshake']}/{stalled} "
+          f"stalled handshakes, {live_reaped} live connections")
+    if late:
+        print(f"Reap lateness: p50 {late[len(late) // 2] * 1000:.0f} ms, max {late[-1] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
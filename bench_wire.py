@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Wire format benchmark.
+Measures the size of a typical chat message and the time to encode and
+decode it in the JSON and binary encodings.
+
+Usage: python bench_wire.py [iterations]
+"""
+
+import sys
+import time
+
+from protocol import (FRAMING_LENGTH, HEADER_SIZE, InternTable, Payload,
+                      decode_binary, decode_json, timestamp)
+
+
+def sample_message():
+    """A broadcast as the server sends it"""
+    return {"type": "message", "sender": "alice", "message": "Hello everyone, how is it going?",
+            "timestamp": timestamp()}
+
+
+def measure(function, iterations):
+    """Average microseconds per call"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    """Print size and per-message encode/decode cost of each format"""
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    message = sample_message()
+    interns = InternTable()
+    interns.intern(message['sender'])
+    names = dict(enumerate(interns.names))
+
+    json_frame = Payload(message).frame(FRAMING_LENGTH)
+    binary_frame, _ = Payload(message).binary(interns)
+    results = [
+        ('json', len(json_frame),
+         measure(lambda: Payload(message).frame(FRAMING_LENGTH), iterations),
+         measure(lambda: decode_json(json_frame[HEADER_SIZE:]), iterations)),
+        ('binary', len(binary_frame),
+         measure(lambda: Payload(message).binary(interns), iterations),
+         measure(lambda: decode_binary(binary_frame[HEADER_SIZE:], names), iterations)),
+    ]
+
+    print(f"{'format':<8} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+    for name, size, encode_us, decode_us in results:
+        print(f"{name:<8} {size:>6} {encode_us:>10.2f} {decode_us:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Asyncio chat client library for bots, bridges and integrations.
+
+    client = ChatClient('localhost', 12345, 'bot')
+    await client.connect()
+    await client.send("hello")
+    await client.private('alice', "hi")
+    print(await client.users())
+    async for message in client:
+        ...
+
+Requests are pipelined: send(), private() and friends write their frame
+and return without waiting for the server, only pausing when the
+connection's write buffer is full. The server numbers its users()
+replies, so several requests can be outstanding at once and a call that
+stops waiting never takes the reply meant for the next one. A request
+dropped by the server's rate limit raises RateLimited.
+
+When the connection drops the client logs in again under the same name,
+backing off exponentially between attempts. Sends made while it is
+reconnecting wait for the new connection; a send racing the drop is lost.
+The client asks for a resumable session, so if the server still holds it
+the reconnect is silent and the messages sent meanwhile are delivered
+once, in order; otherwise (or with resume=False) it is a fresh login and
+those messages are lost.
+"""
+
+import asyncio
+import collections
+import json
+import random
+
+from protocol import (BINARY_TYPES, DEFAULT_COMPRESS_THRESHOLD, ENCODING_BINARY, ENCODING_JSON,
+                      FrameDecoder, InternTable, compress_frame, decode_message, encode_binary,
+                      encode_define, encode_frame, is_welcome, split_sequence)
+
+USERS_REPLY_PREFIX = 'Connected users'
+DEFAULT_LOGIN_TIMEOUT = 10.0
+DEFAULT_BACKOFF_INITIAL = 0.5
+DEFAULT_BACKOFF_MAX = 30.0
+READ_SIZE = 64 * 1024
+PONG_FRAME = encode_frame(b'{"type": "pong"}')
+LOGOUT_FRAME = encode_frame(b'{"type": "logout"}')
+
+
+class UsernameTaken(Exception):
+    """The server rejected the username because someone else is using it"""
+
+
+class RateLimited(Exception):
+    """The server dropped a request because the client sent too many"""
+
+
+class ChatClient:
+    """Asyncio client for the chat server"""
+
+    def __init__(self, host='localhost', port=12345, username=None, encoding=ENCODING_JSON,
+                 compression=None, reconnect=True, backoff_initial=DEFAULT_BACKOFF_INITIAL,
+                 backoff_max=DEFAULT_BACKOFF_MAX, on_connection_change=None, resume=True):
+        """Configure the client; nothing happens until connect()"""
+        self.host = host
+        self.port = port
+        self.username = username
+        self.requested_encoding = encoding
+        self.requested_compression = compression
+        self.reconnect = reconnect
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.on_connection_change = on_connection_change  # Called with True/False as the link comes and goes
+        self.encoding = ENCODING_JSON  # What the server agreed to for the current connection
+        self.compression = None
+        self.reader = None
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.closed = False
+        self.incoming = asyncio.Queue()
+        self.pending_users = collections.deque()  # (request number, future) waiting for user lists, oldest first
+        self.users_requests = 0  # list_users requests sent, numbered across reconnects as the server numbers replies
+        self.interns = InternTable()  # Ids for the names we send in binary frames
+        self.defined = set()  # Ids defined to the server on the current connection
+        self.names = {}  # Ids the server defined for us
+        self.reader_task = None
+        self.reconnects = 0
+        self.resume = resume  # Ask for a session that survives reconnects
+        self.session = None  # Token of the server-side session, once granted
+        self.last_seq = 0  # Sequence number of the last message received in the session
+        self.resumed = 0  # Reconnects that resumed the session
+        self.lost = 0  # Messages the server could no longer replay on a resume
+
+    # Connection management
+
+    async def connect(self, username=None, timeout=DEFAULT_LOGIN_TIMEOUT):
+        """Connect and log in, raising UsernameTaken if the name is in use"""
+        if username:
+            self.username = username
+        self.closed = False
+        await self.login(timeout)
+        self.reader_task = asyncio.create_task(self.read_loop())
+        return self
+
+    async def login(self, timeout):
+        """Open a connection and complete the username handshake"""
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        decoder = FrameDecoder()
+        names = {}
+        handshake = {"username": self.username, "heartbeat": True}  # dispatch() answers pings
+        if self.requested_encoding != ENCODING_JSON:
+            handshake['encoding'] = self.requested_encoding
+        if self.requested_compression:
+            handshake['compression'] = self.requested_compression
+        if self.users_requests:
+            handshake['users_requests'] = self.users_requests
+        if self.resume:
+            handshake['resume'] = True
+            if self.session:
+                handshake['session'] = self.session
+                handshake['last_seq'] = self.last_seq
+        last_seq, self.last_seq = self.last_seq, 0  # Numbering starts over unless resumed
+        writer.write(encode_frame(json.dumps(handshake).encode('utf-8')))
+        try:
+            welcome = await asyncio.wait_for(self.read_welcome(reader, decoder, names), timeout)
+        except BaseException:
+            self.last_seq = last_seq
+            writer.close()
+            raise
+        self.reader, self.writer = reader, writer
+        self.decoder, self.names = decoder, names
+        self.encoding = welcome.get('encoding') or ENCODING_JSON
+        self.compression = welcome.get('compression')
+        self.session = welcome.get('session')
+        if welcome.get('resumed'):
+            self.last_seq = max(self.last_seq, last_seq)
+            self.resumed += 1
+            self.lost += welcome.get('lost', 0)
+        self.defined = set()
+        self.connected.set()
+        if self.on_connection_change:
+            self.on_connection_change(True)
+
+    async def read_welcome(self, reader, decoder, names):
+        """Read until the server accepts or rejects the username"""
+        early_messages = []
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection during login")
+            decoder.feed(data)
+            for flags, payload in decoder.frames():
+                message = self.decode(flags, payload, names)
+                if message is None:
+                    continue
+                if message.get('error') == 'username_taken':
+                    raise UsernameTaken(message.get('message', f"Username '{self.username}' is taken"))
+                if is_welcome(message):
+                    for early in early_messages:
+                        self.incoming.put_nowait(early)
+                    self.incoming.put_nowait(message)
+                    # Frames that arrived together with the welcome
+                    for flags, payload in decoder.frames():
+                        self.dispatch(self.decode(flags, payload, names))
+                    return message
+                if 'timestamp' in message:
+                    # Routed to us once the name was claimed, just before the welcome went out
+                    early_messages.append(message)
+
+    async def read_loop(self):
+        """Receive messages, reconnecting when the connection drops"""
+        try:
+            while not self.closed:
+                try:
+                    while True:
+                        data = await self.reader.read(READ_SIZE)
+                        if not data:
+                            break
+                        self.decoder.feed(data)
+                        for flags, payload in self.decoder.frames():
+                            self.dispatch(self.decode(flags, payload, self.names))
+                except (OSError, ValueError):
+                    pass  # Connection reset or a frame we could not decode: reconnect
+                self.connection_lost()
+                if self.closed or not self.reconnect:
+                    break
+                await self.reconnect_with_backoff()
+        finally:
+            self.incoming.put_nowait(None)  # Ends iteration
+
+    def connection_lost(self):
+        """Forget the dropped connection and fail the requests waiting on it"""
+        self.connected.clear()
+        if self.writer is not None:
+            self.writer.close()
+        while self.pending_users:
+            number, future = self.pending_users.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError("Connection lost before the user list arrived"))
+        if self.on_connection_change and not self.closed:
+            self.on_connection_change(False)
+
+    async def reconnect_with_backoff(self):
+        """Log in again, waiting longer after every failed attempt"""
+        delay = self.backoff_initial
+        while not self.closed:
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                await self.login(DEFAULT_LOGIN_TIMEOUT)
+                self.reconnects += 1
+                return
+            except (OSError, ConnectionError, UsernameTaken, asyncio.TimeoutError):
+                # The server may not have noticed the old connection is gone yet
+                delay = min(delay * 2, self.backoff_max)
+
+    async def close(self):
+        """Log out and stop reconnecting"""
+        if self.session and self.connected.is_set():
+            self.writer.write(LOGOUT_FRAME)  # Leave now rather than when the session expires
+        self.closed = True
+        self.connected.clear()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        if self.reader_task is not None:
+            self.reader_task.cancel()  # Also interrupts a reconnect backoff
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+
+    # Incoming messages
+
+    def decode(self, flags, payload, names):
+        """Decode a frame, noting its sequence number if it has one"""
+        seq, flags, payload = split_sequence(flags, payload)
+        if seq is not None:
+            self.last_seq = seq
+        return decode_message(flags, payload, names)
+
+    def dispatch(self, message):
+        """Route a received message to a waiting users() call or the iterator"""
+        if message is None:
+            return  # A binary name definition
+        if message.get('type') == 'ping':
+            # The server checking that we are still here
+            if self.writer is not None:
+                self.writer.write(PONG_FRAME)
+            return
+        text = message.get('message', '')
+        if message.get('type') == 'system' and self.pending_users and (
+                'request' in message or text.startswith(USERS_REPLY_PREFIX)):
+            self.answer_users(message, text)
+            return
+        self.incoming.put_nowait(message)
+
+    def answer_users(self, message, text):
+        """Hand a user list reply, or the refusal of a request, to the users() call it answers"""
+        request = message.get('request')
+        while self.pending_users:
+            number, future = self.pending_users[0]
+            if request is not None and number > request:
+                return  # Answers a request given up on when the connection dropped
+            self.pending_users.popleft()
+            if request is None and future.done():
+                continue  # Older servers do not answer dropped requests, so a caller that gave up may get none
+            if request is not None and number < request:
+                if not future.done():
+                    future.set_exception(ConnectionError("The server did not answer the user list request"))
+                continue
+            if future.done():
+                return  # The caller stopped waiting for this reply
+            if message.get('error') == 'rate_limited':
+                future.set_exception(RateLimited(text))
+            else:
+                users = message.get('users')
+                if users is None:
+                    # Older servers only send the text
+                    users = [name for name in text.partition(': ')[2].split(', ') if name]
+                future.set_result(users)
+            return
+
+    def __aiter__(self):
+        """Iterate over incoming messages until the client is closed"""
+        return self
+
+    async def __anext__(self):
+        """Return the next incoming message"""
+        message = await self.incoming.get()
+        if message is None:
+            self.incoming.put_nowait(None)  # Let other iterators finish too
+            raise StopAsyncIteration
+        return message
+
+    async def receive_batch(self):
+        """Wait for the next message and return it with every other one already received.
+
+        Returns an empty list once the client is closed.
+        """
+        messages = []
+        message = await self.incoming.get()
+        while message is not None:
+            messages.append(message)
+            if self.incoming.empty():
+                return messages
+            message = self.incoming.get_nowait()
+        self.incoming.put_nowait(None)  # Let other readers finish too
+        return messages
+
+    # Requests
+
+    async def send(self, text):
+        """Broadcast a message (or run a command starting with '/')"""
+        await self.write({"type": "message", "message": text})
+
+    async def command(self, text):
+        """Run a server command such as '/join dev'"""
+        await self.send(text if text.startswith('/') else '/' + text)
+
+    async def private(self, target, text):
+        """Send a private message"""
+        await self.write({"type": "private", "target": target, "message": text})
+
+    async def room(self, room, text):
+        """Send a message to a room"""
+        await self.write({"type": "room", "room": room, "message": text})
+
+    async def users(self, prefix='', page=1):
+        """Return one page of the connected users whose names start with prefix.
+
+        Raises RateLimited if the server dropped the request.
+        """
+        future = asyncio.get_running_loop().create_future()
+        arguments = ' '.join(str(argument) for argument in (prefix, page) if argument)
+        await self.write({"type": "list_users", "message": arguments}, waiter=future)
+        return await future
+
+    async def write(self, message, waiter=None):
+        """Frame and write a message, waiting only if the connection is down or backed up"""
+        if self.closed:
+            raise ConnectionError("Client is closed")
+        await self.connected.wait()
+        if waiter is not None:
+            # Registered together with the write so replies stay in request order
+            self.users_requests += 1
+            self.pending_users.append((self.users_requests, waiter))
+        self.writer.write(self.frame(message))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            if not self.reconnect:
+                raise
+            # The read loop notices the drop and reconnects; this message is lost
+
+    def frame(self, message):
+        """Encode a message in the negotiated encoding and compression"""
+        define = b''
+        if self.encoding == ENCODING_BINARY:
+            name = message.get('target') or message.get('room')
+            name_id = self.interns.intern(name) if name else 0
+            if name_id and name_id not in self.defined:
+                # Announce a new target or room name before its first use
+                self.defined.add(name_id)
+                define = encode_define(name_id, name)
+            frame = encode_binary(BINARY_TYPES[message['type']], 0, name_id, 0,
+                                  message.get('message', '').encode('utf-8'))
+        else:
+            frame = encode_frame(json.dumps(message).encode('utf-8'))
+        if self.compression and len(frame) > DEFAULT_COMPRESS_THRESHOLD:
+            frame = compress_frame(frame)
+        return define + frame
@@ -6,207 +6,209 @@ Connects to the chat server and allows users to:
 - Send private messages
 - List connected users
 - View received messages
+
+This is an interactive frontend for the asyncio ChatClient in
+chat_client.py, which does the networking. Received messages are shown
+through a Renderer (render.py), which updates the terminal in batches
+and collapses floods it cannot keep up with.
 """
 
-import socket
-import threading
-import json
+import asyncio
 import sys
+import threading
 
-class ChatClient:
-    def __init__(self, host='localhost', port=12345):
-        """Initialize the chat client with server host and port"""
+from chat_client import ChatClient, UsernameTaken
+from protocol import COMPRESSIONS, ENCODING_BINARY, ENCODING_JSON
+from render import Renderer
+
+class InteractiveClient:
+    def __init__(self, host='localhost', port=12345, encoding=ENCODING_JSON, compression=None):
+        """Initialize the chat client with server host, port, wire encoding and compression"""
         self.host = host
         self.port = port
-        self.client_socket = None
+        self.client = ChatClient(host, port, encoding=encoding, compression=compression,
+                                 on_connection_change=self.connection_changed)
         self.username = None
-        self.connected = False
-        
-    def connect_to_server(self):
-        """Connect to the chat server"""
-        try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((self.host, self.port))
-            self.connected = True
-            print(f"Connected to chat server at {self.host}:{self.port}")
-            return True
-        except Exception as e:
-            print(f"Failed to connect to server: {e}")
-            return False
-    
-    def start_client(self):
+        self.renderer = Renderer(self.format_message)
+        self.dropped = 0  # Messages the server reported dropping because we fell behind
+        self.display_task = None
+
+    async def start_client(self):
         """Start the client and handle user interaction"""
-        if not self.connect_to_server():
-            return
-        
-        # Start thread to receive messages from server
-        receive_thread = threading.Thread(target=self.receive_messages)
-        receive_thread.daemon = True
-        receive_thread.start()
-        
         # Handle username setup
-        self.setup_username()
-        
+        if not await self.setup_username():
+            return
+
+        # Display messages from the server as they arrive
+        self.display_task = asyncio.create_task(self.receive_messages())
+
         # Display help message
         print("\n=== Simple Chat Client ===")
         print("Commands:")
         print("  /help - Show this help message")
-        print("  /users - List connected users")
+        print("  /users [prefix] [page] - List connected users, optionally by name prefix")
         print("  /private <username> <message> - Send private message")
+        print("  /join <room> - Join a room")
+        print("  /leave <room> - Leave a room")
+        print("  /room <room> <message> - Send a message to a room")
+        print("  /rooms - List the rooms you are in")
+        print("  /members <room> - List a room's members")
+        print("  /search <words> [from:<user>] [after:<time>] - Search the chat history")
         print("  /quit - Exit the chat")
         print("  Just type a message to broadcast to all users")
         print("=" * 30)
-        
+
         # Main message loop
-        self.message_loop()
-    
-    def setup_username(self):
-        """Handle username setup with the server"""
         try:
-            # Wait for server's username request
-            import time
-            time.sleep(0.1)  # Small delay to ensure server message is received
-            
-            while not self.username:
-                username = input("Enter your username: ").strip()
-                if username:
-                    username_msg = {"username": username}
-                    self.client_socket.send(json.dumps(username_msg).encode('utf-8'))
-                    self.username = username
-                    break
-                else:
-                    print("Username cannot be empty!")
-        except Exception as e:
-            print(f"Error setting up username: {e}")
-    
-    def receive_messages(self):
-        """Continuously receive messages from the server"""
-        while self.connected:
+            await self.message_loop()
+        finally:
+            await self.disconnect()
+
+    async def setup_username(self):
+        """Log in, asking for another username while the chosen one is taken"""
+        while not self.username:
+            username = (await read_line("Enter your username: ")).strip()
+            if not username:
+                print("Username cannot be empty!")
+                continue
             try:
-                data = self.client_socket.recv(1024).decode('utf-8')
-                if not data:
-                    break
-                
-                message = json.loads(data)
-                self.display_message(message)
-                
-            except Exception as e:
-                if self.connected:
-                    print(f"Error receiving message: {e}")
+                await self.client.connect(username)
+                self.username = username
+            except UsernameTaken as e:
+                print(f"SYSTEM: {e}")
+            except OSError as e:
+                print(f"Failed to connect to server: {e}")
+                return False
+        print(f"Connected to chat server at {self.host}:{self.port}")
+        return True
+
+    def connection_changed(self, connected):
+        """Tell the user when the connection drops and comes back"""
+        if not self.username:
+            return
+        if connected:
+            print("Reconnected to the server")
+        else:
+            print("Connection lost, reconnecting...")
+
+    async def receive_messages(self):
+        """Display messages until the client is closed, taking everything received so far at once"""
+        while True:
+            messages = await self.client.receive_batch()
+            if not messages:
                 break
-    
-    def display_message(self, message):
-        """Display received message based on its type"""
+            for message in messages:
+                self.dropped += message.get('dropped', 0)
+                # Chat traffic may be collapsed in a flood; what is meant for us never is
+                important = message.get('type') == 'private' or (
+                    message.get('type') == 'system' and 'presence' not in message)
+                self.renderer.add(message, important)
+
+    def format_message(self, message):
+        """Line for a received message based on its type, or None"""
         msg_type = message.get('type', 'message')
         timestamp = message.get('timestamp', '')
-        
+
         if msg_type == 'system':
-            print(f"[{timestamp}] SYSTEM: {message['message']}")
-            
+            return f"[{timestamp}] SYSTEM: {message['message']}"
+
         elif msg_type == 'message':
             sender = message.get('sender', 'Unknown')
             content = message.get('message', '')
-            print(f"[{timestamp}] {sender}: {content}")
-            
+            return f"[{timestamp}] {sender}: {content}"
+
         elif msg_type == 'private':
             sender = message.get('sender', 'Unknown')
             content = message.get('message', '')
-            print(f"[{timestamp}] PRIVATE from {sender}: {content}")
-    
-    def message_loop(self):
+            if sender == self.username and message.get('target'):
+                return f"[{timestamp}] PRIVATE to {message['target']}: {content}"
+            return f"[{timestamp}] PRIVATE from {sender}: {content}"
+
+        elif msg_type == 'room':
+            sender = message.get('sender', 'Unknown')
+            content = message.get('message', '')
+            return f"[{timestamp}] #{message.get('room', '')} {sender}: {content}"
+        return None
+
+    async def message_loop(self):
         """Main loop for handling user input and sending messages"""
-        while self.connected:
+        while True:
             try:
-                user_input = input().strip()
-                
+                user_input = (await read_line()).strip()
+
                 if not user_input:
                     continue
-                
+
                 if user_input == '/quit':
-                    self.disconnect()
                     break
-                    
-                elif user_input == '/help':
-                    self.send_command_message(user_input)
-                    
-                elif user_input == '/users':
-                    self.request_user_list()
-                    
-                elif user_input.startswith('/private'):
-                    self.send_command_message(user_input)
-                    
+
                 else:
-                    # Regular broadcast message
-                    self.send_broadcast_message(user_input)
-                    
-            except KeyboardInterrupt:
-                self.disconnect()
-                break
-            except Exception as e:
-                print(f"Error in message loop: {e}")
+                    # Broadcast messages and every other command
+                    await self.client.send(user_input)
+
+            except (EOFError, KeyboardInterrupt):
                 break
-    
-    def send_broadcast_message(self, message):
-        """Send a broadcast message to all users"""
-        try:
-            msg_data = {
-                "type": "message",
-                "message": message
-            }
-            self.client_socket.send(json.dumps(msg_data).encode('utf-8'))
-        except Exception as e:
-            print(f"Error sending message: {e}")
-    
-    def request_user_list(self):
-        """Request list of connected users from server"""
-        try:
-            msg_data = {"type": "list_users"}
-            self.client_socket.send(json.dumps(msg_data).encode('utf-8'))
-        except Exception as e:
-            print(f"Error requesting user list: {e}")
-    
-    def send_command_message(self, command):
-        """Send command message to server for processing"""
-        try:
-            msg_data = {
-                "type": "message",
-                "message": command
-            }
-            self.client_socket.send(json.dumps(msg_data).encode('utf-8'))
-        except Exception as e:
-            print(f"Error sending command: {e}")
-    
-    def disconnect(self):
+            except ConnectionError as e:
+                print(f"Error sending message: {e}")
+
+    async def disconnect(self):
         """Disconnect from the server"""
-        self.connected = False
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass
+        await self.client.close()
+        if self.display_task is not None:
+            await self.display_task
+        self.renderer.close()
         print("Disconnected from server")
+        if self.renderer.collapsed or self.dropped:
+            print(f"{self.renderer.summary()}, {self.dropped} dropped by the server")
+
+async def read_line(prompt=''):
+    """Read a line from the terminal without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def read():
+        # A daemon thread, so a pending input() never holds up exit
+        try:
+            result = (future.set_result, input(prompt))
+        except BaseException as e:
+            result = (future.set_exception, e)
+        try:
+            loop.call_soon_threadsafe(resolve, *result)
+        except RuntimeError:
+            pass  # The event loop has already finished
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
 
 def main():
     """Main function to start the client"""
     print("Simple Chat Client")
-    
+
     # Allow custom server address
     if len(sys.argv) > 1:
         host = sys.argv[1]
     else:
         host = 'localhost'
-    
+
     if len(sys.argv) > 2:
         port = int(sys.argv[2])
     else:
         port = 12345
-    
-    client = ChatClient(host, port)
+
+    # Optional wire format words after the port, e.g. "binary deflate"
+    options = sys.argv[3:]
+    encoding = ENCODING_BINARY if ENCODING_BINARY in options else ENCODING_JSON
+    compression = next((option for option in options if option in COMPRESSIONS), None)
+
+    client = InteractiveClient(host, port, encoding, compression)
     try:
-        client.start_client()
+        asyncio.run(client.start_client())
     except KeyboardInterrupt:
         print("\nExiting...")
-        client.disconnect()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
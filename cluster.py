@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Multi-process chat server.
+
+The launcher forks N worker processes that each run a ChatServer bound
+to the same port with SO_REUSEPORT, so the kernel spreads connections
+across them. The workers talk to a hub in the launcher process over a
+Unix domain socket. The hub:
+- keeps the global username directory, so names are unique cluster-wide
+- relays broadcasts (and room messages) from one worker to the others
+- routes private messages to the worker the target is connected to
+- answers user list queries from the directory
+
+Bus messages are JSON objects in length-prefixed frames, the same
+framing clients use.
+"""
+
+import _thread
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+
+from protocol import FrameDecoder, decode_json, encode_frame
+
+BUS_MAX_FRAME_SIZE = 16 * 1024 * 1024 - 1
+RPC_TIMEOUT = 5.0
+
+
+class PeerLink:
+    """Framed JSON link to another process with request/reply support.
+
+    A reader thread hands every incoming message that is not a reply to
+    handler(link, message, frame), where frame is the raw framed bytes
+    so it can be forwarded without encoding it again.
+    """
+
+    def __init__(self, sock, handler, on_close=None):
+        """Wrap a connected stream socket and start reading from it"""
+        self.sock = sock
+        self.handler = handler
+        self.on_close = on_close
+        self.decoder = FrameDecoder(BUS_MAX_FRAME_SIZE)
+        self.send_lock = threading.Lock()
+        self.pending = {}  # {request id: [Event, reply]}
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+
+    def start(self):
+        """Start the reader thread"""
+        self.reader.start()
+        return self
+
+    def send_frame(self, frame):
+        """Send an already framed message"""
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def notify(self, message):
+        """Send a message that expects no reply"""
+        self.send_frame(encode_frame(json.dumps(message).encode('utf-8')))
+
+    def request(self, message, timeout=RPC_TIMEOUT):
+        """Send a message and wait for the reply with the same id"""
+        request_id = next(self.request_ids)
+        waiter = [threading.Event(), None]
+        self.pending[request_id] = waiter
+        try:
+            self.notify(dict(message, id=request_id))
+            if not waiter[0].wait(timeout):
+                raise TimeoutError(f"No reply to {message.get('op')} within {timeout}s")
+            return waiter[1]
+        finally:
+            self.pending.pop(request_id, None)
+
+    def reply(self, request, **fields):
+        """Answer a request received from the other side"""
+        self.notify(dict(fields, op='reply', id=request['id']))
+
+    def read_loop(self):
+        """Dispatch incoming messages until the link closes"""
+        try:
+            while self.decoder.recv_into(self.sock):
+                for flags, payload in self.decoder.frames():
+                    message = decode_json(payload)
+                    if message.get('op') == 'reply':
+                        waiter = self.pending.get(message['id'])
+                        if waiter:
+                            waiter[1] = message
+                            waiter[0].set()
+                    else:
+                        self.handler(self, message, encode_frame(bytes(payload)))
+        except OSError:
+            pass
+        except Exception as e:
+            print(f"Error on peer link: {e}")
+        finally:
+            self.close()
+            if self.on_close:
+                self.on_close(self)
+
+    def close(self):
+        """Close the link"""
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+class ClusterHub:
+    """Routing hub run by the launcher process"""
+
+    def __init__(self, path):
+        """Listen for workers on the Unix socket at path"""
+        self.path = path
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+        self.workers = {}  # {worker id: PeerLink}
+        self.directory = {}  # {username: worker id}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Accept worker connections in a background thread"""
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        """Attach every connecting worker"""
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            PeerLink(sock, self.handle, self.worker_lost).start()
+
+    def handle(self, link, message, frame):
+        """Route one message from a worker"""
+        op = message['op']
+        if op == 'hello':
+            link.worker_id = message['worker']
+            with self.lock:
+                self.workers[link.worker_id] = link
+        elif op == 'claim':
+            with self.lock:
+                ok = message['username'] not in self.directory
+                if ok:
+                    self.directory[message['username']] = link.worker_id
+            link.reply(message, ok=ok)
+        elif op == 'release':
+            with self.lock:
+                if self.directory.get(message['username']) == link.worker_id:
+                    del self.directory[message['username']]
+        elif op == 'broadcast':
+            with self.lock:
+                others = [w for worker_id, w in self.workers.items() if worker_id != link.worker_id]
+            for worker in others:
+                self.forward(worker, frame)
+        elif op == 'private':
+            with self.lock:
+                owner = self.workers.get(self.directory.get(message['target']))
+            if owner is not None:
+                self.forward(owner, frame)
+            link.reply(message, ok=owner is not None)
+        elif op == 'users':
+            with self.lock:
+                users = sorted(self.directory)
+            link.reply(message, users=users)
+
+    def forward(self, worker, frame):
+        """Pass a frame on to a worker unchanged"""
+        try:
+            worker.send_frame(frame)
+        except OSError:
+            worker.close()
+
+    def worker_lost(self, link):
+        """Forget a worker and every user connected to it"""
+        worker_id = getattr(link, 'worker_id', None)
+        with self.lock:
+            if self.workers.get(worker_id) is link:
+                del self.workers[worker_id]
+            for username in [u for u, w in self.directory.items() if w == worker_id]:
+                del self.directory[username]
+
+    def close(self):
+        """Stop accepting workers"""
+        self.listener.close()
+
+
+class ClusterLink:
+    """A worker's connection to the hub, used by ChatServer"""
+
+    def __init__(self, server, path, worker_id):
+        """Connect to the hub at path on behalf of a ChatServer"""
+        self.server = server
+        self.worker_id = worker_id
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.link = PeerLink(sock, self.handle, self.hub_lost).start()
+        self.link.notify({"op": "hello", "worker": worker_id})
+
+    def hub_lost(self, link):
+        """Shut the worker down when the launcher goes away"""
+        print(f"Worker {self.worker_id} lost the cluster hub, shutting down")
+        _thread.interrupt_main()
+
+    def notify(self, message):
+        """Send a one-way message to the hub, ignoring a hub that is gone"""
+        try:
+            self.link.notify(message)
+        except OSError:
+            pass
+
+    def claim_username(self, username):
+        """Reserve a username cluster-wide, returning False if it is taken"""
+        return self.link.request({"op": "claim", "username": username})['ok']
+
+    def release_username(self, username):
+        """Give a username back to the directory"""
+        self.notify({"op": "release", "username": username})
+
+    def relay_broadcast(self, message, exclude_user=None, room=None):
+        """Send a broadcast or room message to the other workers"""
+        self.notify({"op": "broadcast", "message": message, "exclude": exclude_user, "room": room})
+
+    def route_private(self, sender, target_user, message):
+        """Deliver a private message on the target's worker, False if offline"""
+        return self.link.request({"op": "private", "sender": sender, "target": target_user,
+                                  "message": message})['ok']
+
+    def list_users(self):
+        """Return every username connected to the cluster"""
+        return self.link.request({"op": "users"})['users']
+
+    def handle(self, link, message, frame):
+        """Deliver messages relayed by the hub on the server's engine"""
+        if message['op'] == 'broadcast':
+            self.server.call_in_engine(self.server.deliver_relayed, message['message'],
+                                       message.get('exclude'), message.get('room'))
+        elif message['op'] == 'private':
+            self.server.call_in_engine(self.server.deliver_private, message['target'], message['message'])
+
+
+def run_cluster(make_server, workers):
+    """Run workers ChatServer processes sharing one port.
+
+    make_server(worker_id, bus_path) builds the ChatServer for a worker.
+    """
+    directory = tempfile.mkdtemp(prefix='chat-cluster-')
+    path = os.path.join(directory, 'bus.sock')
+    hub = ClusterHub(path)
+    hub.start()
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, args=(make_server, worker_id, path))
+                 for worker_id in range(workers)]
+    # Treat a terminate request like Ctrl+C so the workers are stopped too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Starting {workers} worker processes")
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("\nShutting down workers...")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            if process.pid is not None:
+                process.join()
+        hub.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_worker(make_server, worker_id, bus_path):
+    """Entry point of a worker process"""
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server = make_server(worker_id, bus_path)
+    try:
+        server.start_server()
+    except KeyboardInterrupt:
+        server.cleanup_server()
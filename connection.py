@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""
+Client connection objects used by the chat server engines.
+Each connection exposes send() and close() like a socket, so the
+ChatServer message handlers work the same on every engine.
+
+Outgoing frames go to a per-client outbound queue that is drained by a
+writer (a thread for the threaded engine, the event loop for asyncio),
+so a slow client never blocks the thread that is sending to it. Once a
+queue grows past the high watermark the client is either disconnected
+or has messages dropped until it drains below the low watermark.
+
+Writers coalesce: every frame queued by the time the writer runs (or
+within the configured coalescing delay) goes out in one vectored send,
+and WriteStats counts how many frames each send carried.
+
+Clients that negotiated the binary encoding are sent binary frames,
+preceded by a 'define' frame the first time a name id reaches them.
+Clients that negotiated compression get large frames deflated; the
+compressed bytes are cached on the Payload, so a broadcast is compressed
+once however many clients receive it. Clients with a resumable session
+(see sessions.py) get their messages numbered by the session first.
+
+A connection can be frozen and exported for a new server process to
+restore (see handoff.py): once frozen nothing more is written, and what
+was queued but not yet written travels with it.
+"""
+
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+from handoff import decode_bytes, encode_bytes
+from protocol import ENCODING_BINARY, ENCODING_JSON, FrameDecoder, FRAMING_LINE, Payload, sequence_frame
+
+SLOW_CONSUMER_POLICIES = ('disconnect', 'drop')
+DEFAULT_HIGH_WATERMARK = 1024 * 1024
+DEFAULT_LOW_WATERMARK = 256 * 1024
+MAX_BATCH_FRAMES = 512  # Frames per vectored send, well below IOV_MAX
+KEEPALIVE_PROBES = 3  # Unanswered keepalive probes before the kernel drops the connection
+
+
+class WriteStats:
+    """Server-wide count of frames and bytes written and the send calls that wrote them"""
+
+    def __init__(self):
+        """Start with no writes"""
+        self.frames = 0
+        self.calls = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def record(self, frames, calls, size):
+        """Account for one batch"""
+        with self.lock:
+            self.frames += frames
+            self.calls += calls
+            self.bytes += size
+
+    def summary(self):
+        """Human readable totals"""
+        ratio = self.frames / self.calls if self.calls else 0.0
+        return f"{self.frames} frames in {self.calls} send calls ({ratio:.1f} frames per call)"
+
+
+def send_frames(sock, frames):
+    """Write a batch of frames with vectored sends, returning the number of calls"""
+    if not hasattr(sock, 'sendmsg'):  # Windows
+        sock.sendall(b''.join(frames))
+        return 1
+    buffers = [memoryview(frame) for frame in frames]
+    first = calls = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first + MAX_BATCH_FRAMES])
+        calls += 1
+        # Skip the buffers that went out completely, then trim a partial one
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+    return calls
+
+
+def enable_keepalive(sock, idle, interval):
+    """Have the kernel probe an idle peer after idle seconds, every interval seconds after that"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):  # Elsewhere the system defaults apply
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(interval)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_PROBES)
+    except OSError:
+        pass  # Already closed
+
+
+class Connection:
+    """Outbound queue and slow-consumer handling shared by both engines"""
+
+    __slots__ = ()
+
+    def init_outbound(self, server):
+        """Copy the outbound limits from the server configuration"""
+        self.high_watermark = server.high_watermark
+        self.low_watermark = server.low_watermark
+        self.slow_consumer = server.slow_consumer
+        self.dropping = False  # Dropping messages until the queue drains
+        self.dropped = 0  # Messages dropped since the last notice
+        self.closed = False
+        self.frozen = False  # Handed off to another process, nothing more is written
+        self.coalesce_delay = server.coalesce_delay  # Seconds to wait for more frames before writing
+        self.write_stats = server.write_stats
+        self.encoding = ENCODING_JSON  # Replaced by the negotiated encoding at login
+        self.compression = None  # Replaced by the negotiated compression at login
+        self.compress_threshold = server.compress_threshold
+        self.buckets = {}  # Rate limit token buckets by message category
+        self.throttled = set()  # Categories the client was told it is sending too fast
+        self.heartbeat = False  # Whether the client said it answers pings
+        self.users_requests = 0  # list_users requests answered, numbering the replies
+        self.presence = True  # Whether the client wants join/leave notices
+        self.wheel = server.heartbeats.wheel  # Its clock stamps what the timeouts look at
+        self.connected_at = self.last_seen = self.last_message = self.wheel.now
+        self.ping_sent = None  # When the unanswered ping went out, if any
+        self.ping_interval = server.heartbeats.heartbeat_interval  # Silence before a ping, set by watch()
+        self.interns = server.interns
+        self.known_ids = set()  # Name ids already defined to the client
+        self.names = {}  # Name ids the client defined for us
+        self.session = None  # Resumable session numbering the client's messages, if it asked for one
+
+    def send(self, data):
+        """Queue framed bytes for the client, applying the slow-consumer policy"""
+        if self.closed:
+            raise ConnectionResetError("connection is closed")
+        if self.frozen:
+            return 0  # The new process takes over from here
+        queued = self.buffered_bytes()
+        if self.dropping:
+            if queued > self.low_watermark:
+                self.dropped += 1
+                return 0
+            self.dropping = False
+            self.write(Payload({"type": "system",
+                                "message": f"{self.dropped} messages were dropped because you fell behind",
+                                "dropped": self.dropped}).frame(self.framing))
+            self.dropped = 0
+        if queued + len(data) > self.high_watermark and queued:
+            if self.slow_consumer == 'disconnect':
+                self.evict()
+                raise ConnectionResetError("slow consumer evicted")
+            self.dropping = True
+            self.dropped += 1
+            return 0
+        self.write(data)
+        return len(data)
+
+    def send_payload(self, payload):
+        """Queue a shared Payload for the client, numbered if it has a session"""
+        if self.session is not None:
+            return self.session.send(payload)
+        return self.deliver(payload)
+
+    def deliver(self, payload, seq=None):
+        """Queue a shared Payload in this client's framing, encoding and compression"""
+        frame = None
+        unknown = ()
+        if self.encoding == ENCODING_BINARY:
+            frame, ids = payload.binary(self.interns)
+            if frame is not None:
+                unknown = [name_id for name_id in ids if name_id not in self.known_ids]
+        if frame is None:
+            frame = payload.frame(self.framing)
+        if self.compression and len(frame) > self.compress_threshold:
+            frame = payload.compressed(frame)
+        if seq is not None:
+            frame = sequence_frame(frame, seq)
+        if unknown:
+            frame = b''.join([self.interns.define_frame(name_id) for name_id in unknown] + [frame])
+        sent = self.send(frame)
+        if sent and unknown:
+            self.known_ids.update(unknown)
+        return sent
+
+    def send_message(self, message):
+        """Serialize, frame and queue a message dict"""
+        return self.send_payload(Payload(message))
+
+    def evict(self):
+        """Disconnect a client that fell too far behind"""
+        print(f"Evicting slow client {self.username} ({self.buffered_bytes()} bytes queued)")
+        self.abort()
+
+    def freeze(self):
+        """Stop writing, keeping what is queued for export"""
+        self.frozen = True
+
+    def export(self, rooms):
+        """State a new server process needs to carry on serving the client"""
+        return {"username": self.username, "address": list(self.address), "rooms": rooms,
+                "framing": self.framing, "decoder_framing": self.decoder.framing,
+                "encoding": self.encoding, "compression": self.compression, "presence": self.presence,
+                "users_requests": self.users_requests, "heartbeat": self.heartbeat, "known_ids": sorted(self.known_ids),
+                "session": [self.session.token, self.session.seq] if self.session else None,
+                "names": {str(name_id): name for name_id, name in self.names.items()},
+                "inbound": encode_bytes(self.decoder.pending()), "outbound": encode_bytes(self.unsent())}
+
+    def restore(self, state):
+        """Pick up an exported connection; queuing its unsent bytes is left to the caller"""
+        self.username = state['username']
+        self.address = tuple(state['address'])
+        self.framing = state['framing']
+        self.decoder.framing = state['decoder_framing']
+        self.encoding = state['encoding']
+        self.compression = state['compression']
+        self.presence = state['presence']
+        self.users_requests = state.get('users_requests', 0)
+        self.heartbeat = state.get('heartbeat', False)
+        self.known_ids = set(state['known_ids'])
+        self.names = {int(name_id): name for name_id, name in state['names'].items()}
+        self.decoder.feed(decode_bytes(state['inbound']))
+
+
+class ThreadedConnection(Connection):
+    """Client connection served by a reader thread and a writer thread"""
+
+    def __init__(self, server, sock, address):
+        """Wrap an accepted socket and start its writer thread"""
+        self.sock = sock
+        self.address = address
+        self.decoder = FrameDecoder(server.max_frame_size)
+        self.framing = FRAMING_LINE  # Replaced by the client's framing at login
+        self.username = None
+        self.init_outbound(server)
+        self.outbound = collections.deque()
+        self.queued_bytes = 0
+        self.ready = threading.Condition()
+        self.reader = None  # Thread running the server's handle_client, once started
+        self.handoff = server.handoff
+        # With handoff enabled, reads wait in poll() so the handoff can wake them
+        self.poller = self.handoff.poller(sock) if self.handoff else None
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    def receive_frames(self):
+        """Yield (flags, payload) frames until the client disconnects or the server is handed off"""
+        yield from self.decoder.frames()  # Restored with the connection, if any
+        while self.readable() and self.decoder.recv_into(self.sock):
+            self.last_seen = self.wheel.now
+            yield from self.decoder.frames()
+
+    def readable(self):
+        """Wait for data when handoff is enabled; False once the handoff has started"""
+        if self.poller is not None:
+            self.poller.poll()
+            return not self.handoff.started
+        return True
+
+    def buffered_bytes(self):
+        """Bytes queued but not yet written to the socket"""
+        return self.queued_bytes
+
+    def write(self, data):
+        """Append framed bytes to the outbound queue"""
+        with self.ready:
+            self.outbound.append(data)
+            self.queued_bytes += len(data)
+            self.ready.notify()
+
+    def writer_loop(self):
+        """Drain the outbound queue onto the socket, many frames per send"""
+        while True:
+            with self.ready:
+                while not self.outbound and not self.closed and not self.frozen:
+                    self.ready.wait()
+                if self.frozen and not self.closed:
+                    return  # The socket and the queue go to the new process
+                if not self.outbound:
+                    break
+            if self.coalesce_delay and not self.closed:
+                time.sleep(self.coalesce_delay)  # Let more frames gather
+            with self.ready:
+                if self.frozen and not self.closed:
+                    return
+                batch = list(self.outbound)
+                size = self.queued_bytes
+                self.outbound.clear()
+                self.queued_bytes = 0
+            try:
+                calls = send_frames(self.sock, batch)
+            except OSError:
+                self.abort()
+                return
+            self.write_stats.record(len(batch), calls, size)
+        self.sock.close()
+
+    def close(self):
+        """Close the connection once queued frames have been written"""
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+    def freeze(self):
+        """Stop the writer once it finishes the batch it is sending"""
+        with self.ready:
+            self.frozen = True
+            self.ready.notify()
+
+    def settled(self):
+        """Whether the reader and writer have let go of the socket"""
+        return not self.writer.is_alive() and (self.reader is None or not self.reader.is_alive())
+
+    def unsent(self):
+        """Queued bytes the writer never took"""
+        with self.ready:
+            return b''.join(self.outbound)
+
+    def fileno(self):
+        """The socket's file descriptor"""
+        return self.sock.fileno()
+
+    def keep_alive(self, idle, interval):
+        """Turn on TCP keepalive probes for the socket"""
+        enable_keepalive(self.sock, idle, interval)
+
+    def abort(self):
+        """Close the connection immediately, discarding queued frames"""
+        try:
+            # Wake the reader thread blocked in recv; done first, as the
+            # writer thread closes the socket as soon as it is told to stop
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self.ready:
+            self.closed = True
+            self.outbound.clear()
+            self.queued_bytes = 0
+            self.ready.notify()
+        self.sock.close()
+
+
+class AsyncioConnection(Connection, asyncio.BufferedProtocol):
+    """Client connection driven by the asyncio engine.
+
+    Frames written during one loop iteration (or within the coalescing
+    delay) are collected and handed to the transport in one writelines
+    call; the transport's write buffer then holds what the socket did
+    not take.
+    """
+
+    __slots__ = ('server', 'transport', 'address', 'decoder', 'framing', 'username',
+                 'high_watermark', 'low_watermark', 'slow_consumer', 'dropping', 'dropped', 'closed',
+                 'encoding', 'interns', 'known_ids', 'names', 'compression', 'compress_threshold',
+                 'buckets', 'throttled', 'users_requests', 'heartbeat', 'presence', 'frozen', 'adopted',
+                 'session', 'wheel', 'connected_at', 'last_seen', 'last_message', 'ping_sent', 'ping_interval',
+                 'coalesce_delay', 'write_stats', 'pending', 'pending_bytes', 'held')
+
+    def __init__(self, server, adopted=False):
+        """Initialize the connection for the given ChatServer; adopted ones were taken over"""
+        self.server = server
+        self.adopted = adopted
+        self.transport = None
+        self.address = None
+        self.decoder = FrameDecoder(server.max_frame_size)
+        self.framing = FRAMING_LINE  # Replaced by the client's framing at login
+        self.username = None
+        self.pending = []  # Frames waiting for the next flush
+        self.pending_bytes = 0
+        self.held = False  # Frames wait in the decoder while a call made for the client completes
+        self.init_outbound(server)
+
+    def connection_made(self, transport):
+        """Send the username prompt as soon as the client connects"""
+        self.transport = transport
+        self.server.connections.add(self)
+        if self.adopted:
+            return  # Logged in (or prompted) by the old process
+        self.address = transport.get_extra_info('peername')
+        print(f"New connection from {self.address}")
+        self.server.heartbeats.watch(self)
+        self.server.send_username_prompt(self)
+
+    def get_buffer(self, sizehint):
+        """Let the transport read straight into the frame decoder's buffer"""
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        """Take in received bytes and process the frames they complete"""
+        self.decoder.advance(nbytes)
+        self.last_seen = self.wheel.now
+        self.process_frames()
+
+    def process_frames(self):
+        """Run the username handshake, then process client messages, until a call holds the client up"""
+        try:
+            for flags, payload in self.decoder.frames():
+                if self.username is None:
+                    self.username = self.server.register_client(self, self.address, payload)
+                else:
+                    self.server.handle_frame(self, flags, payload)
+                if self.held:
+                    return  # release() carries on from the next frame
+        except Exception as e:
+            print(f"Error handling client {self.username}: {e}")
+            self.transport.close()
+
+    def hold(self):
+        """Stop reading and processing the client's frames while a call made for it completes"""
+        self.held = True
+        self.transport.pause_reading()
+
+    def release(self):
+        """Carry on with the frames that arrived meanwhile"""
+        self.held = False
+        if not self.closed:
+            self.transport.resume_reading()
+            self.process_frames()
+
+    def connection_lost(self, exc):
+        """Remove the client once the transport is closed"""
+        self.closed = True
+        self.server.disconnect_client(self.username, self)
+
+    def buffered_bytes(self):
+        """Bytes waiting to be flushed or in the transport's write buffer"""
+        return self.pending_bytes + self.transport.get_write_buffer_size()
+
+    def write(self, data):
+        """Collect framed bytes for the next flush"""
+        if self.transport.is_closing():
+            raise ConnectionResetError("connection is closed")
+        if not self.pending:
+            if self.coalesce_delay:
+                self.server.loop.call_later(self.coalesce_delay, self.flush)
+            else:
+                self.server.loop.call_soon(self.flush)
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+
+    def flush(self):
+        """Hand every collected frame to the transport in one call"""
+        if self.frozen:
+            return  # Kept for export
+        if self.pending and not self.transport.is_closing():
+            self.transport.writelines(self.pending)
+            self.write_stats.record(len(self.pending), 1, self.pending_bytes)
+        self.pending = []
+        self.pending_bytes = 0
+
+    def close(self):
+        """Close the transport once buffered frames have been written"""
+        self.closed = True
+        self.flush()
+        self.transport.close()
+
+    def settled(self):
+        """Whether the transport wrote out everything it was given"""
+        return not self.transport.get_write_buffer_size()
+
+    def unsent(self):
+        """Collected frames that were never handed to the transport"""
+        return b''.join(self.pending)
+
+    def fileno(self):
+        """The socket's file descriptor"""
+        return self.transport.get_extra_info('socket').fileno()
+
+    def keep_alive(self, idle, interval):
+        """Turn on TCP keepalive probes for the socket"""
+        enable_keepalive(self.transport.get_extra_info('socket'), idle, interval)
+
+    def abort(self):
+        """Close the transport immediately, discarding buffered frames"""
+        self.closed = True
+        self.pending = []
+        self.pending_bytes = 0
+        self.transport.abort()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Multi-node federation of chat servers.
+
+Every node keeps a server-to-server link to every other node (a new node
+only needs one seed peer, the rest are learned from the hello exchange).
+A consistent-hash ring over the live nodes assigns each username's
+presence record to one owner node:
+- logins claim the name on its owner, so names are unique across nodes
+- private messages are sent straight to the target's node, which is
+  looked up on the name's owner the first time and then remembered, so
+  later messages to the same user take a single round trip
+- broadcasts are flooded to every peer and deduplicated by message id
+
+When nodes join or leave only the names whose owner changed move:
+their home nodes re-register them with the new owner.
+"""
+
+import bisect
+import collections
+import hashlib
+import itertools
+import socket
+import threading
+import time
+
+from cluster import PeerLink
+
+DEFAULT_VIRTUAL_NODES = 64
+SEEN_MESSAGE_LIMIT = 10000
+ROUTE_CACHE_LIMIT = 10000  # Users whose node is remembered for private messages
+RECONNECT_INTERVAL = 1.0
+
+
+def ring_hash(key):
+    """Position of a key on the hash ring"""
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes"""
+
+    def __init__(self, nodes=(), virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        """Build a ring over the given node ids"""
+        self.virtual_nodes = virtual_nodes
+        self.positions = []  # Sorted ring positions
+        self.owners = []  # Node id at the same index as each position
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        """Place a node's virtual points on the ring"""
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.virtual_nodes):
+            position = ring_hash(f"{node}#{replica}")
+            index = bisect.bisect(self.positions, position)
+            self.positions.insert(index, position)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        """Take a node's virtual points off the ring"""
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        kept = [(p, o) for p, o in zip(self.positions, self.owners) if o != node]
+        self.positions = [p for p, o in kept]
+        self.owners = [o for p, o in kept]
+
+    def lookup(self, key):
+        """Return the node that owns key"""
+        index = bisect.bisect(self.positions, ring_hash(key)) % len(self.positions)
+        return self.owners[index]
+
+
+class FederationNode:
+    """A ChatServer's membership in a federation of nodes"""
+
+    def __init__(self, server, host, port, peers=()):
+        """Listen for peer nodes on host:port and connect to the seed peers"""
+        self.server = server
+        self.node_id = f"{host}:{port}"
+        self.address = (host, port)
+        self.known_peers = {tuple(peer) for peer in peers}  # Addresses to keep connected
+        self.links = {}  # {node id: PeerLink}
+        self.ring = HashRing([self.node_id])
+        self.presence = {}  # {username: node id} for names this node owns
+        self.seen = collections.OrderedDict()  # Recently relayed broadcast ids
+        self.routes = collections.OrderedDict()  # {username: node id} of recent private message targets
+        self.message_ids = itertools.count(1)
+        self.lock = threading.RLock()
+        self.listener = socket.create_server(self.address, reuse_port=False)
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        threading.Thread(target=self.connect_loop, daemon=True).start()
+
+    # Link management
+
+    def accept_loop(self):
+        """Attach peer nodes that connect to us"""
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            self.attach(sock, outgoing=False)
+
+    def connect_loop(self):
+        """Keep trying to reach every known peer that is not linked"""
+        while True:
+            with self.lock:
+                linked = {getattr(link, 'address', None) for link in self.links.values()}
+                missing = [a for a in self.known_peers if a not in linked and a != self.address]
+            for address in missing:
+                try:
+                    sock = socket.create_connection(address, timeout=RECONNECT_INTERVAL)
+                    sock.settimeout(None)
+                except OSError:
+                    continue
+                self.attach(sock, outgoing=True)
+            time.sleep(RECONNECT_INTERVAL)
+
+    def attach(self, sock, outgoing):
+        """Start a link and introduce ourselves"""
+        link = PeerLink(sock, self.handle, self.link_lost)
+        link.outgoing = outgoing
+        link.node_id = None
+        link.start()
+        try:
+            link.notify(self.hello())
+        except OSError:
+            link.close()
+
+    def hello(self):
+        """Introduction carrying our id and the peers we know about"""
+        with self.lock:
+            peers = [list(link.address) for link in self.links.values()]
+        return {"op": "hello", "node": self.node_id, "address": list(self.address), "peers": peers}
+
+    def register_link(self, link, message):
+        """Adopt a link once the peer has introduced itself"""
+        node = message['node']
+        link.node_id = node
+        link.address = tuple(message['address'])
+        with self.lock:
+            self.known_peers.add(link.address)
+            self.known_peers.update(tuple(peer) for peer in message['peers'])
+            existing = self.links.get(node)
+            if existing is not None and not existing.closed:
+                # Both sides dialled each other: keep the link opened by the smaller id
+                initiator = self.node_id if link.outgoing else node
+                if initiator != min(self.node_id, node):
+                    link.close()
+                    return
+                existing.close()
+            self.links[node] = link
+            joined = node not in self.ring.nodes
+        if joined:
+            print(f"Federation: node {node} joined")
+            self.ring_changed(lambda ring: ring.add(node))
+
+    def link_lost(self, link):
+        """Drop a peer from the ring and forget every user connected to it"""
+        with self.lock:
+            if link.node_id is None or self.links.get(link.node_id) is not link:
+                return
+            del self.links[link.node_id]
+            for username in [u for u, node in self.presence.items() if node == link.node_id]:
+                del self.presence[username]
+            for username in [u for u, node in self.routes.items() if node == link.node_id]:
+                del self.routes[username]
+        print(f"Federation: node {link.node_id} left")
+        self.ring_changed(lambda ring: ring.remove(link.node_id))
+
+    def ring_changed(self, change):
+        """Apply a membership change and move the presence records it affects"""
+        local_users = list(self.server.clients.keys())
+        with self.lock:
+            old_owners = {username: self.ring.lookup(username) for username in local_users}
+            change(self.ring)
+            # Records for names we no longer own are re-sent by their home nodes
+            for username in [u for u in self.presence if self.ring.lookup(u) != self.node_id]:
+                del self.presence[username]
+        moved = 0
+        for username in local_users:
+            owner = self.ring.lookup(username)
+            if owner != old_owners[username]:
+                moved += 1
+                self.register_presence(username, owner)
+        print(f"Federation: {len(self.ring.nodes)} nodes, {moved} of {len(local_users)} local users remapped")
+
+    def link_to(self, node):
+        """Return the live link to a node"""
+        with self.lock:
+            link = self.links.get(node)
+        if link is None:
+            raise ConnectionError(f"No link to node {node}")
+        return link
+
+    # Cluster interface used by ChatServer
+
+    def claim_username(self, username):
+        """Reserve a username federation-wide, returning False if it is taken"""
+        owner = self.ring.lookup(username)
+        if owner == self.node_id:
+            return self.claim_local(username, self.node_id)
+        return self.link_to(owner).request({"op": "claim", "username": username, "node": self.node_id})['ok']
+
+    def claim_local(self, username, node):
+        """Record a claim on the owner node"""
+        with self.lock:
+            if username in self.presence:
+                return False
+            self.presence[username] = node
+            return True
+
+    def register_presence(self, username, owner):
+        """Re-send an already claimed name's record to its new owner"""
+        if owner == self.node_id:
+            with self.lock:
+                self.presence[username] = self.node_id
+        else:
+            self.send_to(owner, {"op": "presence", "username": username, "node": self.node_id})
+
+    def release_username(self, username):
+        """Drop a username's presence record on its owner"""
+        owner = self.ring.lookup(username)
+        if owner == self.node_id:
+            self.release_local(username, self.node_id)
+        else:
+            self.send_to(owner, {"op": "release", "username": username, "node": self.node_id})
+
+    def release_local(self, username, node):
+        """Remove a presence record if it still points at node"""
+        with self.lock:
+            if self.presence.get(username) == node:
+                del self.presence[username]
+
+    def locate(self, username):
+        """Return the node a user is connected to, or None"""
+        owner = self.ring.lookup(username)
+        if owner == self.node_id:
+            return self.presence.get(username)
+        return self.link_to(owner).request({"op": "locate", "username": username})['node']
+
+    def route_private(self, sender, target_user, message):
+        """Send a private message straight to the target's node, asking the owner where that is if need be"""
+        with self.lock:
+            node = self.routes.get(target_user)
+        if node is not None:
+            if self.send_private(node, target_user, message):
+                return True
+            with self.lock:
+                self.routes.pop(target_user, None)  # They moved or left
+        node = self.locate(target_user)
+        if node is None or node == self.node_id or not self.send_private(node, target_user, message):
+            return False
+        with self.lock:
+            self.routes[target_user] = node
+            if len(self.routes) > ROUTE_CACHE_LIMIT:
+                self.routes.popitem(last=False)
+        return True
+
+    def send_private(self, node, target_user, message):
+        """Deliver a private message on a node, False if the user is not there"""
+        try:
+            return self.link_to(node).request({"op": "private", "target": target_user, "message": message})['ok']
+        except ConnectionError:
+            return False  # The node just left
+
+    def relay_broadcast(self, message, exclude_user=None, room=None):
+        """Flood a broadcast to every peer"""
+        message_id = f"{self.node_id}/{next(self.message_ids)}"
+        self.mark_seen(message_id)
+        self.flood({"op": "broadcast", "id": message_id, "message": message,
+                    "exclude": exclude_user, "room": room})
+
+    def list_users(self):
+        """Collect the presence records held by every node"""
+        with self.lock:
+            users = set(self.presence)
+            links = list(self.links.values())
+        for link in links:
+            try:
+                users.update(link.request({"op": "users"})['users'])
+            except (OSError, TimeoutError):
+                pass
+        return sorted(users)
+
+    # Messages from peers
+
+    def handle(self, link, message, frame):
+        """Handle one message from a peer node"""
+        op = message['op']
+        if op == 'hello':
+            self.register_link(link, message)
+        elif op == 'claim':
+            link.reply(message, ok=self.claim_local(message['username'], message['node']))
+        elif op == 'presence':
+            with self.lock:
+                self.presence[message['username']] = message['node']
+        elif op == 'release':
+            self.release_local(message['username'], message['node'])
+        elif op == 'locate':
+            link.reply(message, node=self.presence.get(message['username']))
+        elif op == 'private':
+            ok = message['target'] in self.server.clients
+            if ok:
+                self.server.call_in_engine(self.server.deliver_private, message['target'], message['message'])
+            link.reply(message, ok=ok)
+        elif op == 'broadcast':
+            if self.mark_seen(message['id']):
+                self.server.call_in_engine(self.server.deliver_relayed, message['message'],
+                                           message.get('exclude'), message.get('room'))
+                self.flood(frame, skip=link)
+        elif op == 'users':
+            with self.lock:
+                users = list(self.presence)
+            link.reply(message, users=users)
+
+    def mark_seen(self, message_id):
+        """Remember a broadcast id, returning False if it was already seen"""
+        with self.lock:
+            if message_id in self.seen:
+                return False
+            self.seen[message_id] = True
+            if len(self.seen) > SEEN_MESSAGE_LIMIT:
+                self.seen.popitem(last=False)
+            return True
+
+    def flood(self, message, skip=None):
+        """Send a message (dict or framed bytes) to every peer but skip"""
+        with self.lock:
+            links = [link for link in self.links.values() if link is not skip]
+        for link in links:
+            try:
+                if isinstance(message, dict):
+                    link.notify(message)
+                else:
+                    link.send_frame(message)
+            except OSError:
+                link.close()
+
+    def send_to(self, node, message):
+        """Send a one-way message to a node, ignoring one that just left"""
+        try:
+            self.link_to(node).notify(message)
+        except (OSError, ConnectionError):
+            pass
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Zero-downtime restarts: hand a running server's sockets to a new process.
+
+A server started with --handoff-path listens on that Unix socket for its
+successor. The successor (the same command line plus --takeover)
+connects and asks for everything; the old server then
+
+1. stops accepting (new connections wait in the listen backlog),
+2. stops reading from its clients, so nothing new gets routed,
+3. stops writing: frames already queued for a client but not yet written
+   are kept and sent along, except the one batch a writer may be in the
+   middle of, which is finished first,
+4. flushes and closes its history, search index and metrics,
+5. sends the listening socket and then every client socket, 250 per
+   message, over the Unix socket with SCM_RIGHTS, each with its state:
+   username, framing, encoding, compression, rooms, binary name ids,
+   session token and sequence number (not the replay buffer), and the
+   bytes it received but could not yet decode as a frame,
+6. exits as soon as the successor confirms, without closing anything.
+
+Clients see a pause while this happens but no disconnect, no prompt and
+no join or leave notices. A client that does not take the frame being
+written to it within DRAIN_TIMEOUT is disconnected rather than handed
+off, since the rest of that frame could not be sent by anyone else.
+
+There is no way back: once the old server has stopped reading it exits
+whether or not the successor took over, so start the successor only
+when it can start (same options, same Python).
+"""
+
+import base64
+import json
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+from protocol import FrameDecoder, decode_json, encode_frame
+
+HANDOFF_MAX_FRAME_SIZE = 16 * 1024 * 1024 - 1
+FDS_PER_MESSAGE = 250  # Linux accepts at most 253 descriptors per message
+BATCH_BYTES = 8 * 1024 * 1024  # Client state per message, well below the frame limit
+DRAIN_TIMEOUT = 2.0  # Seconds a client may take to accept the frame being written to it
+CONFIRM_TIMEOUT = 30.0  # Seconds the successor may take to confirm
+
+
+def send_message(sock, message, fds=()):
+    """Send a JSON message, passing the file descriptors along with it"""
+    frame = encode_frame(json.dumps(message).encode('utf-8'))
+    sent = socket.send_fds(sock, [frame], list(fds)) if fds else 0
+    sock.sendall(frame[sent:])
+
+
+def receive_messages(sock):
+    """Yield (message, fds) until the other side closes the socket"""
+    decoder = FrameDecoder(HANDOFF_MAX_FRAME_SIZE)
+    received = []  # Descriptors that arrived before the message claiming them was complete
+    while True:
+        data, fds, flags, _ = socket.recv_fds(sock, 256 * 1024, FDS_PER_MESSAGE + 3)
+        if flags & socket.MSG_CTRUNC:
+            raise OSError("File descriptors were lost in transit")
+        if not data:
+            return
+        received += fds
+        decoder.feed(data)
+        for _, payload in decoder.frames():
+            message = decode_json(payload)
+            count = message.get('fds', 0)
+            fds, received = received[:count], received[count:]
+            yield message, fds
+
+
+def adopt_socket(fd):
+    """Socket object for a received descriptor, in blocking mode whatever the old engine used"""
+    sock = socket.socket(fileno=fd)
+    sock.setblocking(True)
+    return sock
+
+
+def encode_bytes(data):
+    """Buffered bytes as JSON-safe text"""
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode_bytes(text):
+    """Inverse of encode_bytes"""
+    return base64.b64decode(text)
+
+
+class Takeover:
+    """Sockets and client state received from the old server, for ChatServer to adopt"""
+
+    def __init__(self):
+        """Nothing received yet"""
+        self.listen_socket = None
+        self.clients = []  # [(socket, state dict)]
+        self.interns = []  # Binary name ids 1, 2, ... in order
+        self.started = time.monotonic()
+        self.received = None  # Monotonic time the last socket arrived
+
+    def summary(self):
+        """One line for the log, once the connections are being served"""
+        return (f"Took over {len(self.clients)} connections: received in "
+                f"{(self.received - self.started) * 1000:.0f} ms, serving after "
+                f"{(time.monotonic() - self.started) * 1000:.0f} ms")
+
+
+def take_over(path):
+    """Ask the server listening at path for its sockets and return a Takeover.
+
+    The old server exits once the Takeover is complete; the caller then
+    builds its ChatServer with it.
+    """
+    takeover = Takeover()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        send_message(sock, {"op": "takeover", "pid": os.getpid()})
+        for message, fds in receive_messages(sock):
+            op = message.get('op')
+            if op == 'listener':
+                takeover.listen_socket = adopt_socket(fds[0])
+            elif op == 'clients':
+                for fd, state in zip(fds, message['clients']):
+                    takeover.clients.append((adopt_socket(fd), state))
+            elif op == 'done':
+                takeover.interns = message['interns']
+                takeover.received = time.monotonic()
+                send_message(sock, {"op": "ok"})
+                break
+        else:
+            raise OSError("Old server closed the handoff socket before it was done")
+    finally:
+        sock.close()
+    if takeover.listen_socket is None:
+        raise OSError("Old server did not send its listening socket")
+    return takeover
+
+
+class HandoffListener:
+    """Waits on a Unix socket for a successor and hands the server over to it"""
+
+    def __init__(self, server, path):
+        """Bind the Unix socket at path, replacing a stale one"""
+        self.server = server
+        self.path = path
+        # Wakes the threaded engine's accept loop and readers when the handoff starts
+        self.wakeup, self.wake = os.pipe()
+        self.started = False
+        self.accept_stopped = threading.Event()  # Set by the threaded engine's accept loop
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+
+    def poller(self, sock):
+        """poll() object that wakes up for data on sock or for the start of the handoff"""
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        poller.register(self.wakeup, select.POLLIN)
+        return poller
+
+    def start(self):
+        """Wait for the successor in a background thread"""
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        """Serve takeover requests; only returns by exiting the process"""
+        while True:
+            sock, _ = self.listener.accept()
+            try:
+                message, _ = next(receive_messages(sock), (None, None))
+                if message and message.get('op') == 'takeover':
+                    print(f"Process {message.get('pid')} is taking over")
+                    self.hand_off(sock)
+            except Exception as e:
+                print(f"Error handing off: {e}")
+                if self.started:
+                    # The clients stopped being served; there is no going back
+                    os._exit(1)
+            sock.close()
+
+    def hand_off(self, sock):
+        """Freeze the server, send its sockets and state, and exit"""
+        server = self.server
+        start = time.monotonic()
+        self.started = True
+        listen_fd = os.dup(server.server_socket.fileno())  # Survives the engine letting go of it
+        os.write(self.wake, b'!')  # The pipe stays readable, waking every poller for good
+        connections, dropped = server.freeze()
+        frozen = time.monotonic()
+        server.close_storage()
+
+        send_message(sock, {"op": "listener", "fds": 1}, [listen_fd])
+        batch, fds, size = [], [], 0
+        for connection in connections:
+            try:
+                fd = connection.fileno()
+                state = connection.export(server.rooms.rooms_of(connection.username))
+            except OSError:
+                dropped += 1  # Closed while freezing
+                continue
+            state_size = len(state['inbound']) + len(state['outbound'])
+            if batch and (len(batch) == FDS_PER_MESSAGE or size + state_size > BATCH_BYTES):
+                send_message(sock, {"op": "clients", "fds": len(fds), "clients": batch}, fds)
+                batch, fds, size = [], [], 0
+            batch.append(state)
+            fds.append(fd)
+            size += state_size
+        if batch:
+            send_message(sock, {"op": "clients", "fds": len(fds), "clients": batch}, fds)
+        send_message(sock, {"op": "done", "interns": server.interns.names[1:]})
+
+        sock.settimeout(CONFIRM_TIMEOUT)
+        reply, _ = next(receive_messages(sock), (None, None))
+        if not reply or reply.get('op') != 'ok':
+            raise OSError("Successor did not confirm the takeover")
+        done = time.monotonic()
+        print(f"Handed off {len(connections)} connections in {(done - start) * 1000:.0f} ms "
+              f"(frozen in {(frozen - start) * 1000:.0f} ms, {dropped} dropped)")
+        print(f"Writes: {server.write_stats.summary()}")
+        print("Server handed off, exiting")
+        sys.stdout.flush()
+        os._exit(0)  # Closing the sockets here would not hurt, but cleanup would say goodbye
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Persistent, append-only chat history.
+
+Messages are appended to numbered segment files. Each record is a small
+header (timestamp and private-message audience) followed by the message
+exactly as it goes out on the wire, a length-prefixed frame, so replay
+hands memory-mapped slices straight to a connection without decoding.
+
+Every segment has a sparse index file holding the offset and timestamp
+of every index_interval-th record, which is enough to find a record by
+sequence number or time with a short forward scan.
+
+Appends are buffered and written in batches. The fsync policy decides
+how often the batches are forced to disk: 'always' on every append,
+'interval' every fsync_interval_ms from a background thread, or 'never'
+(left to the operating system).
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+from protocol import HEADER, HEADER_SIZE, MAX_PAYLOAD_SIZE
+
+RECORD_HEADER = struct.Struct('>QII')  # timestamp ms, audience hashes (0, 0 when public)
+INDEX_ENTRY = struct.Struct('>QQ')  # record offset, timestamp ms
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_INDEX_INTERVAL = 64
+DEFAULT_FSYNC_INTERVAL_MS = 100
+DEFAULT_BATCH_BYTES = 64 * 1024
+
+
+def audience_hash(username):
+    """Hash a username for the record header; never 0, which marks public records"""
+    return zlib.crc32(username.encode('utf-8')) or 1
+
+
+def now_ms():
+    """Current time as integer epoch milliseconds"""
+    return int(time.time() * 1000)
+
+
+class Segment:
+    """One log file and its sparse index"""
+
+    def __init__(self, directory, base_seq):
+        """Describe the segment whose first record has sequence base_seq"""
+        self.base_seq = base_seq
+        self.log_path = os.path.join(directory, f"{base_seq:020d}.log")
+        self.index_path = os.path.join(directory, f"{base_seq:020d}.idx")
+        self.count = 0  # Records in the segment, including unflushed ones
+        self.size = 0  # Bytes in the segment, including unflushed ones
+        self.flushed = 0  # Bytes written to the file
+        self.offsets = array('Q')  # Offset of every index_interval-th record
+        self.timestamps = array('Q')  # Timestamp of the same records
+        self.pending = bytearray()  # Log bytes not yet written
+        self.pending_index = bytearray()  # Index entries not yet written
+        self.log_fd = None
+        self.index_fd = None
+        self.map = None
+        self.mapped_size = 0
+
+    def open_for_append(self):
+        """Open the log and index files for appending"""
+        self.log_fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def write_pending(self):
+        """Write buffered records and index entries to the files"""
+        if self.pending:
+            os.write(self.log_fd, self.pending)
+            self.flushed += len(self.pending)
+            self.pending.clear()
+        if self.pending_index:
+            os.write(self.index_fd, self.pending_index)
+            self.pending_index.clear()
+
+    def sync(self):
+        """Force written data to disk"""
+        os.fsync(self.log_fd)
+        os.fsync(self.index_fd)
+
+    def close_for_append(self):
+        """Close the append file descriptors"""
+        for fd in (self.log_fd, self.index_fd):
+            if fd is not None:
+                os.close(fd)
+        self.log_fd = self.index_fd = None
+
+    def mapped(self):
+        """Return a read-only memory map covering every flushed byte"""
+        if self.mapped_size != self.flushed:
+            # Views of an older, shorter map keep it alive until released
+            with open(self.log_path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), self.flushed, access=mmap.ACCESS_READ) if self.flushed else None
+            self.mapped_size = self.flushed
+        return self.map
+
+
+def record_span(data, offset):
+    """Return the end offset of the record starting at offset"""
+    header, = HEADER.unpack_from(data, offset + RECORD_HEADER.size)
+    return offset + RECORD_HEADER.size + HEADER_SIZE + (header & MAX_PAYLOAD_SIZE)
+
+
+class MessageLog:
+    """Segmented append-only log of framed chat messages"""
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 index_interval=DEFAULT_INDEX_INTERVAL, fsync='interval',
+                 fsync_interval_ms=DEFAULT_FSYNC_INTERVAL_MS, batch_bytes=DEFAULT_BATCH_BYTES):
+        """Open (or create) the log stored in directory"""
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}', expected one of: {', '.join(FSYNC_POLICIES)}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.batch_bytes = batch_bytes
+        self.lock = threading.Lock()
+        self.segments = []
+        self.dirty = False  # Written but not yet synced
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+        self.load_segments()
+        if self.fsync == 'interval':
+            threading.Thread(target=self.sync_loop, daemon=True).start()
+
+    @property
+    def next_seq(self):
+        """Sequence number the next appended record will get"""
+        active = self.segments[-1]
+        return active.base_seq + active.count
+
+    def load_segments(self):
+        """Rebuild segment metadata from disk and repair a torn final record"""
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                       if name.endswith('.log') and name[:-4].isdigit())
+        for base_seq in bases:
+            segment = Segment(self.directory, base_seq)
+            if os.path.exists(segment.index_path):
+                with open(segment.index_path, 'rb') as f:
+                    data = f.read()
+                for offset, timestamp in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                    segment.offsets.append(offset)
+                    segment.timestamps.append(timestamp)
+            segment.size = segment.flushed = os.path.getsize(segment.log_path)
+            self.segments.append(segment)
+        for segment, following in zip(self.segments, self.segments[1:]):
+            segment.count = following.base_seq - segment.base_seq
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+        else:
+            self.recover(self.segments[-1])
+        self.segments[-1].open_for_append()
+
+    def recover(self, segment):
+        """Count the records of the last segment, dropping any torn tail"""
+        with open(segment.log_path, 'rb') as f:
+            data = f.read()
+        # Index entries written for records that never reached the log
+        while segment.offsets and segment.offsets[-1] >= len(data):
+            segment.offsets.pop()
+            segment.timestamps.pop()
+        position = (len(segment.offsets) - 1) * self.index_interval if segment.offsets else 0
+        offset = segment.offsets[-1] if segment.offsets else 0
+        while offset + RECORD_HEADER.size + HEADER_SIZE <= len(data):
+            end = record_span(data, offset)
+            if end > len(data):
+                break
+            if position % self.index_interval == 0 and position // self.index_interval == len(segment.offsets):
+                segment.offsets.append(offset)
+                segment.timestamps.append(RECORD_HEADER.unpack_from(data, offset)[0])
+            position += 1
+            offset = end
+        segment.count = position
+        if offset != len(data):
+            os.truncate(segment.log_path, offset)
+        segment.size = segment.flushed = offset
+        with open(segment.index_path, 'wb') as f:
+            f.write(b''.join(INDEX_ENTRY.pack(o, t) for o, t in zip(segment.offsets, segment.timestamps)))
+
+    def append(self, frame, timestamp=None, audience=()):
+        """Append one length-prefixed frame and return its sequence number.
+
+        audience lists the usernames allowed to replay a private message;
+        leave it empty for messages everyone may see.
+        """
+        timestamp = now_ms() if timestamp is None else timestamp
+        hashes = [audience_hash(name) for name in audience[:2]] + [0, 0]
+        with self.lock:
+            segment = self.segments[-1]
+            if segment.size >= self.segment_bytes:
+                segment = self.rotate()
+            if segment.count % self.index_interval == 0:
+                segment.offsets.append(segment.size)
+                segment.timestamps.append(timestamp)
+                segment.pending_index += INDEX_ENTRY.pack(segment.size, timestamp)
+            segment.pending += RECORD_HEADER.pack(timestamp, hashes[0], hashes[1])
+            segment.pending += frame
+            segment.size += RECORD_HEADER.size + len(frame)
+            seq = segment.base_seq + segment.count
+            segment.count += 1
+            if self.fsync == 'always':
+                segment.write_pending()
+                segment.sync()
+            elif len(segment.pending) >= self.batch_bytes:
+                segment.write_pending()
+                self.dirty = True
+            return seq
+
+    def rotate(self):
+        """Seal the active segment and start a new one"""
+        active = self.segments[-1]
+        active.write_pending()
+        if self.fsync != 'never':
+            active.sync()
+        active.close_for_append()
+        segment = Segment(self.directory, active.base_seq + active.count)
+        segment.open_for_append()
+        self.segments.append(segment)
+        return segment
+
+    def flush(self, sync=False):
+        """Write buffered records to the file, optionally forcing them to disk.
+
+        Returns the sequence number after the last written record.
+        """
+        with self.lock:
+            segment = self.segments[-1]
+            if segment.pending:
+                segment.write_pending()
+                self.dirty = True
+            if sync and self.dirty:
+                segment.sync()
+                self.dirty = False
+            return self.next_seq
+
+    def sync_loop(self):
+        """Background flusher for the 'interval' fsync policy"""
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            if not self.closed:
+                self.flush(sync=True)
+
+    def close(self):
+        """Flush everything to disk and close the active segment"""
+        if self.closed:
+            return
+        self.flush(sync=self.fsync != 'never')
+        with self.lock:
+            self.closed = True
+            self.segments[-1].close_for_append()
+
+    def locate(self, seq):
+        """Return (segment, offset) of the record with the given sequence number"""
+        index = bisect.bisect_right([s.base_seq for s in self.segments], seq) - 1
+        segment = self.segments[index]
+        position = seq - segment.base_seq
+        slot = position // self.index_interval
+        offset = segment.offsets[slot]
+        data = segment.mapped()
+        for _ in range(position - slot * self.index_interval):
+            offset = record_span(data, offset)
+        return segment, offset
+
+    def read(self, seq):
+        """Return (timestamp, audience hashes, frame view) of one flushed record"""
+        with self.lock:
+            segment, offset = self.locate(seq)
+            data = segment.mapped()
+        timestamp, first, second = RECORD_HEADER.unpack_from(data, offset)
+        return timestamp, (first, second), memoryview(data)[offset + RECORD_HEADER.size:record_span(data, offset)]
+
+    def records(self, start_seq):
+        """Yield (seq, timestamp, audience hashes, frame view) from start_seq on.
+
+        Frames are memoryview slices of the segment maps, ready to send
+        to length-framed clients as they are. Records appended while
+        iterating are left out: they may still be in the write buffer.
+        """
+        end_seq = self.flush()
+        seq = max(start_seq, self.segments[0].base_seq)
+        while seq < end_seq:
+            with self.lock:
+                segment, offset = self.locate(seq)
+                data = segment.mapped()
+            view = memoryview(data)
+            segment_end = min(end_seq, segment.base_seq + segment.count)
+            while seq < segment_end:
+                timestamp, first, second = RECORD_HEADER.unpack_from(data, offset)
+                end = record_span(data, offset)
+                yield seq, timestamp, (first, second), view[offset + RECORD_HEADER.size:end]
+                seq += 1
+                offset = end
+
+    def last(self, count):
+        """Yield the most recent count records"""
+        return self.records(max(0, self.next_seq - count))
+
+    def since(self, timestamp):
+        """Yield every record stamped at or after timestamp (epoch ms)"""
+        self.flush()
+        segment = self.segments[0]
+        for candidate in self.segments:
+            if candidate.timestamps and candidate.timestamps[0] < timestamp:
+                segment = candidate
+        # Start at the last indexed record older than timestamp, then scan
+        slot = max(0, bisect.bisect_left(segment.timestamps, timestamp) - 1)
+        seq = segment.base_seq + slot * self.index_interval
+        for record in self.records(seq):
+            if record[1] >= timestamp:
+                yield record
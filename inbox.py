@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Disk-backed inbox for private messages to users who are offline.
+
+Every user with waiting messages has one append-only file in the inbox
+directory, named after the SHA-256 digest of the username so that any
+name makes a valid, fixed-length file name. Records use the history
+log's format: a record header (timestamp) followed by the message as a
+length-prefixed frame, so delivery hands the stored bytes straight to
+the connection.
+
+An in-memory index of (message count, bytes, oldest timestamp) per user,
+rebuilt from the files at startup, answers "how many are waiting" and
+enforces the caps without touching the disk: at most max_messages per
+user, max_bytes across all inboxes, and nothing older than max_age_days.
+"""
+
+import hashlib
+import os
+import struct
+import threading
+
+from history import RECORD_HEADER, now_ms, record_span
+
+DEFAULT_MAX_MESSAGES = 10000  # Per user
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # All inboxes together
+DEFAULT_MAX_AGE_DAYS = 7.0
+SUFFIX = '.inbox'
+
+
+def inbox_key(username):
+    """Fixed-length key naming a user's inbox file"""
+    return hashlib.sha256(username.encode('utf-8')).hexdigest()
+
+
+def scan(data):
+    """Yield (timestamp, frame start, frame end) for every complete record in data"""
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        try:
+            end = record_span(data, offset)
+        except struct.error:
+            return  # Torn header at the end of the file
+        if end > len(data):
+            return  # Torn frame
+        yield RECORD_HEADER.unpack_from(data, offset)[0], offset + RECORD_HEADER.size, end
+        offset = end
+
+
+class Inbox:
+    """Per-user queues of framed private messages, stored on disk"""
+
+    def __init__(self, directory, max_messages=DEFAULT_MAX_MESSAGES, max_bytes=DEFAULT_MAX_BYTES,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS):
+        """Open (or create) the inboxes stored in directory"""
+        self.directory = directory
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age_ms = int(max_age_days * 24 * 3600 * 1000)
+        self.index = {}  # {inbox key: [message count, bytes, oldest timestamp ms]}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def path(self, key):
+        """File holding the inbox with the given key"""
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def load(self):
+        """Rebuild the index from the inbox files, dropping expired and torn records"""
+        for name in os.listdir(self.directory):
+            key = name[:-len(SUFFIX)]
+            if not name.endswith(SUFFIX) or len(key) != 64 or key.strip('0123456789abcdef'):
+                continue  # Not one of ours
+            records = self.read_records(key)
+            size = sum(len(record) for timestamp, record in records)
+            if records and size == os.path.getsize(self.path(key)):
+                self.index[key] = [len(records), size, records[0][0]]
+                self.total_bytes += size
+            else:
+                self.rewrite(key, records)
+
+    def read_records(self, key):
+        """Return an inbox's unexpired records as a list of (timestamp, record bytes)"""
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        cutoff = now_ms() - self.max_age_ms
+        return [(timestamp, data[start - RECORD_HEADER.size:end])
+                for timestamp, start, end in scan(data) if timestamp >= cutoff]
+
+    def rewrite(self, key, records):
+        """Replace an inbox with records, or remove it if there are none"""
+        path = self.path(key)
+        entry = self.index.pop(key, None)
+        if entry:
+            self.total_bytes -= entry[1]
+        if not records:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(b''.join(record for timestamp, record in records))
+        os.replace(temporary, path)
+        size = sum(len(record) for timestamp, record in records)
+        self.index[key] = [len(records), size, records[0][0]]
+        self.total_bytes += size
+
+    def pending(self, username):
+        """Number of messages waiting for a user"""
+        entry = self.index.get(inbox_key(username))
+        return entry[0] if entry else 0
+
+    def store(self, username, frame, timestamp=None):
+        """Queue a framed message for a user, returning the pending count or None if full"""
+        timestamp = now_ms() if timestamp is None else timestamp
+        record = RECORD_HEADER.pack(timestamp, 0, 0) + bytes(frame)
+        key = inbox_key(username)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry and entry[2] < timestamp - self.max_age_ms:
+                # Make room by dropping what has expired
+                self.rewrite(key, self.read_records(key))
+                entry = self.index.get(key)
+            if (entry and entry[0] >= self.max_messages) or self.total_bytes + len(record) > self.max_bytes:
+                return None
+            fd = os.open(self.path(key), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+            if entry is None:
+                entry = self.index[key] = [0, 0, timestamp]
+            entry[0] += 1
+            entry[1] += len(record)
+            self.total_bytes += len(record)
+            return entry[0]
+
+    def read(self, username):
+        """Return the frames waiting for a user, oldest first, without removing them"""
+        key = inbox_key(username)
+        if key not in self.index:
+            return []
+        with self.lock:
+            records = self.read_records(key)
+        return [record[RECORD_HEADER.size:] for timestamp, record in records]
+
+    def remove(self, username, count):
+        """Drop the oldest count messages of a user's inbox once they were delivered"""
+        key = inbox_key(username)
+        with self.lock:
+            records = self.read_records(key)
+            self.rewrite(key, records[count:])
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Runtime metrics for the chat server.
+
+Metrics.instrument() wraps the server's hot handlers on the instance so
+every call is counted and timed into a fixed-bucket latency histogram;
+with metrics disabled nothing is wrapped and the handlers run exactly as
+before. Counters, gauges and histograms are rendered in the Prometheus
+text format, written periodically to a file, and summarized for the
+admin /stats command.
+"""
+
+import bisect
+import functools
+import os
+import threading
+import time
+
+# Upper bounds in seconds; the last bucket catches everything slower
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+# Per-message handlers only: a connection's lifetime is not a handler latency
+INSTRUMENTED_HANDLERS = ('register_client', 'handle_frame', 'process_message', 'route_message',
+                         'handle_command', 'broadcast_message', 'send_private_message')
+DEFAULT_DUMP_INTERVAL = 10.0
+
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+
+    def __init__(self):
+        """Start with empty buckets"""
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        """Record one duration"""
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+
+    def count(self):
+        """Number of recorded durations"""
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile"""
+        counts = list(self.counts)
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+
+class Metrics:
+    """Counters and per-handler latency histograms for one ChatServer"""
+
+    def __init__(self, server, dump_path=None, dump_interval=DEFAULT_DUMP_INTERVAL):
+        """Collect metrics for server, optionally dumping them to dump_path"""
+        self.server = server
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.started = time.time()
+        self.histograms = {name: Histogram() for name in INSTRUMENTED_HANDLERS}
+        self.messages = {}  # {message type: count}
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+
+    def instrument(self):
+        """Wrap the server's handlers with timing and start the dump thread"""
+        for name in INSTRUMENTED_HANDLERS:
+            setattr(self.server, name, self.timed(getattr(self.server, name), self.histograms[name]))
+        process_message = self.server.process_message
+        route_message = self.server.route_message
+        handle_frame = self.server.handle_frame
+
+        @functools.wraps(process_message)
+        def counted_process_message(sender, message_data):
+            self.count(message_data.get('type', 'message'))
+            return process_message(sender, message_data)
+
+        @functools.wraps(route_message)
+        def counted_route_message(sender, message_type, target_user, body):
+            self.count(message_type)
+            return route_message(sender, message_type, target_user, body)
+
+        @functools.wraps(handle_frame)
+        def counted_handle_frame(client_socket, flags, payload):
+            with self.lock:
+                self.bytes_received += len(payload)
+            return handle_frame(client_socket, flags, payload)
+
+        self.server.process_message = counted_process_message
+        self.server.route_message = counted_route_message
+        self.server.handle_frame = counted_handle_frame
+        if self.dump_path:
+            threading.Thread(target=self.dump_loop, daemon=True).start()
+
+    def count(self, message_type):
+        """Count one received message"""
+        with self.lock:
+            self.messages[message_type] = self.messages.get(message_type, 0) + 1
+
+    def timed(self, function, histogram):
+        """Wrap function so each call's duration lands in histogram"""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+
+    def queue_depths(self):
+        """Total and largest outbound queue in bytes across connected clients"""
+        depths = []
+        for connection in list(self.server.clients.values()):
+            try:
+                depths.append(connection.buffered_bytes())
+            except Exception:
+                pass  # Connection torn down while we looked
+        return sum(depths), max(depths, default=0)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        server = self.server
+        queued, largest = self.queue_depths()
+        writes = server.write_stats
+        lines = [
+            "# HELP chat_uptime_seconds Seconds since the server started",
+            "# TYPE chat_uptime_seconds gauge",
+            f"chat_uptime_seconds {time.time() - self.started:.3f}",
+            "# HELP chat_connected_clients Logged in clients on this server",
+            "# TYPE chat_connected_clients gauge",
+            f"chat_connected_clients {len(server.clients)}",
+            "# HELP chat_rooms Rooms with at least one member",
+            "# TYPE chat_rooms gauge",
+            f"chat_rooms {len(server.rooms.members)}",
+            "# HELP chat_outbound_queued_bytes Bytes queued for clients",
+            "# TYPE chat_outbound_queued_bytes gauge",
+            f"chat_outbound_queued_bytes {queued}",
+            "# HELP chat_outbound_queue_max_bytes Largest single client queue",
+            "# TYPE chat_outbound_queue_max_bytes gauge",
+            f"chat_outbound_queue_max_bytes {largest}",
+            "# HELP chat_messages_total Messages received from clients by type",
+            "# TYPE chat_messages_total counter",
+        ]
+        with self.lock:
+            messages = sorted(self.messages.items())
+            bytes_received = self.bytes_received
+        lines += [f'chat_messages_total{{type="{t}"}} {count}' for t, count in messages]
+        lines += [
+            "# HELP chat_received_bytes_total Frame payload bytes received from clients",
+            "# TYPE chat_received_bytes_total counter",
+            f"chat_received_bytes_total {bytes_received}",
+            "# HELP chat_sent_bytes_total Bytes written to clients",
+            "# TYPE chat_sent_bytes_total counter",
+            f"chat_sent_bytes_total {writes.bytes}",
+            "# HELP chat_sent_frames_total Frames written to clients",
+            "# TYPE chat_sent_frames_total counter",
+            f"chat_sent_frames_total {writes.frames}",
+            "# HELP chat_send_calls_total Send calls used to write those frames",
+            "# TYPE chat_send_calls_total counter",
+            f"chat_send_calls_total {writes.calls}",
+            "# HELP chat_throttled_total Messages dropped by the rate limits",
+            "# TYPE chat_throttled_total counter",
+        ]
+        if server.limiter:
+            lines += [f'chat_throttled_total{{category="{category}"}} {count}'
+                      for category, count in server.limiter.dropped.items()]
+        lines += [
+            "# HELP chat_reaped_connections_total Connections closed by a timeout",
+            "# TYPE chat_reaped_connections_total counter",
+        ]
+        lines += [f'chat_reaped_connections_total{{reason="{reason}"}} {count}'
+                  for reason, count in server.heartbeats.reaped.items()]
+        lines += [
+            "# HELP chat_pings_total Heartbeat pings sent to quiet clients",
+            "# TYPE chat_pings_total counter",
+            f"chat_pings_total {server.heartbeats.pings}",
+            "# HELP chat_handler_seconds Time spent in server handlers",
+            "# TYPE chat_handler_seconds histogram",
+        ]
+        for name, histogram in self.histograms.items():
+            counts = list(histogram.counts)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'chat_handler_seconds_bucket{{handler="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'chat_handler_seconds_sum{{handler="{name}"}} {histogram.total:.6f}')
+            lines.append(f'chat_handler_seconds_count{{handler="{name}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Short multi-line report for the /stats command"""
+        queued, largest = self.queue_depths()
+        writes = self.server.write_stats
+        with self.lock:
+            messages = ', '.join(f"{t} {count}" for t, count in sorted(self.messages.items())) or 'none'
+            bytes_received = self.bytes_received
+        lines = [
+            f"Uptime {time.time() - self.started:.0f}s, {len(self.server.clients)} clients, "
+            f"{len(self.server.rooms.members)} rooms",
+            f"Messages: {messages}",
+            f"Bytes in {bytes_received}, out {writes.bytes}; {writes.summary()}",
+            f"Outbound queues: {queued} bytes total, {largest} bytes largest",
+        ]
+        if self.server.limiter:
+            dropped = ', '.join(f"{c} {count}" for c, count in self.server.limiter.dropped.items())
+            lines.append(f"Rate limited: {dropped}")
+        if self.server.search:
+            lines.append(self.server.search.summary())
+        lines.append(self.server.heartbeats.summary())
+        if self.server.sessions:
+            lines.append(self.server.sessions.summary())
+        for name, histogram in self.histograms.items():
+            count = histogram.count()
+            if count:
+                lines.append(f"{name}: {count} calls, p50 <= {histogram.quantile(0.5) * 1000:g} ms, "
+                             f"p99 <= {histogram.quantile(0.99) * 1000:g} ms")
+        return '\n'.join(lines)
+
+    def dump(self):
+        """Replace the metrics file with a fresh rendering"""
+        temporary = f"{self.dump_path}.tmp"
+        with open(temporary, 'w') as f:
+            f.write(self.render())
+        os.replace(temporary, self.dump_path)
+
+    def dump_loop(self):
+        """Write the metrics file every dump_interval seconds"""
+        while True:
+            time.sleep(self.dump_interval)
+            try:
+                self.dump()
+            except OSError as e:
+                print(f"Error writing metrics to {self.dump_path}: {e}")
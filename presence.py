@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Coalesced join/leave notices.
+
+Announcing every login and logout to every user costs O(n) sends per
+event, so a mass reconnect after a restart or a network blip costs
+O(n^2) right when the server is busiest. PresenceDigest sends the first
+event after a quiet period straight away and folds everything that
+follows within the window into one digest such as "+37 joined, -12 left".
+A user who leaves and comes back (or joins and leaves) within a window
+cancels out and is not announced at all.
+
+Presence notices carry a "presence" field with the counts; clients that
+opted out with "presence": false in their handshake never receive them.
+"""
+
+import threading
+import time
+
+from protocol import timestamp
+
+DEFAULT_PRESENCE_WINDOW = 1.0  # Seconds
+
+
+def presence_message(joined, left):
+    """System message announcing the users that joined and left"""
+    if len(joined) + len(left) == 1:
+        text = f"{joined[0]} joined the chat" if joined else f"{left[0]} left the chat"
+    else:
+        text = ', '.join(part for part in (f"+{len(joined)} joined" if joined else '',
+                                           f"-{len(left)} left" if left else '') if part)
+    return {
+        "type": "system",
+        "message": text,
+        "presence": {"joined": len(joined), "left": len(left)},
+        "timestamp": timestamp()
+    }
+
+
+class PresenceDigest:
+    """Collects joins and leaves on one server and publishes them in digests"""
+
+    def __init__(self, server, window=DEFAULT_PRESENCE_WINDOW):
+        """window is the seconds events are collected for; 0 announces every event"""
+        self.server = server
+        self.window = window
+        self.pending = {}  # {username: +1 joined / -1 left} since the last notice
+        self.last_sent = float('-inf')  # Monotonic time of the last notice
+        self.scheduled = False  # Whether a flush is waiting for the window to end
+        self.events = 0  # Joins and leaves recorded
+        self.notices = 0  # Notices published for them
+        self.lock = threading.Lock()
+
+    def joined(self, username):
+        """Record a login"""
+        self.record(username, 1)
+
+    def left(self, username):
+        """Record a logout"""
+        self.record(username, -1)
+
+    def record(self, username, change):
+        """Announce the event now if the window is quiet, else fold it into the next digest"""
+        with self.lock:
+            self.events += 1
+            if self.scheduled:
+                if self.pending.get(username) == -change:
+                    del self.pending[username]  # Back where the last notice left them
+                else:
+                    self.pending[username] = change
+                return
+            now = time.monotonic()
+            delay = self.last_sent + self.window - now
+            if delay <= 0:
+                self.last_sent = now
+                self.notices += 1
+            else:
+                self.pending[username] = change
+                self.scheduled = True
+        if delay <= 0:
+            self.publish({username: change})
+        else:
+            self.schedule(delay)
+
+    def schedule(self, delay):
+        """Run flush once the window is over, on the server's engine"""
+        if self.server.loop is not None:
+            self.server.call_in_engine(self.server.loop.call_later, delay, self.flush)
+        else:
+            timer = threading.Timer(delay, self.flush)
+            timer.daemon = True
+            timer.start()
+
+    def flush(self):
+        """Publish the events collected during the window as one digest"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+            self.last_sent = time.monotonic()
+            if pending:
+                self.notices += 1
+        if pending:
+            self.publish(pending)
+
+    def publish(self, changes):
+        """Send a presence notice for {username: change} to this server's users and the cluster"""
+        joined = sorted(username for username, change in changes.items() if change > 0)
+        left = sorted(username for username, change in changes.items() if change < 0)
+        # A user who just joined does not need to hear about it
+        exclude_user = joined[0] if len(joined) == 1 and not left else None
+        self.server.publish_message(presence_message(joined, left), exclude_user=exclude_user)
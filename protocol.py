@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+"""
+Wire protocol helpers shared by the chat server and client.
+
+Two framings are understood:
+- Length-prefixed: a 4-byte big-endian header whose high byte holds
+  frame flags and whose low 24 bits hold the payload length.
+- Newline-delimited: one JSON object per line, for older clients.
+  JSON objects that are not followed by a newline are still accepted
+  at the end of a read, one frame per object even when several arrive
+  together, so clients that predate framing keep working.
+
+The framing of each frame is detected from its first byte, because a
+JSON frame always starts with '{' and a flags byte never does.
+
+Clients using length-prefixed framing can ask for the compact binary
+encoding in their handshake. A binary frame has FLAG_BINARY set and a
+payload of a packed header (message type code, sender id, auxiliary id
+for the target user or room, epoch-millisecond timestamp) followed by the
+UTF-8 message text. Names are interned: each side announces a name once
+with a 'define' frame and then refers to it by number. Messages with
+fields the binary layout cannot carry are still sent as JSON frames.
+
+Clients using length-prefixed framing can also negotiate deflate
+compression. Payloads above a size threshold are then sent raw-deflated
+with a preset dictionary of typical chat frames, and FLAG_COMPRESSED is
+added to the frame's flags (FLAG_BINARY still describes the payload
+inside).
+
+Clients that asked for a resumable session get every message routed to
+them with FLAG_SEQUENCED and a 4-byte big-endian sequence number in front
+of the payload (before any compression or binary layout), numbered per
+user, so that after a reconnect they can tell the server the last number
+they saw.
+"""
+
+import functools
+import json
+import re
+import struct
+import threading
+import time
+import zlib
+
+HEADER = struct.Struct('>I')
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD_SIZE = 0xFFFFFF  # Largest length the 24-bit header can carry
+DEFAULT_MAX_FRAME_SIZE = 1024 * 1024
+DEFAULT_BUFFER_SIZE = 4 * 1024  # Receive buffer of an idle connection, grown only for large frames
+MIN_READ_SIZE = 1024  # Free space the receive buffer offers each read
+
+FRAMING_LENGTH = 'length'
+FRAMING_LINE = 'line'
+
+FLAG_BINARY = 0x01  # Payload uses the binary encoding
+FLAG_COMPRESSED = 0x02  # Payload is deflated with COMPRESSION_DICTIONARY
+FLAG_SEQUENCED = 0x04  # Payload starts with the message's delivery sequence number
+KNOWN_FLAGS = FLAG_BINARY | FLAG_COMPRESSED | FLAG_SEQUENCED
+SEQUENCE = struct.Struct('>I')
+
+ENCODING_JSON = 'json'
+ENCODING_BINARY = 'binary'
+ENCODINGS = (ENCODING_JSON, ENCODING_BINARY)
+
+BINARY_HEADER = struct.Struct('>BIIQ')  # type code, sender id, aux id, timestamp ms
+BINARY_DEFINE = 0  # Announces the name for an id; the body is the name
+BINARY_TYPES = {'message': 1, 'system': 2, 'private': 3, 'room': 4, 'list_users': 5}
+BINARY_TYPE_NAMES = {code: name for name, code in BINARY_TYPES.items()}
+BINARY_FIELDS = frozenset(('type', 'sender', 'message', 'timestamp', 'target', 'room'))
+
+COMPRESSION_DEFLATE = 'deflate'
+COMPRESSIONS = (COMPRESSION_DEFLATE,)
+DEFAULT_COMPRESS_THRESHOLD = 512  # Smaller payloads are not worth compressing
+COMPRESSION_LEVEL = 6
+# Strings that recur in chat frames, pasted logs and code. Deflate finds
+# matches near the end of the dictionary cheapest, so the most common
+# strings (the JSON envelope) come last.
+DICTIONARY_SAMPLES = (
+    'Traceback (most recent call last):\n  File "', '", line ', ', in ', 'Error: ', 'Exception',
+    'at java.', 'at ', '.java:', 'undefined', 'null', 'true', 'false', 'None', 'self.',
+    'function ', 'return ', 'const ', 'import ', 'from ', 'def ', 'class ', 'if (', 'else', 'for (',
+    '    ', '\n    ', '\n\n', ' = ', ' == ', '();', '://', 'https://', 'http://', '.com/',
+    'DEBUG', 'INFO', 'WARN', 'WARNING', 'ERROR', 'CRITICAL', 'FATAL', ' - ', ' [', '] ',
+    '2025-', '2026-', 'T00:', ':00.', 'Z ',
+    '"type": "room", "room": "', '"type": "private", "sender": "', '", "target": "',
+    '{"type": "system", "message": "', ' joined the chat', ' left the chat', '", "timestamp": "',
+    '{"type": "message", "sender": "', '", "message": "',
+)
+COMPRESSION_DICTIONARY = ''.join(DICTIONARY_SAMPLES).encode('utf-8')
+
+_OPEN_BRACE = ord('{')
+_CLOSE_BRACE = ord('}')
+_WHITESPACE = frozenset(b' \t\r\n')
+_JSON_DECODER = json.JSONDecoder()
+
+# Envelope of a plain broadcast or private message, for the route-without-decode
+# fast path: {"type": "message"|"private", ["target": "<name>",] "message": "<text>"}
+# with the text still a JSON string token that does not start a command
+_JSON_STRING_BODY = rb'[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*'
+_ENVELOPE = re.compile(rb'\s*\{\s*"type"\s*:\s*"(message|private)"\s*,\s*'
+                       rb'(?:"target"\s*:\s*"([^"\\\x00-\x1f]*)"\s*,\s*)?'
+                       rb'"message"\s*:\s*("(?![/\\])' + _JSON_STRING_BODY + rb'")\s*\}\s*')
+
+
+class FrameError(ValueError):
+    """Raised when the peer sends a malformed or oversized frame"""
+
+
+
+def encode_frame(payload, flags=0):
+    """Prefix payload bytes with a length/flags header"""
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds {MAX_PAYLOAD_SIZE} bytes")
+    return HEADER.pack(flags << 24 | len(payload)) + payload
+
+
+def sequence_frame(frame, seq):
+    """Copy of a length-prefixed frame carrying a delivery sequence number"""
+    header, = HEADER.unpack_from(frame)
+    return b''.join((HEADER.pack(header + (FLAG_SEQUENCED << 24) + SEQUENCE.size), SEQUENCE.pack(seq),
+                     memoryview(frame)[HEADER_SIZE:]))
+
+
+def split_sequence(flags, payload):
+    """Return (sequence number or None, remaining flags, payload without the number)"""
+    if not flags & FLAG_SEQUENCED:
+        return None, flags, payload
+    seq, = SEQUENCE.unpack_from(payload)
+    return seq, flags & ~FLAG_SEQUENCED, payload[SEQUENCE.size:]
+
+
+def encode_line(payload):
+    """Terminate payload bytes with a newline"""
+    return payload + b'\n'
+
+
+def frame_payload(payload, framing):
+    """Frame payload bytes for a connection using the given framing"""
+    if framing == FRAMING_LENGTH:
+        return encode_frame(payload)
+    return encode_line(payload)
+
+
+def decode_json(payload):
+    """Decode a JSON frame payload (bytes or memoryview)"""
+    return json.loads(str(payload, 'utf-8'))
+
+
+def is_welcome(message):
+    """Whether a message is the server accepting a username handshake.
+
+    Chat traffic can reach a new user before its welcome, so the welcome
+    is told apart by the fields only it carries.
+    """
+    return message.get('type') == 'system' and ('encoding' in message or 'session' in message)
+
+
+_clock = [None, None]
+
+
+def timestamp():
+    """Current time as HH:MM:SS, formatted at most once per second"""
+    now = int(time.time())
+    if _clock[0] != now:
+        _clock[:] = [now, time.strftime("%H:%M:%S", time.localtime(now))]
+    return _clock[1]
+
+
+def encode_binary(type_code, sender_id, aux_id, timestamp_ms, body):
+    """Build a complete binary frame"""
+    return encode_frame(BINARY_HEADER.pack(type_code, sender_id, aux_id, timestamp_ms) + body, FLAG_BINARY)
+
+
+def encode_define(name_id, name):
+    """Build the frame announcing the name behind an interned id"""
+    return encode_binary(BINARY_DEFINE, name_id, 0, 0, name.encode('utf-8'))
+
+
+def decode_binary(payload, names):
+    """Decode a binary payload into a message dict.
+
+    names maps interned ids to names and is updated by 'define' frames,
+    for which None is returned.
+    """
+    type_code, sender_id, aux_id, timestamp_ms = BINARY_HEADER.unpack_from(payload)
+    text = str(payload[BINARY_HEADER.size:], 'utf-8')
+    if type_code == BINARY_DEFINE:
+        names[sender_id] = text
+        return None
+    message_type = BINARY_TYPE_NAMES.get(type_code)
+    if message_type is None:
+        raise FrameError(f"Unknown binary message type {type_code}")
+    message = {"type": message_type, "message": text}
+    if sender_id:
+        message['sender'] = names[sender_id]
+    if aux_id:
+        message['room' if message_type == 'room' else 'target'] = names[aux_id]
+    if timestamp_ms:
+        message['timestamp'] = time.strftime("%H:%M:%S", time.localtime(timestamp_ms / 1000))
+    return message
+
+
+def compress_frame(frame):
+    """Deflate a length-prefixed frame's payload, keeping its other flags.
+
+    Returns the frame unchanged when compression does not make it smaller.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                  zdict=COMPRESSION_DICTIONARY)
+    body = compressor.compress(memoryview(frame)[HEADER_SIZE:]) + compressor.flush()
+    if len(body) + HEADER_SIZE >= len(frame):
+        return frame
+    return encode_frame(body, frame[0] | FLAG_COMPRESSED)
+
+
+def decompress_payload(payload, max_size=DEFAULT_MAX_FRAME_SIZE):
+    """Inflate a compressed payload, refusing to grow past max_size"""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+    try:
+        data = decompressor.decompress(payload, max_size)
+    except zlib.error as e:
+        raise FrameError(f"Bad compressed frame: {e}")
+    if decompressor.unconsumed_tail:
+        raise FrameError(f"Compressed frame inflates past {max_size} bytes")
+    return data
+
+
+def scan_envelope(payload):
+    """Read the envelope of a plain broadcast or private message without decoding it.
+    
+    Returns (message type, target, body) with body being the message text
+    as the JSON string token the client sent, quotes and escapes
+    included. Returns None for anything else, such as commands, other
+    message types or fields, or the same fields in another order, which
+    all go through the full parser instead.
+    """
+    data = bytes(payload)
+    if not data.isascii():
+        try:
+            data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    match = _ENVELOPE.fullmatch(data)
+    if match is None:
+        return None
+    message_type, target, body = match.group(1, 2, 3)
+    if message_type == b'message':
+        return None if target is not None else ('message', None, body)
+    return None if target is None else ('private', target.decode('utf-8'), body)
+
+
+@functools.lru_cache(maxsize=4096)
+def json_string(value):
+    """JSON encoding of a short, frequently repeated string such as a username"""
+    return json.dumps(value).encode('utf-8')
+
+
+def decode_message(flags, payload, names, max_size=DEFAULT_MAX_FRAME_SIZE):
+    """Decode a frame payload of any encoding into a message dict.
+
+    Returns None for binary name definitions.
+    """
+    if flags & FLAG_SEQUENCED:
+        payload = payload[SEQUENCE.size:]
+    if flags & FLAG_COMPRESSED:
+        payload = decompress_payload(payload, max_size)
+    if flags & FLAG_BINARY:
+        return decode_binary(payload, names)
+    return decode_json(payload)
+
+
+class InternTable:
+    """Assigns small integer ids to names for the binary encoding"""
+
+    def __init__(self):
+        """Initialize an empty table; id 0 means 'no name'"""
+        self.ids = {}
+        self.names = [None]
+        self.defines = [None]  # Cached 'define' frame per id
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        """Return the id for name, assigning one on first use"""
+        name_id = self.ids.get(name)
+        if name_id is None:
+            with self.lock:
+                name_id = self.ids.get(name)
+                if name_id is None:
+                    name_id = len(self.names)
+                    self.names.append(name)
+                    self.defines.append(encode_define(name_id, name))
+                    self.ids[name] = name_id
+        return name_id
+
+    def define_frame(self, name_id):
+        """Frame that announces the name behind name_id"""
+        return self.defines[name_id]
+
+
+class Payload:
+    """A message serialized once and shared by every recipient.
+
+    The JSON bytes and each framed variant are built on first use and
+    cached, so a broadcast costs one encode however many clients get it.
+    """
+
+    __slots__ = ('message', 'created', '_json', '_frames', '_binary', '_binary_ids', '_compressed')
+
+    def __init__(self, message):
+        """Wrap a message dict"""
+        self.message = message
+        self.created = time.time()
+        self._json = None
+        self._frames = {}
+        self._binary = None
+        self._binary_ids = None
+        self._compressed = {}
+
+    @property
+    def json(self):
+        """UTF-8 JSON encoding of the message"""
+        if self._json is None:
+            self._json = json.dumps(self.message).encode('utf-8')
+        return self._json
+
+    def frame(self, framing):
+        """Framed bytes for a connection using the given framing"""
+        data = self._frames.get(framing)
+        if data is None:
+            data = self._frames[framing] = frame_payload(self.json, framing)
+        return data
+
+    def binary(self, interns):
+        """Return (frame, interned ids) in the binary encoding.
+
+        The frame is None when the message has fields the binary layout
+        cannot carry, in which case it has to be sent as JSON.
+        """
+        if self._binary is None:
+            message = self.message
+            type_code = BINARY_TYPES.get(message.get('type'))
+            if type_code is None or not BINARY_FIELDS.issuperset(message):
+                self._binary, self._binary_ids = False, ()
+            else:
+                sender_id = interns.intern(message['sender']) if 'sender' in message else 0
+                aux = message.get('room') or message.get('target')
+                aux_id = interns.intern(aux) if aux else 0
+                timestamp_ms = int(self.created * 1000) if 'timestamp' in message else 0
+                self._binary = encode_binary(type_code, sender_id, aux_id, timestamp_ms,
+                                             message.get('message', '').encode('utf-8'))
+                self._binary_ids = tuple(i for i in (sender_id, aux_id) if i)
+        return (self._binary or None), self._binary_ids
+
+    def compressed(self, frame):
+        """Return frame (one of this payload's frames) compressed, once per payload"""
+        key = frame[0]  # The flags tell the JSON and binary frames apart
+        data = self._compressed.get(key)
+        if data is None:
+            data = self._compressed[key] = compress_frame(frame)
+        return data
+
+    def field(self, key):
+        """One field of the message, or None"""
+        return self.message.get(key)
+
+
+class RawPayload(Payload):
+    """A Payload whose JSON was spliced together around still-encoded message text.
+
+    Built by raw_broadcast() and raw_private() from the string token a
+    client sent, without decoding or re-encoding the text. The message
+    dict is only decoded if something asks for it, such as the binary
+    encoding or the search index.
+    """
+
+    __slots__ = ('fields', '_message')
+
+    def __init__(self, fields, data):
+        """fields: the message's fields except its text; data: the message's UTF-8 JSON"""
+        self.fields = fields
+        self._message = None
+        self.created = time.time()
+        self._json = data
+        self._frames = {}
+        self._binary = None
+        self._binary_ids = None
+        self._compressed = {}
+
+    @property
+    def message(self):
+        """The message as a dict, decoded on first use"""
+        if self._message is None:
+            self._message = json.loads(self._json)
+        return self._message
+
+    def field(self, key):
+        """One field of the message, or None, decoding only for the text"""
+        if key == 'message':
+            return self.message['message']
+        return self.fields.get(key)
+
+
+def raw_broadcast(sender, body):
+    """RawPayload of a broadcast whose text is the JSON string token body"""
+    now = timestamp()
+    return RawPayload({"type": "message", "sender": sender, "timestamp": now}, b''.join((
+        b'{"type": "message", "sender": ', json_string(sender), b', "message": ', body,
+        b', "timestamp": ', json_string(now), b'}')))
+
+
+def raw_private(sender, target, body):
+    """RawPayload of a private message whose text is the JSON string token body"""
+    now = timestamp()
+    return RawPayload({"type": "private", "sender": sender, "target": target, "timestamp": now}, b''.join((
+        b'{"type": "private", "sender": ', json_string(sender), b', "target": ', json_string(target),
+        b', "message": ', body, b', "timestamp": ', json_string(now), b'}')))
+
+
+class FrameDecoder:
+    """Incremental decoder that parses frames out of one reusable buffer.
+
+    Data is read straight into the buffer with recv_into() (or through
+    get_buffer()/advance() for asyncio buffered protocols) and frames()
+    yields memoryview slices of it, so payloads are never copied. The
+    slices are only valid until the next read into the buffer.
+
+    The buffer starts small, since most connections are idle, grows only
+    while a frame larger than it is partly received, and shrinks back to
+    its starting size once drained.
+    """
+
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE, buffer_size=DEFAULT_BUFFER_SIZE):
+        """Initialize the decoder with a frame size limit"""
+        if not 0 < max_frame_size <= MAX_PAYLOAD_SIZE:
+            raise ValueError(f"max_frame_size must be between 1 and {MAX_PAYLOAD_SIZE}")
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size  # Size the buffer shrinks back to once drained
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not yet returned as a frame
+        self.end = 0  # End of the received data
+        self.scan_from = 0  # Where to resume looking for a newline
+        self.needed = 0  # Bytes required to complete the pending frame
+        self.framing = None  # Framing of the most recent frame
+
+    def get_buffer(self, min_free=MIN_READ_SIZE):
+        """Return a writable view of the free space at the end of the buffer"""
+        if self.start == self.end:
+            self.start = self.end = self.scan_from = 0
+            if len(self.buffer) > self.buffer_size:
+                # Drained after a large frame: give the extra memory back
+                self.buffer = bytearray(self.buffer_size)
+                self.view = memoryview(self.buffer)
+        pending = self.end - self.start
+        wanted = max(self.needed, pending + min_free)
+        if wanted > len(self.buffer):
+            # Grow into a new buffer; earlier frame views keep the old one alive
+            buffer = bytearray(max(wanted, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self._rebase()
+        elif len(self.buffer) - self.end < min_free and self.start:
+            # Move the partial frame to the front of the buffer
+            self.buffer[:pending] = self.view[self.start:self.end]
+            self._rebase()
+        return self.view[self.end:]
+
+    def _rebase(self):
+        """Adjust offsets after the pending bytes moved to the buffer start"""
+        self.scan_from -= self.start
+        self.end -= self.start
+        self.start = 0
+
+    def advance(self, nbytes):
+        """Record that nbytes were written into the view from get_buffer()"""
+        self.end += nbytes
+
+    def recv_into(self, sock):
+        """Read from a socket straight into the buffer, returning the byte count"""
+        nbytes = sock.recv_into(self.get_buffer())
+        self.advance(nbytes)
+        return nbytes
+
+    def feed(self, data):
+        """Append received bytes to the buffer"""
+        self.get_buffer(len(data))[:len(data)] = data
+        self.advance(len(data))
+
+    def pending(self):
+        """Received bytes not yet returned as frames"""
+        return bytes(self.view[self.start:self.end])
+
+    def frames(self):
+        """Yield (flags, payload) for every complete frame in the buffer"""
+        buffer = self.buffer
+        while self.start < self.end:
+            first = buffer[self.start]
+            if first in _WHITESPACE:
+                # Blank lines and stray separators between JSON frames
+                self.start += 1
+                continue
+            if first == _OPEN_BRACE:
+                frame = self._next_line()
+            else:
+                frame = self._next_length_prefixed()
+            if frame is None:
+                return
+            yield frame
+
+    def _next_length_prefixed(self):
+        """Return the next length-prefixed frame, or None if incomplete"""
+        available = self.end - self.start
+        if available < HEADER_SIZE:
+            self.needed = HEADER_SIZE
+            return None
+        header, = HEADER.unpack_from(self.buffer, self.start)
+        flags, length = header >> 24, header & MAX_PAYLOAD_SIZE
+        if flags & ~KNOWN_FLAGS:
+            raise FrameError(f"Unknown frame flags 0x{flags:02x}")
+        if length > self.max_frame_size:
+            raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+        if available < HEADER_SIZE + length:
+            self.needed = HEADER_SIZE + length
+            return None
+        payload_start = self.start + HEADER_SIZE
+        self.start = payload_start + length
+        self.scan_from = self.start
+        self.needed = 0
+        self.framing = FRAMING_LENGTH
+        return flags, self.view[payload_start:self.start]
+
+    def _next_line(self):
+        """Return the next newline-delimited frame, or None if incomplete"""
+        newline = self.buffer.find(b'\n', max(self.start, self.scan_from), self.end)
+        if newline < 0:
+            # Unterminated JSON objects from a client that predates framing,
+            # possibly several merged into one read
+            end = self._json_end(self.start, self.end) if self.buffer[self.end - 1] == _CLOSE_BRACE else None
+            if end is not None and end - self.start <= self.max_frame_size:
+                payload = self.view[self.start:end]
+                self.start = self.scan_from = end
+                self.needed = 0
+                self.framing = FRAMING_LINE
+                return 0, payload
+            if self.end - self.start > self.max_frame_size:
+                raise FrameError(f"Line of over {self.max_frame_size} bytes without a newline")
+            self.scan_from = self.end
+            self.needed = 0
+            return None
+        if newline - self.start > self.max_frame_size:
+            raise FrameError(f"Line of {newline - self.start} bytes exceeds limit of {self.max_frame_size}")
+        payload = self.view[self.start:newline]
+        self.start = self.scan_from = min(newline + 1, self.end)
+        self.needed = 0
+        self.framing = FRAMING_LINE
+        return 0, payload
+
+    def _json_end(self, start, end):
+        """Return where the complete JSON value starting at buffer[start] ends, or None.
+
+        Decoded as latin-1 so that character offsets are byte offsets; the
+        frame's UTF-8 is checked when it is decoded as a message.
+        """
+        try:
+            value, length = _JSON_DECODER.raw_decode(str(self.view[start:end], 'latin-1'))
+        except ValueError:
+            return None
+        return start + length
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Token-bucket flood control.
+
+Every connection gets one bucket per message category, and the server
+can add a global bucket per category shared by all connections. A bucket
+refills lazily from the time elapsed since it was last used, so a check
+is a few float operations and no timers or background threads are
+involved. Messages over the limit are dropped before any fan-out.
+"""
+
+import threading
+import time
+
+# Categories of client traffic that can be limited
+CATEGORIES = ('broadcast', 'private', 'users', 'search')
+# Per-connection defaults: (messages per second, burst)
+DEFAULT_LIMITS = {'broadcast': (50.0, 100), 'private': (50.0, 100), 'users': (5.0, 10), 'search': (1.0, 5)}
+DESCRIPTIONS = {'broadcast': 'messages', 'private': 'private messages', 'users': 'user list requests',
+                'search': 'searches'}
+MESSAGE_TYPE_CATEGORIES = {'room': 'broadcast', 'private': 'private', 'list_users': 'users'}
+
+
+def parse_limit(value):
+    """Parse a CATEGORY=RATE[/BURST] command line value"""
+    category, _, limit = value.partition('=')
+    rate, _, burst = limit.partition('/')
+    if category not in CATEGORIES:
+        raise ValueError(f"Unknown category '{category}', expected one of: {', '.join(CATEGORIES)}")
+    try:
+        rate = float(rate)
+        burst = float(burst) if burst else max(1.0, rate)
+    except ValueError:
+        raise ValueError(f"expected CATEGORY=RATE[/BURST], got '{value}'")
+    return category, (rate, burst)
+
+
+def categorize(message_type, content):
+    """Return the category a client message is limited under, or None"""
+    if message_type == 'message':
+        if not content.startswith('/'):
+            return 'broadcast'
+        if content.startswith('/private '):
+            return 'private'
+        if content.startswith('/room '):
+            return 'broadcast'
+        if content == '/users' or content.startswith('/users '):
+            return 'users'
+        if content.startswith('/search '):
+            return 'search'
+        return None
+    return MESSAGE_TYPE_CATEGORIES.get(message_type)
+
+
+class TokenBucket:
+    """Allows rate events per second on average and up to burst at once"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        """Start with a full bucket"""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Take one token if there is one, returning whether it was taken"""
+        # now may predate a bucket created after the caller read the clock
+        tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = max(self.updated, now)
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return True
+        self.tokens = tokens
+        return False
+
+
+class RateLimiter:
+    """Per-connection and global token buckets for each message category"""
+
+    def __init__(self, limits=None, global_limits=None):
+        """limits and global_limits map categories to (rate, burst); a rate of 0 means unlimited"""
+        limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.limits = {category: limit for category, limit in limits.items() if limit[0] > 0}
+        self.global_buckets = {category: TokenBucket(*limit)
+                               for category, limit in (global_limits or {}).items() if limit[0] > 0}
+        self.global_lock = threading.Lock()
+        self.dropped = dict.fromkeys(CATEGORIES, 0)
+
+    def allow(self, connection, category):
+        """Charge one message to the connection's and the global bucket"""
+        now = time.monotonic()
+        limit = self.limits.get(category)
+        if limit is not None:
+            bucket = connection.buckets.get(category)
+            if bucket is None:
+                bucket = connection.buckets[category] = TokenBucket(*limit)
+            if not bucket.take(now):
+                self.dropped[category] += 1
+                return False
+        bucket = self.global_buckets.get(category)
+        if bucket is not None:
+            with self.global_lock:
+                allowed = bucket.take(now)
+            if not allowed:
+                self.dropped[category] += 1
+                return False
+        return True
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Registry of the clients connected to a server.
+
+Handler threads add and remove clients while others fan messages out to
+them. Changes happen under a lock and bump a version number; readers get
+an immutable snapshot of (username, connection) pairs that is rebuilt at
+most once per version, so iterating during join/leave churn is always
+safe and repeated broadcasts share one snapshot.
+
+Usernames are also kept in a sorted list, which makes prefix lookups a
+binary search. /users listings are paginated and cached per version.
+"""
+
+import bisect
+import threading
+
+DEFAULT_PAGE_SIZE = 100
+_PREFIX_END = '\U0010ffff'  # Sorts after every string that starts with the prefix
+
+
+def paginate(names, prefix='', page=1, page_size=DEFAULT_PAGE_SIZE):
+    """Return (page of names, matching total, page number, page count) from sorted names"""
+    start = bisect.bisect_left(names, prefix) if prefix else 0
+    end = bisect.bisect_left(names, prefix + _PREFIX_END, start) if prefix else len(names)
+    total = end - start
+    pages = max(1, -(-total // page_size))
+    page = min(max(1, page), pages)
+    first = start + (page - 1) * page_size
+    return list(names[first:min(first + page_size, end)]), total, page, pages
+
+
+def format_listing(names, total, page, pages, prefix=''):
+    """User list text; always starts with 'Connected users'"""
+    matching = f" matching '{prefix}'" if prefix else ""
+    paging = f" (page {page} of {pages}, {total} total)" if pages > 1 else ""
+    return f"Connected users{matching}{paging}: {', '.join(names) if names else 'none'}"
+
+
+class ClientRegistry:
+    """Thread-safe {username: connection} map with consistent snapshots"""
+
+    def __init__(self, page_size=DEFAULT_PAGE_SIZE):
+        """Start empty"""
+        self.connections = {}
+        self.names = []  # Sorted usernames
+        self.version = 0  # Bumped on every membership change
+        self.page_size = page_size
+        self._snapshot = ()
+        self._snapshot_version = 0
+        self.listings = {}  # {(prefix, page): (names, text)} for the current version
+        self.lock = threading.Lock()
+
+    def add(self, username, connection):
+        """Register a connection, returning False if the username is taken"""
+        with self.lock:
+            if username in self.connections:
+                return False
+            self.connections[username] = connection
+            bisect.insort(self.names, username)
+            self._changed()
+            return True
+
+    def remove(self, username, connection):
+        """Unregister a username if it still belongs to connection"""
+        with self.lock:
+            if self.connections.get(username) is not connection:
+                return False
+            del self.connections[username]
+            del self.names[bisect.bisect_left(self.names, username)]
+            self._changed()
+            return True
+
+    def replace(self, username, old, new):
+        """Move a username from one connection to another, returning False if old no longer has it"""
+        with self.lock:
+            if self.connections.get(username) is not old:
+                return False
+            self.connections[username] = new
+            self.version += 1  # Snapshots hold the connections; names and listings stay valid
+            return True
+
+    def _changed(self):
+        """Invalidate everything derived from the membership"""
+        self.version += 1
+        self.listings = {}
+
+    def snapshot(self):
+        """Immutable tuple of (username, connection) pairs for the current version"""
+        if self._snapshot_version != self.version:
+            with self.lock:
+                if self._snapshot_version != self.version:
+                    self._snapshot = tuple(self.connections.items())
+                    self._snapshot_version = self.version
+        return self._snapshot
+
+    def listing(self, prefix='', page=1):
+        """Return (names, text) for one page of the user list, cached until membership changes"""
+        key = (prefix, page)
+        cached = self.listings.get(key)
+        if cached is None:
+            with self.lock:
+                names, total, page, pages = paginate(self.names, prefix, page, self.page_size)
+                cached = (names, format_listing(names, total, page, pages, prefix))
+                self.listings[key] = cached
+        return cached
+
+    # Read-only dict interface
+
+    def get(self, username, default=None):
+        """Connection of a user, or default"""
+        return self.connections.get(username, default)
+
+    def __getitem__(self, username):
+        """Connection of a user"""
+        return self.connections[username]
+
+    def __contains__(self, username):
+        """Whether a user is connected"""
+        return username in self.connections
+
+    def __len__(self):
+        """Number of connected users"""
+        return len(self.connections)
+
+    def keys(self):
+        """Connected usernames, sorted"""
+        with self.lock:
+            return list(self.names)
+
+    def values(self):
+        """Snapshot of the connections"""
+        return [connection for username, connection in self.snapshot()]
+
+    def items(self):
+        """Snapshot of (username, connection) pairs"""
+        return self.snapshot()
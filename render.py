@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Terminal output for the interactive client under message floods.
+
+Printing every message as it arrives makes the terminal the bottleneck:
+each print is a write that blocks the event loop once the terminal falls
+behind, so keystrokes, pongs and further reads all wait on it. Renderer
+collects the messages that arrive during a frame interval and writes
+them with one buffered write per frame instead.
+
+A frame shows at most `budget` lines, the newest ones. Messages marked
+important (the client's private and system messages) are only left out
+when there are more of them than fit. The messages left out are replaced
+by a single "...342 more messages" line and are never formatted. The budget
+adapts to the terminal: it halves whenever a write takes longer than
+half a frame and grows back while the terminal keeps up, so a slow
+terminal gets fewer lines rather than a frozen client.
+"""
+
+import asyncio
+import sys
+import time
+
+DEFAULT_FRAME_INTERVAL = 0.05  # Seconds between screen updates
+DEFAULT_FRAME_LINES = 100  # Most lines per update, 2000 lines a second at the default interval
+MIN_FRAME_LINES = 10
+
+
+class Renderer:
+    """Writes messages in batches, collapsing what the terminal cannot keep up with"""
+
+    def __init__(self, format_message, out=None, interval=DEFAULT_FRAME_INTERVAL, max_lines=DEFAULT_FRAME_LINES):
+        """format_message turns a message into a line, or None to skip it"""
+        self.format_message = format_message
+        self.out = out or sys.stdout
+        self.interval = interval
+        self.max_lines = max_lines
+        self.budget = max_lines  # Lines per update, lowered while the terminal is slow
+        self.pending = []  # (message, important) received since the last update
+        self.scheduled = None  # Timer handle of the next update
+        self.last_update = 0.0
+        self.displayed = 0
+        self.collapsed = 0  # Left out to keep up
+        self.updates = 0
+
+    def add(self, message, important=False):
+        """Queue a message for the next update; important ones are collapsed last"""
+        self.pending.append((message, important))
+        if self.scheduled is None:
+            loop = asyncio.get_running_loop()
+            delay = max(0.0, self.last_update + self.interval - loop.time())
+            self.scheduled = loop.call_later(delay, self.update)
+
+    def select(self, pending):
+        """The messages to show and how many were left out, keeping the newest"""
+        if len(pending) <= self.budget:
+            return [message for message, _ in pending], 0
+        important_count = sum(important for _, important in pending)
+        room = {True: self.budget, False: max(0, self.budget - important_count)}
+        shown = []
+        for message, important in reversed(pending):
+            if room[important]:
+                shown.append(message)
+                room[important] -= 1
+        shown.reverse()
+        return shown, len(pending) - len(shown)
+
+    def update(self):
+        """Write everything queued since the last update in one go"""
+        self.scheduled = None
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        shown, collapsed = self.select(pending)
+        lines = [f"...{collapsed} more messages"] if collapsed else []
+        lines += [line for line in map(self.format_message, shown) if line is not None]
+        start = time.perf_counter()
+        self.out.write(''.join(line + '\n' for line in lines))
+        self.out.flush()
+        elapsed = time.perf_counter() - start
+        if elapsed > self.interval / 2:
+            self.budget = max(MIN_FRAME_LINES, self.budget // 2)
+        elif collapsed:
+            self.budget = min(self.max_lines, self.budget + MIN_FRAME_LINES)
+        self.displayed += len(shown)
+        self.collapsed += collapsed
+        self.updates += 1
+        try:
+            self.last_update = asyncio.get_running_loop().time()
+        except RuntimeError:
+            pass  # Final update after the loop stopped
+
+    def close(self):
+        """Write what is still queued and stop updating"""
+        if self.scheduled is not None:
+            self.scheduled.cancel()
+        self.update()
+
+    def summary(self):
+        """One line for when the client exits"""
+        return (f"Displayed {self.displayed} messages in {self.updates} updates, "
+                f"collapsed {self.collapsed} to keep up")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Chat room membership index.
+Keeps room -> members and member -> rooms maps so room messages only
+touch the room's members and a disconnecting user can be removed from
+every room without scanning them all.
+"""
+
+import threading
+
+MAX_ROOM_NAME_LENGTH = 64
+
+
+def normalize_room_name(name):
+    """Return the canonical room name, or None if the name is invalid"""
+    name = name.strip().lstrip('#')
+    if not name or len(name) > MAX_ROOM_NAME_LENGTH or any(c.isspace() for c in name):
+        return None
+    return name
+
+
+class RoomIndex:
+    """Thread-safe room membership index with cached member listings"""
+
+    def __init__(self):
+        """Initialize an empty index"""
+        self.members = {}  # {room: set of usernames}
+        self.user_rooms = {}  # {username: set of rooms}
+        self.listings = {}  # {room: cached "a, b, c" member listing}
+        self.lock = threading.Lock()
+
+    def join(self, username, room):
+        """Add a user to a room, returning False if already a member"""
+        with self.lock:
+            members = self.members.setdefault(room, set())
+            if username in members:
+                return False
+            members.add(username)
+            self.user_rooms.setdefault(username, set()).add(room)
+            self.listings.pop(room, None)
+            return True
+
+    def leave(self, username, room):
+        """Remove a user from a room, returning False if not a member"""
+        with self.lock:
+            members = self.members.get(room)
+            if not members or username not in members:
+                return False
+            self._remove(username, room)
+            rooms = self.user_rooms[username]
+            rooms.discard(room)
+            if not rooms:
+                del self.user_rooms[username]
+            return True
+
+    def leave_all(self, username):
+        """Remove a user from every room, returning the rooms left"""
+        with self.lock:
+            rooms = self.user_rooms.pop(username, set())
+            for room in rooms:
+                self._remove(username, room)
+            return rooms
+
+    def _remove(self, username, room):
+        """Drop a member from a room and forget the room once empty"""
+        members = self.members[room]
+        members.discard(username)
+        if not members:
+            del self.members[room]
+        self.listings.pop(room, None)
+
+    def is_member(self, username, room):
+        """Check whether a user is in a room"""
+        return username in self.members.get(room, ())
+
+    def room_members(self, room):
+        """Return a snapshot of a room's members"""
+        with self.lock:
+            return tuple(self.members.get(room, ()))
+
+    def rooms_of(self, username):
+        """Return the sorted rooms a user belongs to"""
+        with self.lock:
+            return sorted(self.user_rooms.get(username, ()))
+
+    def listing(self, room):
+        """Return the room's members as a sorted, comma separated string.
+
+        The string is cached until the room's membership changes, so
+        repeated listings cost a dict lookup.
+        """
+        listing = self.listings.get(room)
+        if listing is None:
+            with self.lock:
+                listing = ', '.join(sorted(self.members.get(room, ())))
+                self.listings[room] = listing
+        return listing
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Full-text search over the message log.
+
+SearchIndex is an inverted index from lowercased words to the sequence
+numbers of the logged messages containing them; senders are indexed as
+'@name' terms so "from:" filters are just another posting list. It is
+updated as each message is appended to the log.
+
+Posting lists are kept compact: each is a bytearray holding the last
+sequence number (8 bytes) followed by the gaps between successive
+sequence numbers as varints, so a posting usually costs one or two
+bytes. The index is saved next to the log and, on startup, loaded and
+caught up with whatever was logged after the last save.
+
+Searches copy the posting lists they need under the lock and do the
+decoding, intersecting and log reads outside it, so indexing (and with
+it message delivery) only ever waits for a memory copy.
+"""
+
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+from history import audience_hash
+from protocol import decode_json
+
+INDEX_FILE = 'search.idx'
+MAGIC = b'CSI1'
+FILE_HEADER = struct.Struct('>4sQQI')  # magic, next sequence number to index, messages, term count
+TERM_HEADER = struct.Struct('>HI')  # term length, posting list length
+LAST = struct.Struct('<Q')  # Last sequence number at the start of every posting list
+TOKEN = re.compile(r'\w+')
+MAX_TERM_LENGTH = 32
+INDEXED_TYPES = ('message', 'private')
+DEFAULT_SAVE_INTERVAL = 60.0
+DEFAULT_RESULT_LIMIT = 20
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def tokenize(text):
+    """Distinct lowercase words of text"""
+    return {word for word in TOKEN.findall(text.lower()) if len(word) <= MAX_TERM_LENGTH}
+
+
+def sender_term(username):
+    """Term under which a sender's messages are indexed; never a word"""
+    return '@' + username.lower()
+
+
+def decode_postings(data):
+    """Sequence numbers stored in a posting list, ascending"""
+    seqs = []
+    seq = -1
+    value = shift = 0
+    for byte in data[LAST.size:]:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            seq += value + 1
+            seqs.append(seq)
+            value = shift = 0
+    return seqs
+
+
+def parse_time(value):
+    """Epoch milliseconds for '2h'-style durations ago or a 'YYYY-MM-DD[THH:MM]' local time"""
+    unit = DURATION_UNITS.get(value[-1:])
+    if unit and value[:-1].isdigit():
+        return int((time.time() - int(value[:-1]) * unit) * 1000)
+    for pattern in ('%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(value, pattern)) * 1000)
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown time '{value}', use e.g. 2h, 3d or 2026-01-31T14:00")
+
+
+def parse_query(text):
+    """Split '/search' arguments into (words, sender, after ms, before ms)"""
+    words = []
+    sender = after = before = None
+    for part in text.split():
+        key, _, value = part.partition(':')
+        if key == 'from' and value:
+            sender = value
+        elif key == 'after' and value:
+            after = parse_time(value)
+        elif key == 'before' and value:
+            before = parse_time(value)
+        else:
+            words.extend(tokenize(part))
+    return words, sender, after, before
+
+
+class SearchIndex:
+    """Incremental inverted index over a MessageLog, saved in its directory"""
+
+    def __init__(self, log, save_interval=DEFAULT_SAVE_INTERVAL):
+        """Load the saved index for log, catch it up and start saving periodically"""
+        self.log = log
+        self.path = os.path.join(log.directory, INDEX_FILE)
+        self.postings = {}  # {term: bytearray of last seq + varint gaps}
+        self.next_seq = 0  # Log records before this one are indexed
+        self.messages = 0  # Messages indexed
+        self.dirty = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.load()
+        self.catch_up()
+        if save_interval:
+            threading.Thread(target=self.save_loop, args=(save_interval,), daemon=True).start()
+
+    # Indexing
+
+    def append(self, frame, message, audience=()):
+        """Append a framed message to the log and index it, returning its sequence number"""
+        with self.lock:
+            seq = self.log.append(frame, audience=audience)
+            self.add(seq, message)
+        return seq
+
+    def add(self, seq, message):
+        """Index one logged message; the caller holds the lock"""
+        self.next_seq = seq + 1
+        if message.get('type') not in INDEXED_TYPES:
+            return
+        terms = tokenize(message.get('message', ''))
+        if message.get('sender'):
+            terms.add(sender_term(message['sender']))
+        postings = self.postings
+        for term in terms:
+            data = postings.get(term)
+            if data is None:
+                data = postings[term] = bytearray(LAST.size)
+                gap = seq
+            else:
+                gap = seq - LAST.unpack_from(data)[0] - 1
+            LAST.pack_into(data, 0, seq)
+            while gap >= 0x80:
+                data.append(gap & 0x7f | 0x80)
+                gap >>= 7
+            data.append(gap)
+        self.messages += 1
+        self.dirty = True
+
+    def catch_up(self):
+        """Index the log records written since the index was last saved"""
+        if self.next_seq > self.log.next_seq:
+            # The log lost records the index knew about: start over
+            self.postings, self.next_seq, self.messages = {}, 0, 0
+        with self.lock:
+            for seq, timestamp, audience, frame in self.log.records(self.next_seq):
+                self.add(seq, decode_json(frame[4:]))
+
+    # Searching
+
+    def search(self, query, username, limit=DEFAULT_RESULT_LIMIT):
+        """Return up to limit (timestamp ms, message) matches visible to username, newest first"""
+        words, sender, after, before = parse_query(query)
+        terms = words + ([sender_term(sender)] if sender else [])
+        if not terms:
+            return []
+        with self.lock:
+            lists = [self.postings.get(term) for term in terms]
+            if any(data is None for data in lists):
+                return []
+            lists = [bytes(data) for data in lists]  # Copied so indexing can go on meanwhile
+        lists.sort(key=len)
+        matches = set(decode_postings(lists[0]))
+        for data in lists[1:]:
+            if not matches:
+                return []
+            matches.intersection_update(decode_postings(data))
+        self.log.flush()
+        own_hash = audience_hash(username)
+        results = []
+        for seq in sorted(matches, reverse=True):
+            timestamp, audience, frame = self.log.read(seq)
+            if before is not None and timestamp >= before:
+                continue
+            if after is not None and timestamp < after:
+                break  # Older messages all come earlier in the log
+            if audience[0] and own_hash not in audience:
+                continue  # Someone else's private message
+            message = decode_json(frame[4:])
+            if audience[0] and username not in (message.get('sender'), message.get('target')):
+                continue
+            results.append((timestamp, message))
+            if len(results) == limit:
+                break
+        return results
+
+    # Persistence
+
+    def load(self):
+        """Read the saved index, if there is a usable one"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            magic, next_seq, messages, count = FILE_HEADER.unpack_from(data)
+            if magic != MAGIC:
+                return
+            postings = {}
+            offset = FILE_HEADER.size
+            for _ in range(count):
+                term_length, data_length = TERM_HEADER.unpack_from(data, offset)
+                offset += TERM_HEADER.size
+                term = data[offset:offset + term_length].decode('utf-8')
+                offset += term_length
+                postings[term] = bytearray(data[offset:offset + data_length])
+                offset += data_length
+        except (OSError, struct.error, UnicodeDecodeError):
+            return  # Missing or damaged: rebuilt from the log
+        self.postings, self.next_seq, self.messages = postings, next_seq, messages
+
+    def save(self):
+        """Write the index next to the log, replacing the previous save"""
+        with self.lock:
+            if not self.dirty:
+                return
+            parts = [FILE_HEADER.pack(MAGIC, self.next_seq, self.messages, len(self.postings))]
+            for term, data in self.postings.items():
+                encoded = term.encode('utf-8')
+                parts += (TERM_HEADER.pack(len(encoded), len(data)), encoded, bytes(data))
+            self.dirty = False
+            # The log must hold every record the saved index refers to
+            self.log.flush()
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'wb') as f:
+            f.writelines(parts)
+        self.log.flush(sync=True)
+        os.replace(temporary, self.path)
+
+    def save_loop(self, interval):
+        """Save the index every interval seconds while it changes"""
+        while not self.closed:
+            time.sleep(interval)
+            if not self.closed:
+                try:
+                    self.save()
+                except OSError as e:
+                    print(f"Error saving search index: {e}")
+
+    def close(self):
+        """Save the index one last time"""
+        self.save()
+        self.closed = True
+
+    # Reporting
+
+    def memory(self):
+        """Approximate bytes of memory held by the index"""
+        with self.lock:
+            items = list(self.postings.items())
+        size = sys.getsizeof(self.postings)
+        for term, data in items:
+            size += sys.getsizeof(term) + sys.getsizeof(data)
+        return size
+
+    def summary(self):
+        """One line for /stats"""
+        size = self.memory()
+        per_million = size / self.messages * 1_000_000 if self.messages else 0
+        return (f"Search index: {self.messages} messages, {len(self.postings)} terms, "
+                f"{size / 2**20:.1f} MiB ({per_million / 2**20:.0f} MiB per million messages)")
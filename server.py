@@ -5,131 +5,701 @@ Handles multiple client connections and supports:
 - Broadcast messages to all clients
 - List connected users
 - Private messages between users
+
+Two engines are available: 'threaded' runs one thread per client and
+'asyncio' runs every connection on a single event loop.
+
+A running server can hand its listening socket and clients over to a new
+process (--handoff-path and --takeover) for restarts without disconnects.
+Clients that ask for a resumable session can also reconnect after a
+dropped connection and pick up where they left off (see sessions.py).
 """
 
+import argparse
+import asyncio
+import gc
+import os
 import socket
 import threading
-import json
 import time
 
+from cluster import ClusterLink, run_cluster
+from federation import FederationNode
+from handoff import DRAIN_TIMEOUT, HandoffListener, decode_bytes, take_over
+from connection import (AsyncioConnection, ThreadedConnection, WriteStats, SLOW_CONSUMER_POLICIES,
+                        DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK)
+from history import MessageLog, DEFAULT_FSYNC_INTERVAL_MS, FSYNC_POLICIES, audience_hash
+from inbox import DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_BYTES, DEFAULT_MAX_MESSAGES, Inbox
+from metrics import Metrics, DEFAULT_DUMP_INTERVAL
+from presence import DEFAULT_PRESENCE_WINDOW, PresenceDigest
+from protocol import (COMPRESSIONS, DEFAULT_COMPRESS_THRESHOLD, DEFAULT_MAX_FRAME_SIZE, ENCODINGS,
+                      FRAMING_LENGTH, InternTable, Payload, decode_json, decode_message, raw_broadcast,
+                      raw_private, scan_envelope, timestamp)
+from ratelimit import CATEGORIES, DEFAULT_LIMITS, DESCRIPTIONS, RateLimiter, categorize, parse_limit
+from registry import ClientRegistry, format_listing, paginate
+from rooms import RoomIndex, normalize_room_name
+from search import SearchIndex
+from sessions import DEFAULT_REPLAY_BUFFER, DEFAULT_RESUME_GRACE, SessionTable
+from timers import (DEFAULT_HANDSHAKE_TIMEOUT, DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_HEARTBEAT_TIMEOUT,
+                    DEFAULT_IDLE_TIMEOUT, HEARTBEAT_TYPES, Heartbeats)
+
+ENGINES = ('threaded', 'asyncio')
+INBOX_BATCH_BYTES = 64 * 1024  # Inbox delivery writes at most this much at once
+INBOX_RETRY_DELAY = 0.01  # Seconds to wait for a backed up connection during inbox delivery
+MAX_TARGET_LENGTH = 256  # Longest username a private message can be addressed to
+
 class ChatServer:
-    def __init__(self, host='localhost', port=12345):
-        """Initialize the chat server with host and port"""
+    def __init__(self, host='localhost', port=12345, engine='threaded', backlog=128,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE, high_watermark=DEFAULT_HIGH_WATERMARK,
+                 low_watermark=DEFAULT_LOW_WATERMARK, slow_consumer='disconnect', coalesce_delay_ms=0,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 history_dir=None, history_fsync='interval', history_fsync_ms=DEFAULT_FSYNC_INTERVAL_MS,
+                 history_replay=50, search=False,
+                 inbox_dir=None, inbox_max_messages=DEFAULT_MAX_MESSAGES, inbox_max_bytes=DEFAULT_MAX_BYTES,
+                 inbox_max_age_days=DEFAULT_MAX_AGE_DAYS,
+                 reuse_port=False, cluster_path=None, worker_id=0, federation_port=None, peers=(),
+                 metrics=False, metrics_file=None, metrics_interval=DEFAULT_DUMP_INTERVAL, admins=(),
+                 rate_limits=DEFAULT_LIMITS, global_rate_limits=None,
+                 presence_window=DEFAULT_PRESENCE_WINDOW, fast_path=True,
+                 handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 resume_grace=DEFAULT_RESUME_GRACE, resume_buffer=DEFAULT_REPLAY_BUFFER,
+                 handoff_path=None, takeover=None):
+        """Initialize the chat server with host, port and engine"""
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of: {', '.join(ENGINES)}")
+        if slow_consumer not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy '{slow_consumer}', "
+                             f"expected one of: {', '.join(SLOW_CONSUMER_POLICIES)}")
+        if not 0 <= low_watermark <= high_watermark:
+            raise ValueError("low_watermark must be between 0 and high_watermark")
         self.host = host
         self.port = port
-        self.clients = {}  # Dictionary to store client connections {username: socket}
+        self.engine = engine
+        self.backlog = backlog
+        self.max_frame_size = max_frame_size  # Larger frames disconnect the client
+        self.high_watermark = high_watermark  # Outbound bytes queued before a client counts as slow
+        self.low_watermark = low_watermark  # Outbound bytes at which a dropping client recovers
+        self.slow_consumer = slow_consumer  # 'disconnect' or 'drop' once past the high watermark
+        self.coalesce_delay = coalesce_delay_ms / 1000  # Extra wait for frames to batch into one send
+        self.compress_threshold = compress_threshold  # Smallest frame compressed for clients that asked
+        self.write_stats = WriteStats()  # Frames per send call across all clients
+        self.clients = ClientRegistry()  # Connected clients {username: connection}, safe to iterate
+        self.connections = set()  # Every accepted connection, logged in or not
+        self.rooms = RoomIndex()  # Room memberships for targeted fan-out
+        self.interns = InternTable()  # Name ids shared by every binary-encoding client
+        # Sockets and client state taken over from the old process, if restarting
+        self.takeover = takeover
+        if takeover:
+            for name in takeover.interns:
+                self.interns.intern(name)  # Same ids as before, clients already know them
+        self.fast_path = fast_path  # Route plain messages without decoding their text
+        self.presence = PresenceDigest(self, presence_window)  # Join/leave notices, coalesced
+        # Handshake deadlines, heartbeats and idle timeouts, all on one timing wheel
+        self.heartbeats = Heartbeats(self, handshake_timeout, heartbeat_interval, heartbeat_timeout, idle_timeout)
+        # Sessions kept through short disconnects, expired on the same wheel; None when disabled
+        self.sessions = SessionTable(resume_grace, resume_buffer) if resume_grace > 0 else None
+        # On-disk log of broadcast and private messages, replayed on join
+        self.history = (MessageLog(history_dir, fsync=history_fsync, fsync_interval_ms=history_fsync_ms)
+                        if history_dir else None)
+        self.history_replay = history_replay  # Messages replayed to a joining user by default
+        # Inverted index over the history for /search, saved next to the log
+        self.search = SearchIndex(self.history) if search and self.history else None
+        # On-disk private messages for offline users, delivered when they log in
+        self.inbox = Inbox(inbox_dir, inbox_max_messages, inbox_max_bytes, inbox_max_age_days) if inbox_dir else None
+        self.reuse_port = reuse_port  # Share the port with other worker processes
+        self.cluster_path = cluster_path  # Unix socket of the cluster hub, if any
+        self.worker_id = worker_id
+        self.federation_port = federation_port  # Port for links to other server nodes, if federated
+        self.peers = peers  # (host, port) of federation nodes to connect to
+        self.cluster = None  # ClusterLink or FederationNode routing to other servers
         self.server_socket = None
+        self.loop = None  # Event loop used by the asyncio engine
+        # Unix socket a new process connects to in order to take over
+        self.handoff = HandoffListener(self, handoff_path) if handoff_path else None
+        # Flood control checked before fan-out; None when nothing is limited
+        self.limiter = None
+        if any(rate > 0 for rate, burst in (rate_limits or {}).values()) or global_rate_limits:
+            self.limiter = RateLimiter(rate_limits or {}, global_rate_limits)
+        self.admins = set(admins)  # Usernames allowed to run admin commands
+        # Handler timing and counters; left as None, nothing is instrumented
+        self.metrics = None
+        if metrics or metrics_file:
+            self.metrics = Metrics(self, metrics_file, metrics_interval)
+            self.metrics.instrument()
         
+    def create_listen_socket(self):
+        """Create, bind and listen on the server socket"""
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.backlog)
+        return self.server_socket
+    
+    def open_listen_socket(self):
+        """Listen on a new socket, or on the one taken over from the old process"""
+        if self.takeover:
+            self.server_socket = self.takeover.listen_socket
+            return self.server_socket
+        return self.create_listen_socket()
+    
     def start_server(self):
         """Start the server and listen for client connections"""
+        if self.engine == 'asyncio':
+            self.start_asyncio_server()
+            return
+        
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.open_listen_socket()
+            self.connect_cluster()
+            self.heartbeats.start(needed=self.sessions is not None)
+            if self.takeover:
+                self.adopt_clients()
+            if self.handoff:
+                self.handoff.start()
             
             print(f"Chat server started on {self.host}:{self.port}")
             print("Waiting for client connections...")
             
+            poller = self.handoff.poller(self.server_socket) if self.handoff else None
             while True:
+                if poller:
+                    poller.poll()
+                    if self.handoff.started:
+                        self.handoff.accept_stopped.set()
+                        threading.Event().wait()  # The handoff thread ends the process
                 client_socket, client_address = self.server_socket.accept()
                 print(f"New connection from {client_address}")
                 
                 # Start a new thread to handle this client
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, client_address)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+                connection = ThreadedConnection(self, client_socket, client_address)
+                self.connections.add(connection)
+                self.heartbeats.watch(connection)
+                self.start_reader(connection)
                 
         except Exception as e:
             print(f"Error starting server: {e}")
         finally:
             self.cleanup_server()
     
-    def handle_client(self, client_socket, client_address):
+    def start_asyncio_server(self):
+        """Start the server with every connection on one asyncio event loop"""
+        try:
+            asyncio.run(self.serve_asyncio())
+        except Exception as e:
+            print(f"Error starting server: {e}")
+        finally:
+            self.cleanup_server()
+    
+    async def serve_asyncio(self):
+        """Accept and serve client connections on the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        listen_socket = self.open_listen_socket()
+        listen_socket.setblocking(False)
+        self.connect_cluster()
+        self.heartbeats.start(needed=self.sessions is not None)
+        if self.takeover:
+            await self.adopt_clients_async()
+        if self.handoff:
+            self.handoff.start()
+        server = await self.loop.create_server(
+            lambda: AsyncioConnection(self), sock=listen_socket, backlog=self.backlog)
+        
+        print(f"Chat server started on {self.host}:{self.port} (asyncio engine)")
+        print("Waiting for client connections...")
+        
+        async with server:
+            await server.serve_forever()
+    
+    def start_reader(self, connection, adopted=False):
+        """Serve a threaded connection on a thread of its own"""
+        connection.reader = threading.Thread(target=self.handle_client,
+                                             args=(connection, connection.address, adopted))
+        connection.reader.daemon = True
+        connection.reader.start()
+    
+    def adopt(self, connection, state):
+        """Serve a connection taken over from the old process, without announcing it"""
+        self.connections.add(connection)
+        self.heartbeats.watch(connection)
+        if connection.username is not None:
+            self.clients.add(connection.username, connection)
+            for room in state['rooms']:
+                self.rooms.join(connection.username, room)
+            if state.get('session') and self.sessions is not None:
+                # Numbering carries on; the replay buffer starts out empty
+                token, seq = state['session']
+                self.sessions.create(connection.username, connection, token, seq)
+        outbound = decode_bytes(state['outbound'])
+        if outbound:
+            connection.write(outbound)
+    
+    def adopt_clients(self):
+        """Take over the old process's connections on the threaded engine"""
+        gc.disable()  # Collections would only trace the new connections over and over
+        try:
+            for sock, state in self.takeover.clients:
+                connection = ThreadedConnection(self, sock, tuple(state['address']))
+                connection.restore(state)
+                self.adopt(connection, state)
+                self.start_reader(connection, adopted=True)
+        finally:
+            gc.enable()
+        print(self.takeover.summary())
+    
+    async def adopt_clients_async(self):
+        """Take over the old process's connections on the event loop"""
+        async def adopt_one(sock, state):
+            connection = AsyncioConnection(self, adopted=True)
+            connection.restore(state)
+            await self.loop.connect_accepted_socket(lambda: connection, sock)
+            self.adopt(connection, state)
+            connection.buffer_updated(0)  # Frames completed before the handoff, if any
+        gc.disable()  # Collections would only trace the new connections over and over
+        try:
+            await asyncio.gather(*(adopt_one(sock, state) for sock, state in self.takeover.clients))
+        finally:
+            gc.enable()
+        print(self.takeover.summary())
+    
+    def freeze(self):
+        """Stop accepting, reading and writing so the connections can be handed off.
+        
+        Called from the handoff thread. Returns the connections to hand
+        off and how many were dropped because they could not be frozen
+        within DRAIN_TIMEOUT.
+        """
+        if self.loop is not None:
+            return asyncio.run_coroutine_threadsafe(self.freeze_async(), self.loop).result()
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        # The handoff woke every poller: the accept loop and readers stop
+        self.handoff.accept_stopped.wait(DRAIN_TIMEOUT)
+        connections = list(self.connections)
+        for connection in connections:
+            if connection.reader is not None:
+                connection.reader.join(max(0, deadline - time.monotonic()))
+        self.presence.flush()
+        for connection in connections:
+            connection.freeze()
+        for connection in connections:
+            connection.writer.join(max(0, deadline - time.monotonic()))
+        return self.settle(connections)
+    
+    async def freeze_async(self):
+        """freeze() on the event loop"""
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        self.loop.remove_reader(self.server_socket.fileno())
+        connections = list(self.connections)
+        for connection in connections:
+            connection.transport.pause_reading()
+        self.presence.flush()
+        for connection in connections:
+            connection.freeze()
+        while time.monotonic() < deadline and not all(
+                connection.closed or connection.settled() for connection in connections):
+            await asyncio.sleep(0.01)
+        return self.settle(connections)
+    
+    def settle(self, connections):
+        """Split frozen connections into those ready to hand off and a count of the others, which are dropped"""
+        ready = []
+        dropped = 0
+        for connection in connections:
+            if connection.closed:
+                continue
+            if connection.settled():
+                ready.append(connection)
+            else:
+                connection.abort()
+                dropped += 1
+        return ready, dropped
+    
+    def connect_cluster(self):
+        """Join the cluster hub or the federation, if configured"""
+        if self.cluster_path:
+            self.cluster = ClusterLink(self, self.cluster_path, self.worker_id)
+            print(f"Worker {self.worker_id} connected to cluster hub")
+        elif self.federation_port:
+            self.cluster = FederationNode(self, self.host, self.federation_port, self.peers)
+            print(f"Federation node {self.cluster.node_id} started")
+    
+    def call_in_engine(self, function, *args):
+        """Run function on the engine's thread of control.
+        
+        The asyncio engine only allows its event loop to touch connections,
+        so calls from other threads are scheduled onto it.
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(function, *args)
+        else:
+            function(*args)
+    
+    def call_blocking(self, client_socket, function, args, then):
+        """Make a call that waits on another process, then pass its result to then.
+        
+        The threaded engine makes the call on the client's reader thread,
+        which only holds up that client. The event loop must not wait, so
+        the asyncio engine makes it on an executor thread and holds back
+        the client's later frames until then has run on the loop: they
+        are still handled in order, and nobody else waits.
+        """
+        if self.loop is None:
+            then(function(*args))
+            return
+        client_socket.hold()
+        
+        def finish(future):
+            try:
+                then(future.result())
+            except Exception as e:
+                print(f"Error handling client {client_socket.username}: {e}")
+                client_socket.close()
+            finally:
+                client_socket.release()
+        
+        self.loop.run_in_executor(None, function, *args).add_done_callback(finish)
+    
+    def handle_client(self, client_socket, client_address, adopted=False):
         """Handle individual client connection"""
-        username = None
+        username = client_socket.username  # Already set for clients taken over logged in
         try:
             # Get username from client
-            welcome_msg = {"type": "system", "message": "Enter your username:"}
-            client_socket.send(json.dumps(welcome_msg).encode('utf-8'))
-            
-            username_data = client_socket.recv(1024).decode('utf-8')
-            username_msg = json.loads(username_data)
-            username = username_msg.get('username', f"User_{client_address[1]}")
-            
-            # Add client to the clients dictionary
-            self.clients[username] = client_socket
-            
-            # Notify all clients about new user
-            join_msg = {
-                "type": "system",
-                "message": f"{username} joined the chat",
-                "timestamp": time.strftime("%H:%M:%S")
-            }
-            self.broadcast_message(join_msg, exclude_user=username)
-            
-            # Send welcome message to the new user
-            welcome_msg = {
-                "type": "system", 
-                "message": f"Welcome {username}! Type '/help' for commands.",
-                "timestamp": time.strftime("%H:%M:%S")
-            }
-            client_socket.send(json.dumps(welcome_msg).encode('utf-8'))
+            frames = client_socket.receive_frames()
+            if not adopted:
+                self.send_username_prompt(client_socket)
+            while username is None:
+                frame = next(frames, None)
+                if frame is None:
+                    return
+                username = self.register_client(client_socket, client_address, frame[1])
             
             # Handle client messages
-            while True:
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
-                    break
-                    
-                message_data = json.loads(data)
-                self.process_message(username, message_data)
+            for flags, payload in frames:
+                self.handle_frame(client_socket, flags, payload)
                 
         except Exception as e:
             print(f"Error handling client {username}: {e}")
         finally:
-            self.disconnect_client(username, client_socket)
+            if not (self.handoff and self.handoff.started):
+                self.disconnect_client(username, client_socket)
+    
+    def send_username_prompt(self, client_socket):
+        """Ask a freshly connected client for its username"""
+        welcome_msg = {"type": "system", "message": "Enter your username:"}
+        client_socket.send_message(welcome_msg)
+    
+    def register_client(self, client_socket, client_address, username_data):
+        """Complete the username handshake and return the username.
+        
+        Returns None, after asking for another name, if the username is
+        already taken.
+        """
+        username_msg = decode_json(username_data)
+        username = username_msg.get('username', f"User_{client_address[1]}")
+        
+        # Answer in the framing the client used for its handshake
+        client_socket.framing = client_socket.decoder.framing
+        encoding = username_msg.get('encoding')
+        compression = username_msg.get('compression')
+        if client_socket.framing != FRAMING_LENGTH:
+            encoding = compression = None  # Both need the flags of length-prefixed frames
+        if encoding not in ENCODINGS:
+            encoding = ENCODINGS[0]
+        if compression not in COMPRESSIONS:
+            compression = None
+        try:
+            # The client numbers its list_users requests across reconnects
+            client_socket.users_requests = max(0, int(username_msg.get('users_requests', 0)))
+        except (TypeError, ValueError):
+            pass
+        self.heartbeats.logged_in(client_socket, username_msg.get('heartbeat') is True)
+        # Sessions number messages in the frame flags, so they need length-prefixed frames too
+        resumable = (self.sessions is not None and client_socket.framing == FRAMING_LENGTH
+                     and bool(username_msg.get('resume') or 'session' in username_msg))
+        if resumable and 'session' in username_msg and self.resume_session(
+                client_socket, username, username_msg, encoding, compression):
+            return username
+        
+        # Add client to the clients dictionary unless the name is in use
+        def claimed(ok):
+            if ok:
+                self.welcome_client(client_socket, username, username_msg, encoding, compression, resumable)
+                return
+            taken_msg = {
+                "type": "system",
+                "error": "username_taken",
+                "message": f"Username '{username}' is already taken, please choose another:"
+            }
+            client_socket.send_message(taken_msg)
+        
+        self.claim_username(username, client_socket, claimed)
+        return client_socket.username  # Still None while a cluster claim is under way
+    
+    def welcome_client(self, client_socket, username, username_msg, encoding, compression, resumable):
+        """Log in a client that claimed its username: welcome, announce and catch it up"""
+        client_socket.username = username
+        client_socket.encoding = encoding
+        client_socket.compression = compression
+        client_socket.presence = username_msg.get('presence', True) is not False
+        
+        # Send welcome message to the new user, ahead of the join notice at least
+        welcome_msg = {
+            "type": "system", 
+            "message": f"Welcome {username}! Type '/help' for commands.",
+            "timestamp": timestamp(),
+            "encoding": encoding,
+            "compression": compression
+        }
+        if resumable:
+            welcome_msg["session"] = self.sessions.create(username, client_socket).token
+            welcome_msg["resumed"] = False
+            client_socket.deliver(Payload(welcome_msg))  # Not numbered, like the welcome back
+        else:
+            client_socket.send_message(welcome_msg)
+        
+        # Notify all clients about new user
+        self.presence.joined(username)
+        
+        # Catch the new user up on what was said before they joined
+        if self.history:
+            self.replay_history(client_socket, username, username_msg)
+        # ... and hand over the private messages that arrived while they were away
+        if self.inbox and self.inbox.pending(username):
+            self.deliver_inbox(client_socket, username)
+    
+    def resume_session(self, client_socket, username, username_msg, encoding, compression):
+        """Hand a user's session over to their new connection and send what they missed.
+        
+        Returns False, leaving the client to log in afresh, if the token
+        does not match a session of that user or the session expired.
+        """
+        session = self.sessions.find(username_msg['session'], username)
+        previous = self.clients.get(username)
+        if session is None or previous is None or previous.session is not session:
+            return False
+        try:
+            last_seq = int(username_msg.get('last_seq', 0))
+        except (TypeError, ValueError):
+            last_seq = 0
+        client_socket.username = username
+        client_socket.encoding = encoding
+        client_socket.compression = compression
+        client_socket.presence = previous.presence
+        welcome_msg = {
+            "type": "system",
+            "message": f"Welcome back {username}!",
+            "timestamp": timestamp(),
+            "encoding": encoding,
+            "compression": compression,
+            "session": session.token,
+            "resumed": True
+        }
+        resumed = self.sessions.resume(session, client_socket, last_seq, welcome_msg)
+        if resumed is None:
+            client_socket.username = None
+            return False
+        # Same name, rooms and place in the user list: nobody is told anything
+        self.clients.replace(username, previous, client_socket)
+        if not previous.closed:
+            previous.abort()  # The client gave up on it before the server noticed
+        print(f"{username} resumed their session ({resumed[0]} missed messages sent, {resumed[1]} lost)")
+        return True
+    
+    def claim_username(self, username, client_socket, then):
+        """Register client_socket under username if no one else uses it, then call then(claimed)"""
+        if username in self.clients or not self.cluster:
+            then(self.clients.add(username, client_socket))
+            return
+        
+        def claimed(ok):
+            if ok and client_socket.closed:
+                self.cluster.release_username(username)  # Gave up waiting for us
+                return
+            then(ok and self.clients.add(username, client_socket))
+        
+        # The other servers settle races for the name, so no lock is held meanwhile
+        self.call_blocking(client_socket, self.cluster.claim_username, (username,), claimed)
+    
+    def replay_history(self, client_socket, username, username_msg):
+        """Stream logged messages to a joining user straight from the log segments.
+        
+        The handshake may ask for the last 'history' messages or for
+        everything 'since' an epoch-millisecond timestamp.
+        """
+        if 'since' in username_msg:
+            records = self.history.since(int(username_msg['since']))
+        else:
+            count = min(int(username_msg.get('history', self.history_replay)), self.history_replay)
+            records = self.history.last(count)
+        
+        own_hash = audience_hash(username)
+        for seq, sent_ms, audience, frame in records:
+            if audience[0]:
+                # Private message: only its sender and target may see it
+                if own_hash not in audience:
+                    continue
+                message = decode_json(frame[4:])
+                if username not in (message.get('sender'), message.get('target')):
+                    continue
+            if client_socket.framing == FRAMING_LENGTH:
+                client_socket.send(frame)
+            else:
+                client_socket.send(bytes(frame[4:]) + b'\n')
+    
+    def deliver_inbox(self, client_socket, username):
+        """Start sending a user's waiting private messages"""
+        frames = self.inbox.read(username)
+        if frames:
+            self.send_system_message(username, f"You have {len(frames)} private messages from while you were away")
+            self.send_inbox_batches(client_socket, username, frames, 0)
+    
+    def send_inbox_batches(self, client_socket, username, frames, start):
+        """Send inbox frames in batches, waiting for the connection to drain in between.
+        
+        The threaded engine waits on the user's own thread; the asyncio
+        engine reschedules itself, so a large backlog never holds up other
+        connections or trips the slow-consumer policy.
+        """
+        while start < len(frames):
+            if client_socket.closed:
+                return  # Undelivered messages stay in the inbox
+            if client_socket.buffered_bytes() > client_socket.low_watermark:
+                if self.loop is not None:
+                    self.loop.call_later(INBOX_RETRY_DELAY, self.send_inbox_batches,
+                                         client_socket, username, frames, start)
+                    return
+                time.sleep(INBOX_RETRY_DELAY)
+                continue
+            end = start
+            size = 0
+            while end < len(frames) and (end == start or size + len(frames[end]) <= INBOX_BATCH_BYTES):
+                size += len(frames[end])
+                end += 1
+            if client_socket.framing == FRAMING_LENGTH:
+                batch = b''.join(frames[start:end])
+            else:
+                batch = b''.join(frame[4:] + b'\n' for frame in frames[start:end])
+            try:
+                client_socket.send(batch)
+            except OSError:
+                return
+            start = end
+        self.inbox.remove(username, len(frames))
+    
+    def handle_frame(self, client_socket, flags, payload):
+        """Decode one frame received from a logged-in client"""
+        if self.fast_path and not flags:
+            envelope = scan_envelope(payload)
+            if envelope is not None:
+                client_socket.last_message = client_socket.last_seen
+                self.route_message(client_socket.username, *envelope)
+                return
+        message = decode_message(flags, payload, client_socket.names, self.max_frame_size)
+        if message is None:
+            return  # A binary name definition
+        if message.get('type') in HEARTBEAT_TYPES:
+            self.heartbeats.answer(client_socket, message)
+            return
+        if message.get('type') == 'logout':
+            self.end_session(client_socket)
+            return
+        client_socket.last_message = client_socket.last_seen
+        self.process_message(client_socket.username, message)
     
     def process_message(self, sender, message_data):
         """Process different types of messages from clients"""
         message_type = message_data.get('type', 'message')
         content = message_data.get('message', '')
         
+        if self.limiter and not self.admit(sender, message_type, content):
+            if message_type == 'list_users':
+                # Answered all the same, as the client library waits for a reply to every request
+                self.answer_users_request(sender, {
+                    "type": "system",
+                    "error": "rate_limited",
+                    "message": "User list request dropped, you are sending them too fast",
+                    "timestamp": timestamp()
+                })
+            return
+        
         if message_type == 'message':
             if content.startswith('/'):
                 self.handle_command(sender, content)
             else:
                 # Regular broadcast message
-                broadcast_msg = {
+                self.send_broadcast(sender, Payload({
                     "type": "message",
                     "sender": sender,
                     "message": content,
-                    "timestamp": time.strftime("%H:%M:%S")
-                }
-                self.broadcast_message(broadcast_msg, exclude_user=sender)
+                    "timestamp": timestamp()
+                }))
         
         elif message_type == 'list_users':
-            self.send_user_list(sender)
+            # Optional "[prefix] [page]" arguments, as for /users
+            self.send_user_list(sender, *parse_users_arguments(content), numbered=True)
             
         elif message_type == 'private':
             target_user = message_data.get('target')
             self.send_private_message(sender, target_user, content)
+            
+        elif message_type == 'room':
+            self.send_room_message(sender, message_data.get('room', ''), content)
+    
+    def route_message(self, sender, message_type, target_user, body):
+        """Forward a broadcast or private message whose text is still JSON-encoded.
+        
+        The fast path for the bulk of the traffic: body is passed through
+        to the recipients' JSON frames as the client encoded it.
+        """
+        if self.limiter and not self.admit(sender, message_type, ''):
+            return
+        if message_type == 'message':
+            self.send_broadcast(sender, raw_broadcast(sender, body))
+        else:
+            self.send_private_payload(sender, target_user, raw_private(sender, target_user, body))
+    
+    def send_broadcast(self, sender, broadcast_msg):
+        """Log a user's broadcast and send it to everyone else"""
+        if self.history:
+            self.log_message(broadcast_msg)
+        self.publish_message(broadcast_msg, exclude_user=sender)
+    
+    def admit(self, sender, message_type, content):
+        """Check a message against the rate limits, telling a flooding client once"""
+        category = categorize(message_type, content)
+        client_socket = self.clients.get(sender)
+        if category is None or client_socket is None:
+            return True
+        if self.limiter.allow(client_socket, category):
+            if client_socket.throttled:
+                client_socket.throttled.discard(category)
+            return True
+        if category not in client_socket.throttled:
+            client_socket.throttled.add(category)
+            client_socket.send_message({
+                "type": "system",
+                "error": "rate_limited",
+                "message": f"You are sending {DESCRIPTIONS[category]} too fast, some were dropped",
+                "timestamp": timestamp()
+            })
+        return False
     
     def handle_command(self, sender, command):
         """Handle special commands from clients"""
         if command == '/help':
             help_msg = {
                 "type": "system",
-                "message": "Commands: /help, /users, /private <username> <message>",
-                "timestamp": time.strftime("%H:%M:%S")
+                "message": "Commands: /help, /users [prefix] [page], /private <username> <message>, "
+                           "/join <room>, /leave <room>, /room <room> <message>, /rooms, /members <room>, "
+                           "/search <words> [from:<username>] [after:<time>] [before:<time>]",
+                "timestamp": timestamp()
             }
-            self.clients[sender].send(json.dumps(help_msg).encode('utf-8'))
+            self.clients[sender].send_message(help_msg)
             
-        elif command == '/users':
-            self.send_user_list(sender)
+        elif command == '/users' or command.startswith('/users '):
+            self.send_user_list(sender, *parse_users_arguments(command[7:]))
             
         elif command.startswith('/private'):
             parts = command.split(' ', 2)
@@ -141,93 +711,543 @@ class ChatServer:
                 error_msg = {
                     "type": "system",
                     "message": "Usage: /private <username> <message>",
-                    "timestamp": time.strftime("%H:%M:%S")
+                    "timestamp": timestamp()
                 }
-                self.clients[sender].send(json.dumps(error_msg).encode('utf-8'))
+                self.clients[sender].send_message(error_msg)
+                
+        elif command == '/join' or command.startswith('/join '):
+            self.join_room(sender, command[6:])
+            
+        elif command == '/leave' or command.startswith('/leave '):
+            self.leave_room(sender, command[7:])
+            
+        elif command == '/room' or command.startswith('/room '):
+            parts = command.split(' ', 2)
+            if len(parts) >= 3:
+                self.send_room_message(sender, parts[1], parts[2])
+            else:
+                self.send_system_message(sender, "Usage: /room <room> <message>")
+                
+        elif command == '/rooms':
+            rooms = self.rooms.rooms_of(sender)
+            listing = ', '.join('#' + room for room in rooms) if rooms else "none"
+            self.send_system_message(sender, f"Your rooms: {listing}")
+            
+        elif command == '/members' or command.startswith('/members '):
+            room = normalize_room_name(command[9:])
+            if room is None:
+                self.send_system_message(sender, "Usage: /members <room>")
+            else:
+                self.send_system_message(sender, f"Members of #{room}: {self.rooms.listing(room) or 'none'}")
+        
+        elif command == '/search' or command.startswith('/search '):
+            if not self.search:
+                self.send_system_message(sender, "Search is disabled, start the server with --history-dir and --search")
+            elif not command[8:].strip():
+                self.send_system_message(sender, "Usage: /search <words> [from:<username>] [after:<time>] [before:<time>]")
+            else:
+                self.search_history(sender, command[8:].strip())
+        
+        elif command == '/stats' and sender in self.admins:
+            if self.metrics:
+                self.send_system_message(sender, self.metrics.summary())
+            else:
+                self.send_system_message(sender, "Metrics are disabled, start the server with --metrics")
+        
+        else:
+            self.send_system_message(sender, f"Unknown command: {command.split(' ', 1)[0]}")
+    
+    def send_system_message(self, username, text):
+        """Send a timestamped system message to one user"""
+        system_msg = {
+            "type": "system",
+            "message": text,
+            "timestamp": timestamp()
+        }
+        self.clients[username].send_message(system_msg)
+    
+    def join_room(self, username, room_name):
+        """Add a user to a room and tell the room's members"""
+        room = normalize_room_name(room_name)
+        if room is None:
+            self.send_system_message(username, "Usage: /join <room>")
+        elif not self.rooms.join(username, room):
+            self.send_system_message(username, f"You are already in #{room}")
+        else:
+            notice = {
+                "type": "system",
+                "room": room,
+                "message": f"{username} joined #{room}",
+                "timestamp": timestamp()
+            }
+            self.publish_message(notice, room=room)
     
-    def send_user_list(self, requester):
-        """Send list of connected users to the requester"""
-        user_list = list(self.clients.keys())
+    def leave_room(self, username, room_name):
+        """Remove a user from a room and tell the remaining members"""
+        room = normalize_room_name(room_name)
+        if room is None:
+            self.send_system_message(username, "Usage: /leave <room>")
+        elif not self.rooms.leave(username, room):
+            self.send_system_message(username, f"You are not in #{room}")
+        else:
+            self.send_system_message(username, f"You left #{room}")
+            notice = {
+                "type": "system",
+                "room": room,
+                "message": f"{username} left #{room}",
+                "timestamp": timestamp()
+            }
+            self.publish_message(notice, room=room)
+    
+    def send_room_message(self, sender, room_name, message):
+        """Send a message to the members of one room"""
+        room = normalize_room_name(room_name)
+        if room is None or not self.rooms.is_member(sender, room):
+            self.send_system_message(sender, f"You are not in #{room or room_name}")
+            return
+        room_msg = {
+            "type": "room",
+            "room": room,
+            "sender": sender,
+            "message": message,
+            "timestamp": timestamp()
+        }
+        self.publish_message(room_msg, exclude_user=sender, room=room)
+    
+    def send_user_list(self, requester, prefix='', page=1, numbered=False):
+        """Send one page of the connected users starting with prefix to the requester.
+        
+        numbered replies answer list_users requests rather than /users.
+        """
+        if self.cluster:
+            def listed(everyone):
+                users, total, shown_page, pages = paginate(sorted(everyone), prefix, page, self.clients.page_size)
+                self.send_user_page(requester, users, format_listing(users, total, shown_page, pages, prefix),
+                                    numbered)
+            
+            self.call_blocking(self.clients[requester], self.cluster.list_users, (), listed)
+        else:
+            # Cached until someone joins or leaves
+            self.send_user_page(requester, *self.clients.listing(prefix, page), numbered)
+    
+    def send_user_page(self, requester, users, text, numbered):
+        """Send a page of the user list, as a list_users reply if numbered"""
         user_msg = {
             "type": "system",
-            "message": f"Connected users: {', '.join(user_list)}",
-            "timestamp": time.strftime("%H:%M:%S")
+            "message": text,
+            "users": users,
+            "timestamp": timestamp()
         }
-        self.clients[requester].send(json.dumps(user_msg).encode('utf-8'))
+        if numbered:
+            self.answer_users_request(requester, user_msg)
+        else:
+            self.clients[requester].send_message(user_msg)
+    
+    def answer_users_request(self, requester, reply):
+        """Send the reply to a list_users request, numbered so the client can pair them up"""
+        client_socket = self.clients[requester]
+        client_socket.users_requests += 1
+        reply["request"] = client_socket.users_requests
+        client_socket.send_message(reply)
     
     def send_private_message(self, sender, target_user, message):
         """Send private message between two users"""
-        if target_user in self.clients:
-            # Send to target user
-            private_msg = {
-                "type": "private",
-                "sender": sender,
-                "message": message,
-                "timestamp": time.strftime("%H:%M:%S")
-            }
-            self.clients[target_user].send(json.dumps(private_msg).encode('utf-8'))
+        private_msg = Payload({
+            "type": "private",
+            "sender": sender,
+            "target": target_user,
+            "message": message,
+            "timestamp": timestamp()
+        })
+        self.send_private_payload(sender, target_user, private_msg)
+    
+    def send_private_payload(self, sender, target_user, private_msg):
+        """Deliver, relay or store a built private message and tell the sender"""
+        if not isinstance(target_user, str) or not 0 < len(target_user) <= MAX_TARGET_LENGTH:
+            # Nobody can have that name: don't route it or give it an inbox
+            self.send_system_message(sender, f"User '{target_user}' not found")
+            return
+        # Send to target user, on this server or through the cluster
+        if self.deliver_private(target_user, private_msg):
+            self.private_sent(sender, target_user, private_msg, True)
+        elif self.cluster:
+            def routed(delivered):
+                if delivered and self.history:
+                    self.log_message(private_msg, audience=(sender, target_user))
+                self.private_sent(sender, target_user, private_msg, delivered)
             
+            self.call_blocking(self.clients[sender], self.cluster.route_private,
+                               (sender, target_user, private_msg.message), routed)
+        else:
+            self.private_sent(sender, target_user, private_msg, False)
+    
+    def private_sent(self, sender, target_user, private_msg, delivered):
+        """Tell the sender how a private message went, keeping it in the inbox if the target is offline"""
+        if not delivered and self.inbox:
+            # Keep it for when they log in
+            pending = self.inbox.store(target_user, private_msg.frame(FRAMING_LENGTH))
+            if pending is None:
+                self.send_system_message(sender, f"User '{target_user}' is offline and their inbox is full")
+            else:
+                self.send_system_message(sender, f"User '{target_user}' is offline, message saved to their "
+                                                 f"inbox ({pending} pending)")
+            return
+        
+        if delivered:
             # Confirm to sender
             confirm_msg = {
                 "type": "system",
                 "message": f"Private message sent to {target_user}",
-                "timestamp": time.strftime("%H:%M:%S")
+                "timestamp": timestamp()
             }
-            self.clients[sender].send(json.dumps(confirm_msg).encode('utf-8'))
+            self.clients[sender].send_message(confirm_msg)
         else:
             # User not found
             error_msg = {
                 "type": "system",
                 "message": f"User '{target_user}' not found",
-                "timestamp": time.strftime("%H:%M:%S")
+                "timestamp": timestamp()
             }
-            self.clients[sender].send(json.dumps(error_msg).encode('utf-8'))
+            self.clients[sender].send_message(error_msg)
+    
+    def deliver_private(self, target_user, message):
+        """Deliver a private message to a user connected to this server.
+        
+        message is a dict or Payload. Returns False if the user is not here.
+        """
+        client_socket = self.clients.get(target_user)
+        if client_socket is None:
+            return False
+        payload = message if isinstance(message, Payload) else Payload(message)
+        client_socket.send_payload(payload)
+        if self.history:
+            self.log_message(payload, audience=(payload.field('sender'), target_user))
+        return True
+    
+    def log_message(self, payload, audience=()):
+        """Append a message to the history log, and the search index if there is one"""
+        if self.search:
+            self.search.append(payload.frame(FRAMING_LENGTH), payload.message, audience)
+        else:
+            self.history.append(payload.frame(FRAMING_LENGTH), audience=audience)
+    
+    def search_history(self, username, query):
+        """Run a /search and send the matches to username.
+        
+        The asyncio engine runs the search on a worker thread so the event
+        loop keeps delivering messages meanwhile.
+        """
+        if self.loop is None:
+            try:
+                results = self.search.search(query, username)
+            except ValueError as e:
+                results = e
+            self.send_search_results(username, query, results)
+            return
+        
+        def done(future):
+            try:
+                results = future.result()
+            except ValueError as e:
+                results = e
+            self.send_search_results(username, query, results)
+        
+        self.loop.run_in_executor(None, self.search.search, query, username).add_done_callback(done)
     
-    def broadcast_message(self, message, exclude_user=None):
-        """Broadcast message to all connected clients except excluded user"""
-        message_json = json.dumps(message)
+    def send_search_results(self, username, query, results):
+        """Send search matches, or the reason there are none"""
+        if username not in self.clients:
+            return  # Left while the search ran
+        if isinstance(results, ValueError):
+            text = f"{results}"
+        elif not results:
+            text = f"No messages match '{query}'"
+        else:
+            lines = [f"{len(results)} message{'s' if len(results) != 1 else ''} match '{query}', newest first:"]
+            for sent_ms, message in results:
+                when = time.strftime('%Y-%m-%d %H:%M', time.localtime(sent_ms / 1000))
+                target = f" to {message['target']}" if message.get('type') == 'private' else ""
+                lines.append(f"[{when}] {message.get('sender', '?')}{target}: {message.get('message', '')}")
+            text = '\n'.join(lines)
+        self.send_system_message(username, text)
+    
+    def publish_message(self, message, exclude_user=None, room=None):
+        """Broadcast a message here and on every other worker in the cluster.
+        
+        With room set, only the room's members receive it.
+        """
+        payload = message if isinstance(message, Payload) else Payload(message)
+        recipients = self.rooms.room_members(room) if room else None
+        self.broadcast_message(payload, exclude_user=exclude_user, recipients=recipients)
+        if self.cluster:
+            self.cluster.relay_broadcast(payload.message, exclude_user, room)
+    
+    def deliver_relayed(self, message, exclude_user=None, room=None):
+        """Deliver a broadcast relayed from another worker to local clients"""
+        payload = Payload(message)
+        if self.history and not room and message.get('type') == 'message':
+            self.log_message(payload)
+        recipients = self.rooms.room_members(room) if room else None
+        self.broadcast_message(payload, exclude_user=exclude_user, recipients=recipients)
+    
+    def broadcast_message(self, message, exclude_user=None, recipients=None):
+        """Broadcast message to all connected clients except excluded user.
+        
+        message is a dict or an already built Payload. Pass recipients
+        (usernames) to fan out to a subset such as a room, so the cost
+        scales with the recipients rather than every client.
+        """
+        # Encoded once and shared by every recipient
+        payload = message if isinstance(message, Payload) else Payload(message)
         disconnected_users = []
+        presence = payload.field('presence') is not None  # Skipped by clients that opted out
+        
+        if recipients is None:
+            # Shared snapshot, unaffected by clients joining or leaving mid-broadcast
+            targets = self.clients.snapshot()
+        else:
+            targets = [(username, self.clients.get(username)) for username in recipients]
         
-        for username, client_socket in self.clients.items():
-            if username != exclude_user:
+        for username, client_socket in targets:
+            if username != exclude_user and client_socket is not None:
+                if presence and not client_socket.presence:
+                    continue
                 try:
-                    client_socket.send(message_json.encode('utf-8'))
+                    client_socket.send_payload(payload)
                 except:
                     disconnected_users.append(username)
         
         # Remove disconnected users
         for username in disconnected_users:
-            self.disconnect_client(username, self.clients[username])
+            self.disconnect_client(username, self.clients.get(username))
     
     def disconnect_client(self, username, client_socket):
-        """Handle client disconnection"""
-        if username and username in self.clients:
-            del self.clients[username]
-            
-            # Notify other clients
-            leave_msg = {
-                "type": "system",
-                "message": f"{username} left the chat",
-                "timestamp": time.strftime("%H:%M:%S")
-            }
-            self.broadcast_message(leave_msg)
-            print(f"{username} disconnected")
+        """Handle client disconnection, keeping the user's session if they have one"""
+        self.connections.discard(client_socket)
+        session = getattr(client_socket, 'session', None)
+        if username and session is not None:
+            # Still logged in until the session expires; a connection that
+            # was superseded by a resume has nothing left to clean up
+            if self.sessions.detach(session, client_socket, self.heartbeats.wheel.now):
+                self.heartbeats.wheel.schedule(self.sessions.grace, self.expire_session, session)
+                print(f"{username} dropped, keeping their session for {self.sessions.grace:g}s")
+        else:
+            self.remove_client(username, client_socket)
         
         try:
             client_socket.close()
         except:
             pass
     
+    def end_session(self, client_socket):
+        """The client is logging out: its next disconnect removes it straight away"""
+        if client_socket.session is not None:
+            self.sessions.close(client_socket.session)
+            client_socket.session = None
+    
+    def expire_session(self, session):
+        """Log out a user whose session was not resumed within the grace period"""
+        if not self.sessions.expire(session, self.heartbeats.wheel.now):
+            return  # Resumed, or dropped again and expiring later
+        print(f"{session.username}'s session expired")
+        self.remove_client(session.username, self.clients.get(session.username))
+    
+    def remove_client(self, username, client_socket):
+        """Forget a user's connection and rooms and tell everyone they left"""
+        if username and client_socket is not None and self.clients.remove(username, client_socket):
+            self.rooms.leave_all(username)
+            if self.cluster:
+                self.cluster.release_username(username)
+            
+            # Notify other clients
+            self.presence.left(username)
+            print(f"{username} disconnected")
+    
     def cleanup_server(self):
         """Clean up server resources"""
         if self.server_socket:
             self.server_socket.close()
+        self.close_storage()
+        print(f"Writes: {self.write_stats.summary()}")
+        print(f"Presence: {self.presence.events} joins and leaves announced in {self.presence.notices} notices")
+        print(self.heartbeats.summary())
+        if self.sessions:
+            print(self.sessions.summary())
         print("Server shut down")
 
-if __name__ == "__main__":
-    server = ChatServer()
+    def close_storage(self):
+        """Save the search index and flush and close the history and metrics file"""
+        if self.search:
+            self.search.close()
+        if self.history:
+            self.history.close()
+        if self.metrics and self.metrics.dump_path:
+            self.metrics.dump()
+
+def parse_users_arguments(arguments):
+    """Split "[prefix] [page]" into (prefix, page); a lone number is a page"""
+    words = arguments.split()
+    page = 1
+    if words and words[-1].isdigit():
+        page = int(words.pop())
+    return (words[0] if words else ''), page
+
+def parse_address(value):
+    """Parse a HOST:PORT command line value"""
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got '{value}'")
+    return host, int(port)
+
+def limit_argument(value):
+    """Parse a CATEGORY=RATE[/BURST] command line value"""
+    try:
+        return parse_limit(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def parse_args(argv=None):
+    """Parse command line options for the server"""
+    parser = argparse.ArgumentParser(description="Simple Chat Server")
+    parser.add_argument('--host', default='localhost', help="address to bind (default: localhost)")
+    parser.add_argument('--port', type=int, default=12345, help="port to listen on (default: 12345)")
+    parser.add_argument('--engine', choices=ENGINES, default='threaded',
+                        help="connection engine (default: threaded)")
+    parser.add_argument('--max-frame-size', type=int, default=DEFAULT_MAX_FRAME_SIZE,
+                        help=f"largest accepted frame in bytes (default: {DEFAULT_MAX_FRAME_SIZE})")
+    parser.add_argument('--high-watermark', type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help=f"queued outbound bytes before a client counts as slow (default: {DEFAULT_HIGH_WATERMARK})")
+    parser.add_argument('--low-watermark', type=int, default=DEFAULT_LOW_WATERMARK,
+                        help=f"queued outbound bytes at which a dropping client recovers (default: {DEFAULT_LOW_WATERMARK})")
+    parser.add_argument('--slow-consumer', choices=SLOW_CONSUMER_POLICIES, default='disconnect',
+                        help="what to do with clients past the high watermark (default: disconnect)")
+    parser.add_argument('--coalesce-delay', type=float, default=0, metavar='MS',
+                        help="milliseconds to wait for more outbound frames before a send (default: 0)")
+    parser.add_argument('--compress-threshold', type=int, default=DEFAULT_COMPRESS_THRESHOLD, metavar='BYTES',
+                        help="compress larger frames for clients that negotiated compression "
+                             f"(default: {DEFAULT_COMPRESS_THRESHOLD})")
+    parser.add_argument('--no-fast-path', dest='fast_path', action='store_false',
+                        help="decode every message in full instead of passing plain message text through")
+    parser.add_argument('--presence-window', type=float, default=DEFAULT_PRESENCE_WINDOW, metavar='SECONDS',
+                        help="fold joins and leaves within this window into one notice, 0 announces each one "
+                             f"(default: {DEFAULT_PRESENCE_WINDOW:g})")
+    parser.add_argument('--handshake-timeout', type=float, default=DEFAULT_HANDSHAKE_TIMEOUT, metavar='SECONDS',
+                        help="close connections that have not sent their username by then, 0 waits forever "
+                             f"(default: {DEFAULT_HANDSHAKE_TIMEOUT:g})")
+    parser.add_argument('--heartbeat-interval', type=float, default=DEFAULT_HEARTBEAT_INTERVAL, metavar='SECONDS',
+                        help="ping clients that were silent this long, 0 never pings "
+                             f"(default: {DEFAULT_HEARTBEAT_INTERVAL:g})")
+    parser.add_argument('--heartbeat-timeout', type=float, default=DEFAULT_HEARTBEAT_TIMEOUT, metavar='SECONDS',
+                        help="disconnect clients that do not answer a ping within this time "
+                             f"(default: {DEFAULT_HEARTBEAT_TIMEOUT:g})")
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT, metavar='SECONDS',
+                        help="disconnect clients that sent no messages for this long (default: 0, never)")
+    parser.add_argument('--rate-limit', action='append', default=[], type=limit_argument,
+                        metavar='CATEGORY=RATE[/BURST]',
+                        help=f"messages per second each client may send in a category ({', '.join(CATEGORIES)}); "
+                             "0 disables the limit (repeatable, default: "
+                             + ', '.join(f"{c}={r:g}/{b:g}" for c, (r, b) in DEFAULT_LIMITS.items()) + ")")
+    parser.add_argument('--global-rate-limit', action='append', default=[], type=limit_argument,
+                        metavar='CATEGORY=RATE[/BURST]',
+                        help="messages per second all clients together may send in a category (repeatable)")
+    parser.add_argument('--history-dir', help="directory for the persistent message log (default: no history)")
+    parser.add_argument('--history-fsync', choices=FSYNC_POLICIES, default='interval',
+                        help="when to force logged messages to disk (default: interval)")
+    parser.add_argument('--history-fsync-ms', type=float, default=DEFAULT_FSYNC_INTERVAL_MS, metavar='MS',
+                        help="milliseconds between syncs with --history-fsync interval "
+                             f"(default: {DEFAULT_FSYNC_INTERVAL_MS})")
+    parser.add_argument('--history-replay', type=int, default=50,
+                        help="messages replayed to a joining user (default: 50)")
+    parser.add_argument('--search', action='store_true',
+                        help="index the history for /search (requires --history-dir)")
+    parser.add_argument('--inbox-dir', help="directory for private messages to offline users (default: none, "
+                                            "such messages are refused)")
+    parser.add_argument('--inbox-max-messages', type=int, default=DEFAULT_MAX_MESSAGES,
+                        help=f"messages kept per offline user (default: {DEFAULT_MAX_MESSAGES})")
+    parser.add_argument('--inbox-max-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help=f"bytes kept across all inboxes (default: {DEFAULT_MAX_BYTES})")
+    parser.add_argument('--inbox-max-age', type=float, default=DEFAULT_MAX_AGE_DAYS, metavar='DAYS',
+                        help=f"days a message waits before it is discarded (default: {DEFAULT_MAX_AGE_DAYS:g})")
+    parser.add_argument('--metrics', action='store_true',
+                        help="time server handlers and keep counters for /stats")
+    parser.add_argument('--metrics-file', help="write metrics in Prometheus text format to this file (implies --metrics)")
+    parser.add_argument('--metrics-interval', type=float, default=DEFAULT_DUMP_INTERVAL,
+                        help=f"seconds between metrics file writes (default: {DEFAULT_DUMP_INTERVAL:g})")
+    parser.add_argument('--admin', action='append', default=[], metavar='USERNAME',
+                        help="username allowed to run admin commands such as /stats (repeatable)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes sharing the port through SO_REUSEPORT (default: 1)")
+    parser.add_argument('--federation-port', type=int,
+                        help="port for links to other server nodes (enables federation)")
+    parser.add_argument('--peer', action='append', default=[], type=parse_address, metavar='HOST:PORT',
+                        help="federation port of another node to connect to (repeatable)")
+    parser.add_argument('--resume-grace', type=float, default=DEFAULT_RESUME_GRACE, metavar='SECONDS',
+                        help="keep the session of a client that asked for one this long after its connection "
+                             f"drops, 0 disables sessions (default: {DEFAULT_RESUME_GRACE:g})")
+    parser.add_argument('--resume-buffer', type=int, default=DEFAULT_REPLAY_BUFFER, metavar='MESSAGES',
+                        help=f"messages kept per session for a resuming client (default: {DEFAULT_REPLAY_BUFFER})")
+    parser.add_argument('--handoff-path', metavar='PATH',
+                        help="Unix socket on which a new server process can take over this one's clients")
+    parser.add_argument('--takeover', action='store_true',
+                        help="take over the clients of the server listening on --handoff-path instead of "
+                             "binding the port")
+    args = parser.parse_args(argv)
+    if args.search and not args.history_dir:
+        parser.error("--search requires --history-dir")
+    if args.history_fsync_ms <= 0:
+        parser.error("--history-fsync-ms must be positive")
+    if args.workers > 1 and args.federation_port:
+        parser.error("--workers and --federation-port cannot be combined")
+    if args.takeover and not args.handoff_path:
+        parser.error("--takeover requires --handoff-path")
+    if args.handoff_path and (args.workers > 1 or args.federation_port):
+        parser.error("--handoff-path cannot be combined with --workers or --federation-port")
+    if args.inbox_dir and (args.workers > 1 or args.federation_port):
+        # A user may log in to any process or node, so offline messages would be found only by chance
+        parser.error("--inbox-dir cannot be combined with --workers or --federation-port")
+    return args
+
+def main():
+    """Start a single server, or a cluster of worker processes"""
+    args = parse_args()
+    server_options = dict(engine=args.engine, max_frame_size=args.max_frame_size,
+                          high_watermark=args.high_watermark, low_watermark=args.low_watermark,
+                          slow_consumer=args.slow_consumer, coalesce_delay_ms=args.coalesce_delay,
+                          compress_threshold=args.compress_threshold, history_fsync=args.history_fsync,
+                          history_fsync_ms=args.history_fsync_ms,
+                          history_replay=args.history_replay, search=args.search, metrics=args.metrics,
+                          metrics_interval=args.metrics_interval, admins=args.admin,
+                          rate_limits=dict(DEFAULT_LIMITS, **dict(args.rate_limit)),
+                          global_rate_limits=dict(args.global_rate_limit),
+                          presence_window=args.presence_window, fast_path=args.fast_path,
+                          handshake_timeout=args.handshake_timeout, heartbeat_interval=args.heartbeat_interval,
+                          heartbeat_timeout=args.heartbeat_timeout, idle_timeout=args.idle_timeout,
+                          resume_grace=args.resume_grace, resume_buffer=args.resume_buffer,
+                          inbox_max_messages=args.inbox_max_messages, inbox_max_bytes=args.inbox_max_bytes,
+                          inbox_max_age_days=args.inbox_max_age)
+    
+    if args.workers > 1:
+        def make_server(worker_id, bus_path):
+            # Every worker keeps its own history log
+            history_dir = os.path.join(args.history_dir, f"worker-{worker_id}") if args.history_dir else None
+            # ... and its own metrics file
+            metrics_file = f"{args.metrics_file}.{worker_id}" if args.metrics_file else None
+            return ChatServer(args.host, args.port, history_dir=history_dir, metrics_file=metrics_file,
+                              reuse_port=True, cluster_path=bus_path, worker_id=worker_id, **server_options)
+        run_cluster(make_server, args.workers)
+        return
+    
+    # Taken over before the server opens its history, which the old process closes first
+    takeover = take_over(args.handoff_path) if args.takeover else None
+    server = ChatServer(args.host, args.port, history_dir=args.history_dir, inbox_dir=args.inbox_dir,
+                        metrics_file=args.metrics_file,
+                        federation_port=args.federation_port, peers=args.peer,
+                        handoff_path=args.handoff_path, takeover=takeover, **server_options)
     try:
         server.start_server()
     except KeyboardInterrupt:
         print("\nShutting down server...")
-        server.cleanup_server()
\ No newline at end of file
+        server.cleanup_server()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Resumable sessions: ride out short disconnects without logging out.
+
+A client that adds "resume": true to its handshake is given a session
+token in the welcome message, and from then on every message routed to it
+carries a sequence number (see FLAG_SEQUENCED in protocol.py). The
+session keeps the last `buffer` Payloads it delivered; they are the same
+objects every other recipient got, so a replay buffer costs a reference
+per message rather than a copy.
+
+When the connection drops, the session is detached instead of the user
+being removed: the username stays taken, room memberships stay, nobody is
+told the user left, and messages keep being numbered into the buffer. A
+client that reconnects within the grace period and sends its token with
+the last sequence number it saw gets a "welcome back" followed by only
+the messages it missed, and carries on where it left off. Messages that
+fell out of the buffer meanwhile are counted as lost and reported to the
+client. A session nobody resumes in time expires, and only then does the
+user leave.
+
+All sequenced sends go through Session.send, which numbers, records and
+writes under the session's lock to whichever connection currently holds
+the session, so a resume and the messages racing with it are delivered in
+order with no gaps and no duplicates.
+"""
+
+import collections
+import secrets
+import threading
+
+from protocol import Payload
+
+DEFAULT_RESUME_GRACE = 30.0  # Seconds a detached session waits for its client
+DEFAULT_REPLAY_BUFFER = 500  # Messages kept per session for replay
+
+
+class Session:
+    """One user's sequence numbers and recently delivered messages"""
+
+    __slots__ = ('username', 'token', 'seq', 'replay', 'connection', 'detached_at', 'lock')
+
+    def __init__(self, username, token, connection, buffer, seq=0):
+        """A session attached to connection, numbering from seq + 1"""
+        self.username = username
+        self.token = token
+        self.seq = seq  # Number of the last message sent
+        self.replay = collections.deque(maxlen=buffer)  # (seq, Payload) of the latest messages
+        self.connection = connection  # None while detached
+        self.detached_at = None
+        self.lock = threading.Lock()
+
+    def send(self, payload):
+        """Number a message, keep it for replay and write it to the current connection"""
+        with self.lock:
+            self.seq += 1
+            self.replay.append((self.seq, payload))
+            if self.connection is None:
+                return 0  # Waiting for the client to come back
+            try:
+                return self.connection.deliver(payload, self.seq)
+            except OSError:
+                return 0  # The connection is going away; the message waits in the buffer
+
+    def missed(self, last_seq):
+        """Buffered messages after last_seq, and how many more were already dropped from the buffer"""
+        oldest = self.replay[0][0] if self.replay else self.seq + 1
+        lost = max(0, oldest - last_seq - 1)
+        return [(seq, payload) for seq, payload in self.replay if seq > last_seq], lost
+
+
+class SessionTable:
+    """Sessions of one server by token, with their grace period and counters"""
+
+    def __init__(self, grace=DEFAULT_RESUME_GRACE, buffer=DEFAULT_REPLAY_BUFFER):
+        """grace is in seconds and buffer in messages"""
+        self.grace = grace
+        self.buffer = buffer
+        self.sessions = {}
+        self.created = 0
+        self.resumed = 0
+        self.replayed = 0  # Messages sent again on resume
+        self.lost = 0  # Messages a resuming client missed for good
+        self.expired = 0
+        self.lock = threading.Lock()
+
+    def create(self, username, connection, token=None, seq=0):
+        """Start a session for a logged in connection (or carry one over from another process)"""
+        session = Session(username, token or secrets.token_urlsafe(16), connection, self.buffer, seq)
+        with self.lock:
+            self.sessions[session.token] = session
+            self.created += 1
+        connection.session = session
+        return session
+
+    def find(self, token, username):
+        """The detached or attached session with token, if it belongs to username"""
+        session = self.sessions.get(token) if isinstance(token, str) else None
+        if session is None or session.username != username:
+            return None
+        return session
+
+    def detach(self, session, connection, now):
+        """Keep a session whose connection dropped; False if another connection took it over"""
+        with session.lock:
+            if session.connection is not connection:
+                return False
+            session.connection = None
+            session.detached_at = now
+            return True
+
+    def resume(self, session, connection, last_seq, welcome):
+        """Move session to connection, send welcome and then what the client missed.
+
+        Returns (messages replayed, messages lost), or None if the session
+        expired in the meantime. Holding the session's lock keeps messages
+        routed meanwhile behind the replay.
+        """
+        with session.lock:
+            if self.sessions.get(session.token) is not session:
+                return None
+            session.connection = connection
+            session.detached_at = None
+            connection.session = session
+            missed, lost = session.missed(last_seq)
+            welcome["missed"] = len(missed)
+            welcome["lost"] = lost
+            connection.deliver(Payload(welcome))  # Unnumbered, so the replay's numbers come next
+            for seq, payload in missed:
+                connection.deliver(payload, seq)
+        with self.lock:
+            self.resumed += 1
+            self.replayed += len(missed)
+            self.lost += lost
+        return len(missed), lost
+
+    def expire(self, session, now):
+        """Drop a session still detached after the grace period; True if it was dropped"""
+        with session.lock:
+            if session.connection is not None or now - session.detached_at < self.grace:
+                return False
+            with self.lock:
+                if self.sessions.pop(session.token, None) is None:
+                    return False
+                self.expired += 1
+            return True
+
+    def close(self, session):
+        """Forget a session whose user logged out or was removed"""
+        with self.lock:
+            self.sessions.pop(session.token, None)
+
+    def summary(self):
+        """One line for /stats and shutdown"""
+        detached = sum(session.connection is None for session in list(self.sessions.values()))
+        return (f"Sessions: {len(self.sessions)} open ({detached} detached), {self.created} created, "
+                f"{self.resumed} resumed ({self.replayed} messages replayed, {self.lost} lost), "
+                f"{self.expired} expired")
@@ -4,11 +4,54 @@ Test script for the Simple Chat Application
 This script helps verify that the server and client work correctly
 """
 
+import asyncio
 import subprocess
+import tempfile
+import threading
+import socket
+import json
 import time
 import sys
 import os
 
+from chat_client import ChatClient, RateLimited, UsernameTaken
+from connection import ThreadedConnection, send_frames
+from federation import HashRing
+from history import MessageLog
+from presence import PresenceDigest
+from render import Renderer
+from rooms import RoomIndex
+from ratelimit import RateLimiter
+from registry import ClientRegistry
+from search import SearchIndex
+from server import ChatServer, parse_args
+from timers import TimingWheel
+from protocol import (FLAG_BINARY, FLAG_COMPRESSED, FrameDecoder, FrameError, InternTable, Payload,
+                      compress_frame, decode_binary, decode_json, decode_message, encode_frame,
+                      raw_private, scan_envelope)
+
+def start_test_server(port, *extra_args):
+    """Start server.py on the given port and wait until it accepts connections"""
+    server_process = subprocess.Popen([sys.executable, 'server.py', '--port', str(port), *extra_args],
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=0.5).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return server_process
+
+def login(port, username, **handshake):
+    """Connect a raw socket client and complete the username handshake"""
+    sock = socket.create_connection(('localhost', port), timeout=5)
+    json.loads(sock.recv(1024).decode('utf-8'))  # username prompt
+    sock.send(json.dumps({"username": username, **handshake}).encode('utf-8'))
+    json.loads(sock.recv(1024).decode('utf-8'))  # welcome message
+    return sock
+
 def test_server_startup():
     """Test if the server starts correctly"""
     print("Testing server startup...")
@@ -79,6 +122,992 @@ def test_client_connection():
         print(f"[FAIL] Error testing client connection: {e}")
         return False
 
+def test_asyncio_engine():
+    """Test broadcast delivery on the asyncio engine"""
+    print("Testing asyncio engine...")
+    server_process = start_test_server(12346, '--engine', 'asyncio')
+    try:
+        alice = login(12346, "Alice")
+        bob = login(12346, "Bob")
+        join = json.loads(alice.recv(1024).decode('utf-8'))
+        
+        # Two unterminated objects in one send, as an old client's burst can arrive
+        bob.send(json.dumps({"type": "message", "message": "hello"}).encode('utf-8') +
+                 json.dumps({"type": "message", "message": "again"}).encode('utf-8'))
+        data = b''
+        while data.count(b'\n') < 2:
+            data += alice.recv(1024)
+        received = [json.loads(line)['message'] for line in data.splitlines()]
+        
+        alice.close()
+        bob.close()
+        if join['message'] == "Bob joined the chat" and received == ["hello", "again"]:
+            print("[OK] Asyncio engine delivered broadcasts")
+            return True
+        print(f"[FAIL] Unexpected messages: {join}, {received}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing asyncio engine: {e}")
+        return False
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+def test_async_client():
+    """Test the asyncio client library against a running server"""
+    print("Testing asyncio client library...")
+    server_process = start_test_server(12347)
+    
+    async def scenario():
+        alice = await ChatClient('localhost', 12347, 'Alice', encoding='binary').connect()
+        bob = await ChatClient('localhost', 12347, 'Bob').connect()
+        try:
+            await ChatClient('localhost', 12347, 'Bob', reconnect=False).connect()
+            taken = False
+        except UsernameTaken:
+            taken = True
+        # Pipelined requests, answered in order
+        user_lists = await asyncio.gather(alice.users(), alice.users())
+        await alice.private('Bob', 'secret')
+        received = None
+        async for message in bob:
+            if message.get('type') == 'private':
+                received = message
+                break
+        await alice.close()
+        await bob.close()
+        return taken, user_lists, received
+    
+    try:
+        taken, user_lists, received = asyncio.run(asyncio.wait_for(scenario(), 10))
+        if taken and user_lists == [['Alice', 'Bob']] * 2 and received['message'] == 'secret':
+            print("[OK] Async client logged in, listed users and sent a private message")
+            return True
+        print(f"[FAIL] Name taken: {taken}, user lists: {user_lists}, received: {received}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing asyncio client library: {e}")
+        return False
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+def test_offline_inbox():
+    """Test that private messages to an offline user are delivered at login"""
+    print("Testing offline inbox...")
+    directory = tempfile.TemporaryDirectory()
+    server_process = start_test_server(12348, '--engine', 'asyncio', '--inbox-dir', directory.name,
+                                       '--rate-limit', 'private=0')
+    
+    async def scenario():
+        alice = await ChatClient('localhost', 12348, 'Alice').connect()
+        for i in range(1000):
+            await alice.private('Bob', f"m{i}")
+        # Wait until the last one is stored
+        async for message in alice:
+            if '(1000 pending)' in message.get('message', ''):
+                break
+        bob = await ChatClient('localhost', 12348, 'Bob').connect()
+        received = []
+        async for message in bob:
+            if message.get('type') == 'private':
+                received.append(message['message'])
+                if len(received) == 1000:
+                    break
+        # Targets nobody can have are refused without touching the inbox
+        await alice.write({"type": "private", "message": "hi"})
+        await alice.private('x' * 300, "hi")
+        await alice.private('Bob', "still here")
+        refused = []
+        async for message in alice:
+            refused.append(message.get('message', ''))
+            if message.get('message') == 'Private message sent to Bob':
+                break
+        await alice.close()
+        await bob.close()
+        return received, [text for text in refused if text.endswith('not found')]
+    
+    try:
+        received, refused = asyncio.run(asyncio.wait_for(scenario(), 20))
+        if received == [f"m{i}" for i in range(1000)] and len(refused) == 2 and not os.listdir(directory.name):
+            print("[OK] 1000 stored private messages delivered in order, invalid targets refused")
+            return True
+        print(f"[FAIL] Received {len(received)} messages, refused {refused}, "
+              f"inbox files left: {os.listdir(directory.name)}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing offline inbox: {e}")
+        return False
+    finally:
+        server_process.terminate()
+        server_process.wait()
+        directory.cleanup()
+
+def test_timeouts():
+    """Test timing wheel accuracy and that dead and stalled connections are reaped"""
+    print("Testing timeouts...")
+    wheel = TimingWheel(tick=0.1, slots=8, levels=2)
+    fired = {}
+    for delay in (0.05, 0.8, 5.0, 6.4, 20.0):  # Level 0, level 1 and beyond the top level
+        wheel.schedule(delay, lambda delay: fired.setdefault(delay, wheel.ticks), delay)
+    for tick in range(1, 250):
+        wheel.advance(wheel.started + tick * 0.1 + 0.01)
+    
+    server_process = start_test_server(12349, '--handshake-timeout', '0.5', '--heartbeat-interval', '0.5',
+                                       '--heartbeat-timeout', '0.5')
+    
+    def closed_after(sock):
+        start = time.time()
+        try:
+            while sock.recv(1024):
+                pass
+        except OSError:
+            pass
+        return time.time() - start
+    
+    async def scenario():
+        alive = await ChatClient('localhost', 12349, 'Alive').connect()
+        stalled = socket.create_connection(('localhost', 12349), timeout=5)
+        silent = login(12349, "Silent", heartbeat=True)  # Says it answers pings, never does
+        older = login(12349, "Older")  # Predates heartbeats: not pinged, so never reaped for silence
+        loop = asyncio.get_running_loop()
+        closes = await asyncio.gather(loop.run_in_executor(None, closed_after, stalled),
+                                      loop.run_in_executor(None, closed_after, silent))
+        users = await alive.users()
+        await alive.close()
+        older.close()
+        return closes, users
+    
+    try:
+        closes, users = asyncio.run(asyncio.wait_for(scenario(), 20))
+        expected = {0.05: 1, 0.8: 8, 5.0: 50, 6.4: 64, 20.0: 200}
+        if fired == expected and max(closes) < 3 and users == ['Alive', 'Older']:
+            print("[OK] Timers fired on time and dead connections were reaped, older clients left alone")
+            return True
+        print(f"[FAIL] Fired at ticks {fired}, connections closed after {closes}s, users {users}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing timeouts: {e}")
+        return False
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+def test_handoff():
+    """Test that clients stay connected while the server is handed to new processes"""
+    print("Testing handoff...")
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, 'handoff.sock')
+    old = start_test_server(12350, '--handoff-path', path, '--presence-window', '0')
+    successors = []
+    
+    async def expect(client, text):
+        """Messages received up to and including the one with text"""
+        received = []
+        async for message in client:
+            received.append(message)
+            if message.get('message') == text:
+                return received
+    
+    async def scenario():
+        alice = await ChatClient('localhost', 12350, 'Alice', encoding='binary').connect()
+        bob = await ChatClient('localhost', 12350, 'Bob').connect()
+        await alice.command('/join dev')
+        await expect(alice, 'Alice joined #dev')
+        await bob.command('/join dev')
+        await expect(bob, 'Bob joined #dev')
+        seen = []
+        # Threaded to asyncio and back again
+        for engine in ('asyncio', 'threaded'):
+            previous = successors[-1] if successors else old
+            successors.append(subprocess.Popen(
+                [sys.executable, 'server.py', '--port', '12350', '--engine', engine,
+                 '--handoff-path', path, '--takeover', '--presence-window', '0'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+            await asyncio.get_running_loop().run_in_executor(None, previous.wait, 10)
+            await alice.room('dev', f'to {engine}')
+            seen += await expect(bob, f'to {engine}')
+        carol = await ChatClient('localhost', 12350, 'Carol').connect()
+        users = await carol.users()
+        await asyncio.gather(alice.close(), bob.close(), carol.close())
+        return seen, users, alice.reconnects + bob.reconnects
+    
+    try:
+        seen, users, reconnects = asyncio.run(asyncio.wait_for(scenario(), 30))
+        exits = [old.returncode] + [process.returncode for process in successors[:-1]]
+        if [message['message'] for message in seen] == ['to asyncio', 'to threaded'] and reconnects == 0 \
+                and users == ['Alice', 'Bob', 'Carol'] and exits == [0, 0]:
+            print("[OK] Clients kept their connections, rooms and names across two handoffs")
+            return True
+        print(f"[FAIL] Bob saw {seen}, users {users}, {reconnects} reconnects, old servers exited with {exits}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing handoff: {e}")
+        return False
+    finally:
+        for process in [old] + successors:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        directory.cleanup()
+
+def test_session_resume():
+    """Test that a dropped client resumes its session and gets only what it missed"""
+    print("Testing session resume...")
+    server_process = start_test_server(12351, '--presence-window', '0', '--resume-grace', '1.5')
+    
+    async def expect(client, text):
+        """Messages received up to and including the one with text"""
+        received = []
+        async for message in client:
+            received.append(message)
+            if message.get('message') == text:
+                return received
+    
+    async def scenario():
+        alice = await ChatClient('localhost', 12351, 'Alice', encoding='binary', backoff_initial=0.4).connect()
+        bob = await ChatClient('localhost', 12351, 'Bob').connect()
+        await alice.command('/join dev')
+        await expect(alice, 'Alice joined #dev')
+        await bob.command('/join dev')
+        await expect(alice, 'Bob joined #dev')
+        
+        # The network goes away under Alice; she comes back before the grace period ends
+        alice.writer.transport.abort()
+        await bob.private('Alice', 'away 1')
+        await bob.room('dev', 'away 2')
+        await bob.send('away 3')
+        missed = await expect(alice, 'away 3')
+        await alice.send('back')
+        seen_by_bob = await expect(bob, 'back')
+        
+        # A session nobody comes back for expires, and only then is the user gone
+        carol = socket.create_connection(('localhost', 12351), timeout=5)
+        carol.sendall(encode_frame(json.dumps({"username": "Carol", "resume": True}).encode('utf-8')))
+        await expect(bob, 'Carol joined the chat')
+        carol.close()
+        dropped = time.time()
+        await expect(bob, 'Carol left the chat')
+        expired_after = time.time() - dropped
+        
+        await alice.close()  # Logging out ends the session straight away
+        await expect(bob, 'Alice left the chat')
+        users = await bob.users()
+        await bob.close()
+        return missed, seen_by_bob, expired_after, users, alice
+    
+    try:
+        missed, seen_by_bob, expired_after, users, alice = asyncio.run(asyncio.wait_for(scenario(), 20))
+        texts = [message.get('message') for message in missed]
+        notices = [message['message'] for message in seen_by_bob if 'presence' in message]
+        if texts == ['Welcome back Alice!', 'away 1', 'away 2', 'away 3'] and missed[0].get('lost') == 0 \
+                and alice.resumed == 1 and alice.reconnects == 1 and notices == [] \
+                and 1.4 < expired_after < 3 and users == ['Bob']:
+            print("[OK] Dropped client resumed without notices and got only the 3 messages it missed")
+            return True
+        print(f"[FAIL] Alice got {texts} after {alice.resumed} resumes, Bob saw notices {notices}, "
+              f"Carol expired after {expired_after:.1f}s, users {users}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing session resume: {e}")
+        return False
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+def test_renderer():
+    """Test that a message flood is written in one go with the overflow collapsed"""
+    print("Testing batched rendering...")
+    
+    class Terminal:
+        def __init__(self):
+            self.writes = []
+        def write(self, text):
+            self.writes.append(text)
+        def flush(self):
+            pass
+    
+    terminal = Terminal()
+    renderer = Renderer(lambda message: f"{message['sender']}: {message['message']}", terminal,
+                        interval=0.05, max_lines=20)
+    
+    async def scenario():
+        for i in range(5000):
+            renderer.add({"sender": "bot", "message": str(i)})
+            if i == 10:
+                renderer.add({"sender": "Bob", "message": "psst"}, important=True)
+        await asyncio.sleep(0.1)
+    
+    try:
+        asyncio.run(scenario())
+        lines = ''.join(terminal.writes).splitlines()
+        if len(terminal.writes) == 1 and lines[:2] == ["...4981 more messages", "Bob: psst"] \
+                and lines[2:] == [f"bot: {i}" for i in range(4981, 5000)] \
+                and (renderer.displayed, renderer.collapsed) == (20, 4981):
+            print("[OK] 5001 messages written in one update, 4981 collapsed, private message kept")
+            return True
+        print(f"[FAIL] {len(terminal.writes)} writes, first lines {lines[:3]}, "
+              f"{renderer.displayed} displayed, {renderer.collapsed} collapsed")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing rendering: {e}")
+        return False
+
+def test_throttled_user_lists():
+    """Test that user list requests dropped by the rate limit are answered and do not stall later ones"""
+    print("Testing throttled user lists...")
+    server_process = start_test_server(12352, '--rate-limit', 'users=1/1')
+
+    async def scenario():
+        alice = await ChatClient('localhost', 12352, 'Alice').connect()
+        burst = await asyncio.gather(alice.users(), alice.users(), alice.users(), return_exceptions=True)
+        # A call abandoned after its request went out must not take the next call's reply
+        abandoned = asyncio.create_task(alice.users())
+        await asyncio.sleep(0)
+        abandoned.cancel()
+        await asyncio.sleep(1.2)
+        users = await alice.users()
+        await alice.close()
+        return burst, users
+
+    try:
+        burst, users = asyncio.run(asyncio.wait_for(scenario(), 10))
+        refused = [isinstance(result, RateLimited) for result in burst]
+        if burst[0] == ['Alice'] and refused == [False, True, True] and users == ['Alice']:
+            print("[OK] Dropped user list requests were refused and the next one was answered")
+            return True
+        print(f"[FAIL] Burst got {burst}, later request got {users}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing throttled user lists: {e!r}")
+        return False
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+def test_cluster():
+    """Test unique names, user lists and private messages across worker processes"""
+    print("Testing cluster mode...")
+    server_process = start_test_server(12353, '--workers', '2', '--engine', 'asyncio')
+
+    async def first_private(client):
+        async for message in client:
+            if message.get('type') == 'private':
+                return message
+
+    async def scenario():
+        # Connections are spread over both workers by the kernel
+        names = [f"user{i}" for i in range(6)]
+        clients = [await ChatClient('localhost', 12353, name).connect() for name in names]
+        # The same new name claimed from two connections at once
+        racing = await asyncio.gather(*(ChatClient('localhost', 12353, 'Dup', reconnect=False).connect()
+                                        for _ in range(2)), return_exceptions=True)
+        won = [client for client in racing if isinstance(client, ChatClient)]
+        users = await clients[0].users()
+        for i, client in enumerate(clients):
+            await client.private(names[(i + 1) % len(names)], f"from {names[i]}")
+        received = await asyncio.gather(*(first_private(client) for client in clients))
+        for client in clients + won:
+            await client.close()
+        return len(won), users, names, [message['sender'] for message in received]
+
+    try:
+        won, users, names, senders = asyncio.run(asyncio.wait_for(scenario(), 20))
+        if won == 1 and users == sorted(names + ['Dup']) and senders == names[-1:] + names[:-1]:
+            print("[OK] Names were unique across workers and private messages reached every worker")
+            return True
+        print(f"[FAIL] {won} connections got the same name, users {users}, private messages from {senders}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing cluster mode: {e!r}")
+        return False
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+def test_federation():
+    """Test unique names, user lists and private messages between two federated nodes"""
+    print("Testing federation...")
+    first = start_test_server(12354, '--federation-port', '12355', '--engine', 'asyncio')
+    second = start_test_server(12356, '--federation-port', '12357', '--peer', 'localhost:12355')
+
+    async def privates(client, count):
+        received = []
+        async for message in client:
+            if message.get('type') == 'private':
+                received.append(message['message'])
+                if len(received) == count:
+                    return received
+
+    async def scenario():
+        alice = await ChatClient('localhost', 12354, 'Alice').connect()
+        bob = await ChatClient('localhost', 12356, 'Bob').connect()
+        users = []
+        for _ in range(50):  # Until the nodes have linked up
+            users = await alice.users()
+            if users == ['Alice', 'Bob']:
+                break
+            await asyncio.sleep(0.1)
+        try:
+            await ChatClient('localhost', 12356, 'Alice', reconnect=False).connect()
+            taken = False
+        except UsernameTaken:
+            taken = True
+        for i in range(3):
+            await alice.private('Bob', f"hi {i}")
+        await bob.private('Alice', 'hello')
+        received = await asyncio.gather(privates(bob, 3), privates(alice, 1))
+        
+        # A name owned by the first node, held by a user of the second node when that node dies
+        ring = HashRing(['localhost:12355', 'localhost:12357'])
+        stray = next(name for name in (f"user{i}" for i in range(100)) if ring.lookup(name) == 'localhost:12355')
+        await ChatClient('localhost', 12356, stray, reconnect=False).connect()
+        second.kill()
+        second.wait()
+        returned = None
+        for _ in range(50):  # Until the first node notices
+            try:
+                returned = await ChatClient('localhost', 12354, stray, reconnect=False).connect()
+                break
+            except UsernameTaken:
+                await asyncio.sleep(0.1)
+        await alice.close()
+        if returned is not None:
+            await returned.close()
+        return users, taken, received, returned is not None
+
+    try:
+        users, taken, received, reclaimed = asyncio.run(asyncio.wait_for(scenario(), 20))
+        if users == ['Alice', 'Bob'] and taken and received == [['hi 0', 'hi 1', 'hi 2'], ['hello']] and reclaimed:
+            print("[OK] Names were unique across nodes, private messages crossed both ways "
+                  "and names held on a dead node were freed")
+            return True
+        print(f"[FAIL] Users {users}, name taken on the other node: {taken}, private messages {received}, "
+              f"name freed after its node died: {reclaimed}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing federation: {e!r}")
+        return False
+    finally:
+        for process in (first, second):
+            process.terminate()
+            process.wait()
+
+def test_slow_consumers():
+    """Test that a client that stops reading is evicted, or has messages dropped until it catches up"""
+    print("Testing slow consumers...")
+    limits = ['--high-watermark', '65536', '--low-watermark', '8192', '--rate-limit', 'broadcast=0']
+    evicting = start_test_server(12358, *limits)
+    dropping = start_test_server(12359, *limits, '--slow-consumer', 'drop', '--engine', 'asyncio')
+    flood = 6000
+    
+    def stalled(port):
+        """A length-framed client with a tiny receive window that does not read yet"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.settimeout(1)
+        sock.connect(('localhost', port))
+        sock.sendall(encode_frame(json.dumps({"username": "Slow"}).encode('utf-8')))
+        return sock
+    
+    def read_until(sock, text=None):
+        """Messages received up to the one with text, or until the connection goes quiet or away"""
+        decoder = FrameDecoder()
+        received = []
+        while not received or received[-1].get('message') != text:
+            try:
+                if not decoder.recv_into(sock):
+                    break
+            except OSError:
+                break
+            received.extend(decode_json(payload) for flags, payload in decoder.frames())
+        return received
+    
+    async def scenario(port, evicted):
+        slow = stalled(port)
+        sender = await ChatClient('localhost', port, 'Fast').connect()
+        for i in range(flood):
+            await sender.send(f"flood {i} " + 'x' * 1000)
+        users = await sender.users()
+        for _ in range(50):  # Until the server has caught up with the flood
+            if users == ['Fast'] or not evicted:
+                break
+            await asyncio.sleep(0.1)
+            users = await sender.users()
+        loop = asyncio.get_running_loop()
+        caught_up = await loop.run_in_executor(None, read_until, slow)
+        await sender.send('after')
+        after = await loop.run_in_executor(None, read_until, slow, 'after')
+        slow.close()
+        await sender.close()
+        return users, caught_up, after
+    
+    try:
+        users, _, evicted = asyncio.run(asyncio.wait_for(scenario(12358, True), 20))
+        _, caught_up, after = asyncio.run(asyncio.wait_for(scenario(12359, False), 20))
+        received = [m for m in caught_up if m.get('message', '').startswith('flood ')]
+        # Every dropped message is counted in a notice once the queue drains below the low watermark
+        dropped = sum(m.get('dropped', 0) for m in caught_up + after)
+        if users == ['Fast'] and evicted == [] and 0 < dropped == flood - len(received) \
+                and after[-1].get('message') == 'after':
+            print(f"[OK] Slow client was evicted, or had {dropped} messages dropped and was told once it caught up")
+            return True
+        print(f"[FAIL] Users after the flood {users}, evicted client got {evicted}, "
+              f"{len(received)} of {flood} received and {dropped} reported dropped, then {after[-2:]}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing slow consumers: {e!r}")
+        return False
+    finally:
+        for process in (evicting, dropping):
+            process.terminate()
+            process.wait()
+
+def test_frame_decoder():
+    """Test that merged, split and oversized frames are handled"""
+    print("Testing frame decoder...")
+    try:
+        first = encode_frame(b'{"type": "message", "message": "one"}')
+        second = encode_frame(b'{"type": "message", "message": "two"}')
+        line = b'{"type": "message", "message": "three"}\n'
+        merged = b'{"type": "message", "message": "four"}{"type": "message", "message": "five"}'
+        stream = first + line + second + merged
+        
+        # Deliver the stream in awkward chunk sizes across frame boundaries
+        decoder = FrameDecoder(buffer_size=16)
+        messages = []
+        for i in range(0, len(stream), 7):
+            decoder.feed(stream[i:i + 7])
+            messages.extend(decode_json(payload)['message'] for flags, payload in decoder.frames())
+        
+        limited = FrameDecoder(max_frame_size=8)
+        limited.feed(first)
+        try:
+            list(limited.frames())
+            rejected = False
+        except FrameError:
+            rejected = True
+        
+        if messages == ['one', 'three', 'two', 'four', 'five'] and rejected:
+            print("[OK] Frame decoder split and limited frames correctly")
+            return True
+        print(f"[FAIL] Decoded {messages}, oversized frame rejected: {rejected}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing frame decoder: {e}")
+        return False
+
+def test_rooms():
+    """Test joining, leaving and listing rooms, room delivery and cleanup on disconnect"""
+    print("Testing rooms...")
+    index = RoomIndex()
+    index.join('Carol', 'dev')
+    index.join('Carol', 'ops')
+    index.join('Alice', 'dev')
+    left = index.leave_all('Carol')
+    cleaned = left == {'dev', 'ops'} and index.members == {'dev': {'Alice'}} and 'Carol' not in index.user_rooms
+    
+    server_process = start_test_server(12360, '--presence-window', '0')
+    
+    async def expect(client, text):
+        """Messages received up to and including the one with text"""
+        received = []
+        async for message in client:
+            received.append(message)
+            if message.get('message') == text:
+                return received
+    
+    async def scenario():
+        alice = await ChatClient('localhost', 12360, 'Alice').connect()
+        bob = await ChatClient('localhost', 12360, 'Bob').connect()
+        carol = await ChatClient('localhost', 12360, 'Carol', resume=False).connect()
+        for client, name in ((alice, 'Alice'), (bob, 'Bob'), (carol, 'Carol')):
+            await client.command('/join dev')
+            await expect(alice, f"{name} joined #dev")
+        await carol.command('/join ops')
+        await carol.command('/rooms')
+        await expect(carol, 'Your rooms: #dev, #ops')
+        await bob.command('/leave dev')
+        await expect(bob, 'You left #dev')
+        await expect(alice, 'Bob left #dev')
+        
+        # Room messages reach the members but not Bob, who still gets broadcasts
+        await alice.room('dev', 'dev only')
+        to_carol = (await expect(carol, 'dev only'))[-1]
+        await alice.send('everyone')
+        to_bob = await expect(bob, 'everyone')
+        
+        # A dropped connection leaves every room, and empty rooms go away
+        carol.writer.transport.abort()
+        await expect(alice, 'Carol left the chat')
+        await alice.command('/members dev')
+        await expect(alice, 'Members of #dev: Alice')
+        await alice.command('/members ops')
+        await expect(alice, 'Members of #ops: none')
+        await alice.close()
+        await bob.close()
+        return to_carol, to_bob
+    
+    try:
+        to_carol, to_bob = asyncio.run(asyncio.wait_for(scenario(), 10))
+        if cleaned and (to_carol['type'], to_carol['room'], to_carol['sender']) == ('room', 'dev', 'Alice') \
+                and not any(message.get('type') == 'room' for message in to_bob):
+            print("[OK] Rooms joined, left, listed and cleaned up; room messages reached only members")
+            return True
+        print(f"[FAIL] Index cleaned up: {cleaned}, Carol got {to_carol}, Bob got {to_bob}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing rooms: {e!r}")
+        return False
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+def test_send_frames():
+    """Test that vectored sends resume after partial writes and that queued frames share send calls"""
+    print("Testing vectored sends...")
+    try:
+        # Small buffers on both ends make sendmsg() stop part way through a frame
+        listener = socket.create_server(('localhost', 0))
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        receiver.connect(listener.getsockname())
+        sender, _ = listener.accept()
+        listener.close()
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        sender.settimeout(5)
+        frames = [encode_frame(json.dumps({"message": f"{i} " + 'x' * (i * 37 % 3000)}).encode('utf-8'))
+                  for i in range(200)]
+        results = []
+        writer = threading.Thread(target=lambda: results.append(send_frames(sender, frames)))
+        writer.start()
+        received = bytearray()
+        while len(received) < sum(map(len, frames)):
+            received += receiver.recv(1000)
+        writer.join()
+        sender.close()
+        receiver.close()
+        
+        # A connection's writer waits for more frames before each send
+        server = ChatServer(coalesce_delay_ms=50)
+        near, far = socket.socketpair()
+        connection = ThreadedConnection(server, near, ('localhost', 0))
+        connection.username = 'Alice'
+        for i in range(100):
+            connection.send(encode_frame(b'{"message": "hi"}'))
+        connection.close()
+        far.settimeout(5)
+        while far.recv(65536):
+            pass
+        far.close()
+        stats = server.write_stats
+        
+        if bytes(received) == b''.join(frames) and results[0] > 1 and stats.frames == 100 \
+                and stats.calls < stats.frames:
+            print(f"[OK] Partial sends resumed in place over {results[0]} calls; {stats.summary()}")
+            return True
+        print(f"[FAIL] Stream intact: {bytes(received) == b''.join(frames)} after {results} calls; "
+              f"{stats.summary()}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing vectored sends: {e!r}")
+        return False
+
+def test_binary_encoding():
+    """Test that binary frames round-trip and unsupported messages fall back to JSON"""
+    print("Testing binary encoding...")
+    try:
+        interns = InternTable()
+        message = {"type": "private", "sender": "alice", "target": "bob",
+                   "message": "hi", "timestamp": "12:00:00"}
+        frame, ids = Payload(message).binary(interns)
+        
+        decoder = FrameDecoder()
+        decoder.feed(b''.join(interns.define_frame(name_id) for name_id in ids) + frame)
+        names = {}
+        decoded = [decode_binary(payload, names) for flags, payload in decoder.frames()
+                   if flags & FLAG_BINARY]
+        fallback, _ = Payload({"type": "system", "error": "username_taken", "message": "x"}).binary(interns)
+        
+        received = decoded[-1]
+        if (received['sender'], received['target'], received['message']) == ('alice', 'bob', 'hi') \
+                and decoded[:-1] == [None, None] and fallback is None:
+            print("[OK] Binary frames decoded correctly")
+            return True
+        print(f"[FAIL] Decoded {decoded}, fallback frame: {fallback}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing binary encoding: {e}")
+        return False
+
+def test_fast_path():
+    """Test that plain messages are routed from their raw bytes and everything else falls back"""
+    print("Testing fast path...")
+    try:
+        envelope = scan_envelope(json.dumps({"type": "private", "target": "bob",
+                                             "message": "caf\u00e9 \"x\""}).encode('utf-8'))
+        message_type, target, body = envelope
+        raw = raw_private("alice", target, body)
+        full = Payload({"type": "private", "sender": "alice", "target": "bob",
+                        "message": 'caf\u00e9 "x"', "timestamp": raw.field('timestamp')})
+        fallbacks = [scan_envelope(json.dumps(message).encode('utf-8')) for message in (
+            {"type": "message", "message": "/users"},
+            {"type": "message", "message": "hi", "room": "ops"},
+            {"message": "hi", "type": "message"},
+            {"type": "private", "target": "b\u00f8b", "message": "hi"},
+            {"type": "list_users"},
+        )]
+        
+        if (message_type, target) == ('private', 'bob') and raw.json == full.json \
+                and raw.message == full.message and fallbacks == [None] * len(fallbacks):
+            print("[OK] Fast path matched the full parser")
+            return True
+        print(f"[FAIL] Envelope {envelope}, raw {raw.json}, fallbacks {fallbacks}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing fast path: {e}")
+        return False
+
+def test_compression():
+    """Test compressed frames round-trip and oversized inflation is refused"""
+    print("Testing compression...")
+    try:
+        message = {"type": "message", "sender": "alice", "message": "ERROR disk full\n" * 200,
+                   "timestamp": "12:00:00"}
+        payload = Payload(message)
+        frame = payload.compressed(payload.frame('length'))
+        decoded = decode_message(frame[0], frame[4:], {})
+        cached = payload.compressed(payload.frame('length')) is frame
+        
+        bomb = compress_frame(encode_frame(b'{"message": "' + b'x' * 100000 + b'"}'))
+        try:
+            decode_message(bomb[0], bomb[4:], {}, max_size=1024)
+            refused = False
+        except FrameError:
+            refused = True
+        
+        if frame[0] & FLAG_COMPRESSED and len(frame) < 200 and decoded == message and cached and refused:
+            print(f"[OK] Compressed {len(payload.json)} bytes to {len(frame)}")
+            return True
+        print(f"[FAIL] Frame {len(frame)} bytes, round trip: {decoded == message}, cached: {cached}, "
+              f"bomb refused: {refused}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing compression: {e}")
+        return False
+
+def test_rate_limiter():
+    """Test per-connection and global token buckets"""
+    print("Testing rate limiter...")
+    try:
+        class Client:
+            def __init__(self):
+                self.buckets = {}
+        
+        limiter = RateLimiter({'broadcast': (1.0, 3)}, {'broadcast': (1.0, 5)})
+        first, second = Client(), Client()
+        allowed_first = sum(limiter.allow(first, 'broadcast') for _ in range(10))
+        allowed_second = sum(limiter.allow(second, 'broadcast') for _ in range(10))
+        unlimited = all(limiter.allow(first, 'private') for _ in range(100))
+        
+        if (allowed_first, allowed_second) == (3, 2) and unlimited and limiter.dropped['broadcast'] == 15:
+            print("[OK] Token buckets limited each client and the server")
+            return True
+        print(f"[FAIL] Allowed {allowed_first} and {allowed_second}, private unlimited: {unlimited}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing rate limiter: {e}")
+        return False
+
+def test_client_registry():
+    """Test registry snapshots and paginated prefix listings"""
+    print("Testing client registry...")
+    try:
+        registry = ClientRegistry(page_size=4)
+        connections = {f"user{i:03d}": object() for i in range(250)}
+        for username, connection in connections.items():
+            registry.add(username, connection)
+        registry.add("bob", object())
+        
+        snapshot = registry.snapshot()
+        taken = registry.add("bob", object())
+        stale = registry.remove("user000", object())
+        registry.remove("user001", connections["user001"])
+        names, text = registry.listing("user01", 3)
+        
+        consistent = len(snapshot) == 251 and registry.snapshot() is not snapshot and len(registry) == 250
+        if (not taken and not stale and consistent and names == ["user018", "user019"]
+                and text == "Connected users matching 'user01' (page 3 of 3, 10 total): user018, user019"
+                and registry.listing("user01", 3)[1] is text):
+            print("[OK] Registry kept snapshots consistent and paginated by prefix")
+            return True
+        print(f"[FAIL] Taken {taken}, stale removal {stale}, consistent {consistent}, listing {text!r}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing client registry: {e}")
+        return False
+
+def test_presence_digest():
+    """Test that joins and leaves within a window become one notice"""
+    print("Testing presence digests...")
+    try:
+        class Connection:
+            def __init__(self, presence):
+                self.presence = presence
+                self.received = []
+            def send_payload(self, payload):
+                self.received.append(payload.message['message'])
+        
+        server = ChatServer()
+        watcher, quiet = Connection(True), Connection(False)
+        server.clients.add("watcher", watcher)
+        server.clients.add("quiet", quiet)
+        server.presence = PresenceDigest(server, window=0.2)
+        server.presence.joined("alice")
+        for i in range(30):
+            server.presence.joined(f"bot{i}")
+        server.presence.left("bot0")  # Joined and left within the window: not announced
+        server.presence.left("carol")
+        time.sleep(0.4)
+        
+        if watcher.received == ["alice joined the chat", "+29 joined, -1 left"] and not quiet.received:
+            print("[OK] 32 events announced in 2 notices, opted-out client skipped")
+            return True
+        print(f"[FAIL] Received {watcher.received}, opted out received {quiet.received}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing presence digests: {e}")
+        return False
+
+def test_metrics():
+    """Test that instrumented handlers are timed and rendered"""
+    print("Testing metrics...")
+    try:
+        server = ChatServer(metrics=True)
+        server.broadcast_message({"type": "system", "message": "hello"})
+        text = server.metrics.render()
+        plain = ChatServer()
+        
+        timed = 'chat_handler_seconds_count{handler="broadcast_message"} 1' in text and 'handle_client' not in text
+        untouched = plain.metrics is None and 'broadcast_message' not in vars(plain)
+        if timed and untouched:
+            print("[OK] Handlers timed only with metrics enabled")
+            return True
+        print(f"[FAIL] Broadcast timed: {timed}, disabled server untouched: {untouched}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing metrics: {e}")
+        return False
+
+def test_message_log():
+    """Test history replay across segments and recovery from a torn write"""
+    print("Testing message log...")
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            log = MessageLog(directory, segment_bytes=1024, index_interval=4, fsync='never')
+            for i in range(100):
+                log.append(encode_frame(json.dumps({"message": f"m{i}"}).encode('utf-8')), timestamp=1000 + i)
+            log.close()
+            
+            # Simulate a crash in the middle of writing a record
+            last_segment = sorted(name for name in os.listdir(directory) if name.endswith('.log'))[-1]
+            with open(os.path.join(directory, last_segment), 'ab') as f:
+                f.write(b'\x00' * 7)
+            
+            log = MessageLog(directory, segment_bytes=1024, index_interval=4, fsync='never')
+            last = [decode_json(frame[4:])['message'] for seq, ts, audience, frame in log.last(3)]
+            since = [seq for seq, ts, audience, frame in log.since(1050)]
+            segments = len(log.segments)
+
+            log.close()
+
+            # Another thread appending right after the reader's flush leaves a record in the write buffer
+            class RacingLog(MessageLog):
+                def flush(self, sync=False):
+                    flushed = MessageLog.flush(self, sync)
+                    self.append(encode_frame(b'{"message": "late"}'))
+                    return flushed
+            log = RacingLog(directory, segment_bytes=1024, index_interval=4, fsync='never')
+            scanned = sum(1 for record in log.records(0))
+            log.close()
+            
+            # The sync interval option reaches the server's log
+            args = parse_args(['--history-dir', directory, '--history-fsync-ms', '250'])
+            log = ChatServer(history_dir=args.history_dir, history_fsync_ms=args.history_fsync_ms).history
+            fsync_interval = log.fsync_interval
+            log.close()
+
+        if last == ['m97', 'm98', 'm99'] and since == list(range(50, 100)) and segments > 1 and scanned == 100 \
+                and fsync_interval == 0.25:
+            print("[OK] Message log replayed and recovered correctly")
+            return True
+        print(f"[FAIL] Replayed {last}, since {since[:3]}..., {segments} segments, {scanned} records scanned, "
+              f"synced every {fsync_interval}s")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing message log: {e}")
+        return False
+
+def test_search_index():
+    """Test search filters, private message visibility and reloading the saved index"""
+    print("Testing search index...")
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            log = MessageLog(directory, fsync='never')
+            index = SearchIndex(log, save_interval=0)
+            messages = [
+                ({"type": "message", "sender": "alice", "message": "Deploy is green"}, ()),
+                ({"type": "message", "sender": "bob", "message": "deploy failed, rolling back"}, ()),
+                ({"type": "private", "sender": "bob", "target": "carol", "message": "deploy secrets"},
+                 ("bob", "carol")),
+            ]
+            for message, audience in messages:
+                index.append(encode_frame(json.dumps(message).encode('utf-8')), message, audience)
+            index.save()
+            # Logged after the save: picked up from the log on reload
+            late = {"type": "message", "sender": "alice", "message": "deploy done"}
+            log.append(encode_frame(json.dumps(late).encode('utf-8')))
+            reloaded = SearchIndex(log, save_interval=0)
+            
+            def texts(query, username):
+                return [message['message'] for ts, message in reloaded.search(query, username)]
+            
+            found = (texts("deploy", "alice"), texts("DEPLOY from:alice", "dave"), texts("deploy", "carol"))
+            log.close()
+        
+        expected = (["deploy done", "deploy failed, rolling back", "Deploy is green"],
+                    ["deploy done", "Deploy is green"],
+                    ["deploy done", "deploy secrets", "deploy failed, rolling back", "Deploy is green"])
+        if found == expected:
+            print("[OK] Search filtered by sender and hid other users' private messages")
+            return True
+        print(f"[FAIL] Found {found}")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing search index: {e}")
+        return False
+
+def test_hash_ring():
+    """Test that adding a node only remaps a small share of users"""
+    print("Testing consistent-hash ring...")
+    try:
+        users = [f"user{i}" for i in range(10000)]
+        ring = HashRing(["node-a", "node-b", "node-c", "node-d"])
+        before = {user: ring.lookup(user) for user in users}
+        ring.add("node-e")
+        moved = [user for user in users if ring.lookup(user) != before[user]]
+        
+        # Ideally 1/5 of users move, and only ever to the new node
+        share = len(moved) / len(users)
+        if 0.1 < share < 0.3 and all(ring.lookup(user) == "node-e" for user in moved):
+            print(f"[OK] Adding a node remapped {share:.0%} of users")
+            return True
+        print(f"[FAIL] Adding a node remapped {share:.0%} of users")
+        return False
+    except Exception as e:
+        print(f"[FAIL] Error testing hash ring: {e}")
+        return False
+
 def check_files():
     """Check if all required files exist"""
     print("Checking required files...")
@@ -103,7 +1132,7 @@ def main():
     os.chdir(script_dir)
     
     tests_passed = 0
-    total_tests = 3
+    total_tests = 27
     
     # Test 1: Check files
     if check_files():
@@ -120,6 +1149,126 @@ def main():
         tests_passed += 1
     print()
     
+    # Test 4: Asyncio engine
+    if test_asyncio_engine():
+        tests_passed += 1
+    print()
+    
+    # Test 5: Asyncio client library
+    if test_async_client():
+        tests_passed += 1
+    print()
+    
+    # Test 6: Frame decoder
+    if test_frame_decoder():
+        tests_passed += 1
+    print()
+    
+    # Test 7: Binary encoding
+    if test_binary_encoding():
+        tests_passed += 1
+    print()
+    
+    # Test 8: Compression
+    if test_compression():
+        tests_passed += 1
+    print()
+    
+    # Test 9: Message log
+    if test_message_log():
+        tests_passed += 1
+    print()
+    
+    # Test 10: Consistent-hash ring
+    if test_hash_ring():
+        tests_passed += 1
+    print()
+    
+    # Test 11: Metrics
+    if test_metrics():
+        tests_passed += 1
+    print()
+    
+    # Test 12: Rate limiter
+    if test_rate_limiter():
+        tests_passed += 1
+    print()
+    
+    # Test 13: Client registry
+    if test_client_registry():
+        tests_passed += 1
+    print()
+    
+    # Test 14: Presence digests
+    if test_presence_digest():
+        tests_passed += 1
+    print()
+    
+    # Test 15: Offline inbox
+    if test_offline_inbox():
+        tests_passed += 1
+    print()
+    
+    # Test 16: Search index
+    if test_search_index():
+        tests_passed += 1
+    print()
+    
+    # Test 17: Fast path
+    if test_fast_path():
+        tests_passed += 1
+    print()
+    
+    # Test 18: Timeouts
+    if test_timeouts():
+        tests_passed += 1
+    print()
+    
+    # Test 19: Handoff
+    if test_handoff():
+        tests_passed += 1
+    print()
+    
+    # Test 20: Session resume
+    if test_session_resume():
+        tests_passed += 1
+    print()
+    
+    # Test 21: Batched rendering
+    if test_renderer():
+        tests_passed += 1
+    print()
+    
+    # Test 22: Throttled user lists
+    if test_throttled_user_lists():
+        tests_passed += 1
+    print()
+    
+    # Test 23: Cluster mode
+    if test_cluster():
+        tests_passed += 1
+    print()
+    
+    # Test 24: Federation
+    if test_federation():
+        tests_passed += 1
+    print()
+    
+    # Test 25: Slow consumers
+    if test_slow_consumers():
+        tests_passed += 1
+    print()
+    
+    # Test 26: Vectored sends
+    if test_send_frames():
+        tests_passed += 1
+    print()
+    
+    # Test 27: Rooms
+    if test_rooms():
+        tests_passed += 1
+    print()
+    
     # Results
     print("=== Test Results ===")
     print(f"Tests passed: {tests_passed}/{total_tests}")
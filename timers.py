@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Connection timeouts driven by one hierarchical timing wheel.
+
+TimingWheel keeps timers in buckets instead of a heap: level 0 has one
+bucket per tick, and each level above covers `slots` times the span of
+the one below. A timer is dropped into the bucket for its expiry at the
+coarsest level that still resolves it and moves down a level whenever
+the level below wraps around, so scheduling and firing cost O(1) each
+however many timers there are. Timers fire at most one tick
+late; `now` is the wheel's clock, refreshed every tick, and is cheap
+enough to read for every packet.
+
+Heartbeats gives every connection exactly one timer. Receiving data only
+records the time; when the timer fires it works out what is due:
+
+- a connection that has not completed the username handshake within
+  handshake_timeout is closed;
+- a logged in client the server has heard nothing from for
+  heartbeat_interval is sent {"type": "ping"} and reaped if nothing (a
+  {"type": "pong"} or any other frame) arrives within heartbeat_timeout.
+  Only clients that announced "heartbeat": true in their handshake are
+  pinged; older clients would never answer, so their sockets get TCP
+  keepalive probes on the same schedule instead;
+- with idle_timeout set, a client that has sent no messages (pongs do
+  not count) for that long is disconnected.
+
+Otherwise the timer is pushed back to the next deadline. Each
+connection's ping interval is shortened by a random amount of up to 10%,
+so clients that logged in together (say, after a restart) are not all
+pinged in the same tick. Reaped connections are counted by reason.
+"""
+
+import asyncio
+import random
+import threading
+import time
+
+from connection import KEEPALIVE_PROBES
+from protocol import Payload
+
+DEFAULT_TICK = 0.1  # Seconds
+DEFAULT_SLOTS = 256
+DEFAULT_LEVELS = 3  # 256**3 ticks of 0.1s is over 19 days
+DEFAULT_HANDSHAKE_TIMEOUT = 120.0  # Older clients connect before asking the user for a name
+DEFAULT_HEARTBEAT_INTERVAL = 30.0
+DEFAULT_HEARTBEAT_TIMEOUT = 10.0
+DEFAULT_IDLE_TIMEOUT = 0.0  # Off
+HEARTBEAT_SPREAD = 0.1  # Ping intervals vary by up to this fraction
+REAP_REASONS = ('handshake', 'heartbeat', 'idle')
+HEARTBEAT_TYPES = ('ping', 'pong')
+
+PING = Payload({"type": "ping"})
+PONG = Payload({"type": "pong"})
+
+
+class TimingWheel:
+    """Hierarchical timing wheel of callbacks, advanced one tick at a time.
+
+    Buckets hold timers flattened into (expiry tick, callback, argument)
+    runs of a plain list, so scheduling allocates no objects of its own
+    and a hundred thousand long-lived timers add nothing for the garbage
+    collector to trace. Timers cannot be cancelled; a callback that is
+    no longer wanted should find nothing to do.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, levels=DEFAULT_LEVELS):
+        """tick is the resolution in seconds; slots and levels set the range"""
+        self.tick = tick
+        self.slots = slots
+        self.spans = [slots ** level for level in range(levels + 1)]  # Ticks per bucket, per level
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.overflow = []  # Timers beyond the top level's range
+        self.ticks = 0  # Ticks elapsed
+        self.started = time.monotonic()
+        self.now = self.started  # Time of the last tick
+        self.timers = 0  # Scheduled and not yet fired
+        self.fired = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback, argument):
+        """Call callback(argument) after delay seconds"""
+        with self.lock:
+            self.place(self.ticks + max(1, -int(-delay // self.tick)), callback, argument)
+            self.timers += 1
+
+    def schedule_at(self, when, callback, argument):
+        """Call callback(argument) at monotonic time when"""
+        self.schedule(when - self.now, callback, argument)
+
+    def place(self, expires, callback, argument):
+        """Put a timer in the bucket for its expiry tick; the caller holds the lock"""
+        remaining = expires - self.ticks
+        bucket = self.overflow
+        for level, wheel in enumerate(self.wheels):
+            if remaining < self.spans[level + 1]:
+                bucket = wheel[expires // self.spans[level] % self.slots]
+                break
+        bucket.append(expires)
+        bucket.append(callback)
+        bucket.append(argument)
+
+    def cascade(self, bucket):
+        """Move the timers of a bucket whose turn came down to finer levels"""
+        timers = bucket[:]
+        bucket.clear()
+        for i in range(0, len(timers), 3):
+            self.place(timers[i], timers[i + 1], timers[i + 2])
+
+    def advance(self, now=None):
+        """Fire every timer that expired by now (monotonic seconds)"""
+        now = time.monotonic() if now is None else now
+        target = int((now - self.started) / self.tick)
+        due = []
+        with self.lock:
+            while self.ticks < target:
+                self.ticks += 1
+                ticks = self.ticks
+                # Move the timers of every level that wrapped down a level, coarsest first
+                if ticks % self.spans[-1] == 0:
+                    self.cascade(self.overflow)
+                for level in range(len(self.wheels) - 1, 0, -1):
+                    if ticks % self.spans[level] == 0:
+                        self.cascade(self.wheels[level][ticks // self.spans[level] % self.slots])
+                bucket = self.wheels[0][ticks % self.slots]
+                due += bucket
+                bucket.clear()
+            self.now = now
+            self.timers -= len(due) // 3
+            self.fired += len(due) // 3
+        for i in range(1, len(due), 3):
+            try:
+                due[i](due[i + 1])
+            except Exception as e:
+                print(f"Error in timer callback: {e}")
+
+    def run(self):
+        """Advance the wheel every tick, forever; for a daemon thread"""
+        while True:
+            time.sleep(self.tick)
+            self.advance()
+
+    async def run_async(self):
+        """Advance the wheel every tick on the running event loop"""
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+
+class Heartbeats:
+    """Handshake deadlines, ping/pong heartbeats and idle timeouts for one server's clients"""
+
+    def __init__(self, server, handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, tick=DEFAULT_TICK):
+        """Timeouts are in seconds; 0 turns one off"""
+        self.server = server
+        self.handshake_timeout = handshake_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+        self.enabled = bool(handshake_timeout or heartbeat_interval or idle_timeout)
+        self.wheel = TimingWheel(tick)
+        self.pings = 0
+        self.reaped = dict.fromkeys(REAP_REASONS, 0)
+        self.check_connection = self.check  # Bound once, not per timer
+        self.lock = threading.Lock()
+
+    def start(self, needed=False):
+        """Drive the wheel: on the event loop for asyncio, else on a daemon thread.
+
+        Pass needed when something else schedules timers on the wheel,
+        as it is otherwise only driven with a timeout enabled.
+        """
+        if not (self.enabled or needed):
+            return
+        if self.server.loop is not None:
+            self.server.loop.create_task(self.wheel.run_async())
+        else:
+            threading.Thread(target=self.wheel.run, daemon=True).start()
+
+    def watch(self, connection):
+        """Start timing a freshly accepted connection"""
+        now = self.wheel.now
+        connection.connected_at = connection.last_seen = connection.last_message = now
+        connection.ping_sent = None
+        connection.ping_interval = self.heartbeat_interval * (1 - HEARTBEAT_SPREAD * random.random())
+        if self.enabled:
+            self.schedule(connection, self.next_deadline(connection, now))
+
+    def logged_in(self, connection, heartbeat):
+        """Note whether a client that just logged in answers pings"""
+        connection.heartbeat = heartbeat
+        if self.heartbeat_interval and not heartbeat:
+            # Only the kernel can tell whether this one is still there
+            connection.keep_alive(self.heartbeat_interval, self.heartbeat_timeout / KEEPALIVE_PROBES)
+
+    def schedule(self, connection, when):
+        """(Re)arm the connection's one timer"""
+        if when is not None:
+            self.wheel.schedule_at(when, self.check_connection, connection)
+
+    def next_deadline(self, connection, now):
+        """Earliest time something may be due for the connection, or None"""
+        if connection.username is None:
+            if self.handshake_timeout:
+                return connection.connected_at + self.handshake_timeout
+            # Nothing to enforce until the login, look again later
+            return now + (self.heartbeat_interval or self.idle_timeout)
+        deadlines = []
+        if self.idle_timeout:
+            deadlines.append(connection.last_message + self.idle_timeout)
+        if self.heartbeat_interval and connection.heartbeat:
+            if connection.ping_sent is not None and connection.last_seen < connection.ping_sent:
+                deadlines.append(connection.ping_sent + self.heartbeat_timeout)
+            else:
+                deadlines.append(max(connection.last_seen + connection.ping_interval, now))
+        return min(deadlines) if deadlines else None
+
+    def check(self, connection):
+        """The connection's timer fired: reap it, ping it, or wait for the next deadline"""
+        if connection.closed or connection.frozen:
+            return  # Gone, or handed off to another process
+        now = self.wheel.now
+        if connection.username is None:
+            if self.handshake_timeout and now - connection.connected_at >= self.handshake_timeout:
+                self.reap(connection, 'handshake')
+                return
+        else:
+            if self.idle_timeout and now - connection.last_message >= self.idle_timeout:
+                self.reap(connection, 'idle')
+                return
+            if self.heartbeat_interval and connection.heartbeat:
+                if connection.ping_sent is not None and connection.last_seen < connection.ping_sent:
+                    if now - connection.ping_sent >= self.heartbeat_timeout:
+                        self.reap(connection, 'heartbeat')
+                        return
+                elif now - connection.last_seen >= connection.ping_interval:
+                    self.ping(connection, now)
+        self.schedule(connection, self.next_deadline(connection, now))
+
+    def ping(self, connection, now):
+        """Ask a quiet client to prove it is still there"""
+        connection.ping_sent = now
+        with self.lock:
+            self.pings += 1
+        try:
+            connection.send(PING.frame(connection.framing))  # Unnumbered, never worth replaying
+        except OSError:
+            pass  # Already going away
+
+    def answer(self, connection, message):
+        """Handle a ping or pong from a client; receiving it already counted as activity"""
+        if message.get('type') == 'ping':
+            connection.send(PONG.frame(connection.framing))
+
+    def reap(self, connection, reason):
+        """Drop a dead, silent or idle connection"""
+        with self.lock:
+            self.reaped[reason] += 1
+        print(f"Reaping {connection.username or connection.address} ({reason} timeout)")
+        connection.abort()
+
+    def summary(self):
+        """One line for /stats and shutdown"""
+        reaped = ', '.join(f"{reason} {count}" for reason, count in self.reaped.items())
+        return (f"Timeouts: {sum(self.reaped.values())} connections reaped ({reaped}), "
+                f"{self.pings} pings, {self.wheel.timers} timers pending")